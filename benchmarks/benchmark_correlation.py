@@ -0,0 +1,63 @@
+"""
+Benchmark `statistics.correlation_matrix` against `pd.DataFrame.corr`.
+
+Usage (after installing the package with `pip install .`):
+    python benchmarks/benchmark_correlation.py --rows 10000 --columns 100 500 --missing 0 0.1
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from v6_carrier_py.statistics import correlation_matrix
+
+
+def create_dataset(n_rows, n_columns, missing, seed=0):
+    rng = np.random.RandomState(seed)
+    # Correlated columns: linear combinations of a few latent variables plus noise
+    latent = rng.normal(size=(n_rows, 10))
+    values = latent @ rng.normal(size=(10, n_columns)) + rng.normal(size=(n_rows, n_columns))
+    df = pd.DataFrame(values, columns=[f'feature{i}' for i in range(n_columns)])
+    if missing:
+        df = df.mask(rng.rand(*df.shape) < missing)
+    return df
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', nargs='+', type=int, default=[10000])
+    parser.add_argument('--columns', nargs='+', type=int, default=[100, 500])
+    parser.add_argument('--missing', nargs='+', type=float, default=[0, 0.1],
+                        help='share of missing values')
+    parser.add_argument('--methods', nargs='+', default=['pearson', 'spearman'])
+    args = parser.parse_args()
+
+    print(f'{"method":>9} {"rows":>8} {"columns":>8} {"missing":>8} {"pandas (s)":>11} {"float64 (s)":>12} '
+          f'{"float32 (s)":>12} {"speedup":>8} {"max error":>10}')
+    for method in args.methods:
+        for n_rows in args.rows:
+            for n_columns in args.columns:
+                for missing in args.missing:
+                    df = create_dataset(n_rows, n_columns, missing)
+
+                    pandas_time, expected = timed(df.corr, method)
+                    float64_time, result = timed(correlation_matrix, df, method)
+                    float32_time, result32 = timed(correlation_matrix, df, method, dtype='float32')
+
+                    pd.testing.assert_frame_equal(expected, result, check_exact=False, atol=1e-10)
+                    error = np.nanmax(np.abs(expected.values - result32.values))
+
+                    print(f'{method:>9} {n_rows:>8} {n_columns:>8} {missing:>8} {pandas_time:>11.2f} '
+                          f'{float64_time:>12.2f} {float32_time:>12.2f} {pandas_time / float64_time:>7.1f}x '
+                          f'{error:>10.1e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Benchmark `encryption.encrypt_identifiers` against the original row-wise
+implementation.
+
+The row-wise implementation is slow, so it is timed on a sample of at most
+`--legacy-rows` rows and extrapolated linearly to the full table size.
+
+Usage (after installing the package with `pip install .`):
+    python benchmarks/benchmark_encryption.py --rows 1e5 1e6 1e7 --jobs 4
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from v6_carrier_py.encryption import encrypt_identifiers, salthash
+
+IDENTIFIER_KEYS = ['GBAGeboorteJaar', 'GBAGeboorteMaand', 'GBAGeboorteDag', 'GBAGeslacht', 'GBAPostcode',
+                   'GBAHuisnummer', 'GBAToev']
+SALT = 'a' * 128
+
+
+def legacy_encrypt_identifiers(df, salt, identifiers):
+    def _hash_identifiers(row):
+        identifier_values = row[identifiers]
+        if any(pd.isna(identifier_values)):
+            raise ValueError('One of the identifier values is NaN or None')
+        joined_ids = ''.join(identifier_values.apply(str)).replace(' ', '')
+        return salthash(salt, joined_ids)
+    df['encrypted_identifier'] = df.apply(_hash_identifiers, axis=1)
+    return df.drop(columns=identifiers)
+
+
+def create_dataset(n_rows, seed=0):
+    rng = np.random.RandomState(seed)
+    postcodes = [f'{n} {a}{b}' for n, a, b in zip(rng.randint(1000, 9999, 1000),
+                                                   rng.choice(list('ABCDEFGH'), 1000),
+                                                   rng.choice(list('JKLMNOPQ'), 1000))]
+    return pd.DataFrame({
+        'GBAGeboorteJaar': rng.randint(1900, 2020, n_rows),
+        'GBAGeboorteMaand': rng.randint(1, 13, n_rows),
+        'GBAGeboorteDag': rng.randint(1, 29, n_rows),
+        'GBAGeslacht': rng.randint(0, 2, n_rows),
+        'GBAPostcode': rng.choice(postcodes, n_rows),
+        'GBAHuisnummer': rng.randint(1, 300, n_rows),
+        'GBAToev': rng.choice(['', 'a', 'b', 'I'], n_rows),
+        'value': rng.rand(n_rows),
+    })
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', nargs='+', type=float, default=[1e5, 1e6, 1e7])
+    parser.add_argument('--jobs', type=int, default=-1, help='number of processes, -1 uses all cpus')
+    parser.add_argument('--legacy-rows', type=int, default=100000,
+                        help='maximum number of rows the row-wise implementation is timed on')
+    args = parser.parse_args()
+
+    print(f'{"rows":>12} {"row-wise (s)":>14} {"vectorized (s)":>15} {"parallel (s)":>13} {"speedup":>8}')
+    for n_rows in map(int, args.rows):
+        df = create_dataset(n_rows)
+
+        legacy_rows = min(n_rows, args.legacy_rows)
+        legacy_time, legacy = timed(legacy_encrypt_identifiers, df.head(legacy_rows).copy(), SALT, IDENTIFIER_KEYS)
+        legacy_time *= n_rows / legacy_rows
+
+        vectorized_time, vectorized = timed(encrypt_identifiers, df.copy(), SALT, IDENTIFIER_KEYS)
+        parallel_time, parallel = timed(encrypt_identifiers, df.copy(), SALT, IDENTIFIER_KEYS, n_jobs=args.jobs)
+
+        pd.testing.assert_frame_equal(legacy, vectorized.head(legacy_rows))
+        pd.testing.assert_frame_equal(vectorized, parallel)
+
+        estimated = '*' if legacy_rows < n_rows else ' '
+        print(f'{n_rows:>12} {legacy_time:>13.2f}{estimated} {vectorized_time:>15.2f} {parallel_time:>13.2f} '
+              f'{legacy_time / min(vectorized_time, parallel_time):>7.1f}x')
+
+    print('* extrapolated from a sample of the rows')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Benchmark the encoding of node results (`transfer.write`) and decoding by the master (`transfer.decode`) for a wide
+table, with pickle and with Arrow IPC, uncompressed and compressed.
+
+Usage (from the root of the repository, after installing the package with `pip install .`):
+    python benchmarks/benchmark_result_formats.py --rows 100000 --columns 200
+"""
+import argparse
+import time
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+from vantage6.common import base64s_to_bytes, bytes_to_base64s
+
+from v6_carrier_py import transfer
+
+FORMATS = [('pickle', None, None), ('arrow', 'arrow', None), ('arrow lz4', 'arrow', 'lz4'),
+           ('arrow zstd', 'arrow', 'zstd')]
+
+
+def create_dataset(n_rows, n_columns, seed=0):
+    """
+    Clinical-like table: mostly measurements and counts, some categories.
+    """
+    rng = np.random.RandomState(seed)
+    columns = {}
+    for i in range(n_columns):
+        if i % 4 == 0:
+            columns[f'count{i}'] = rng.randint(0, 10, n_rows)
+        elif i % 4 == 1:
+            columns[f'category{i}'] = pd.Categorical(rng.choice(['low', 'medium', 'high'], n_rows))
+        else:
+            columns[f'measurement{i}'] = rng.normal(100, 15, n_rows).round(1)
+    return pd.DataFrame(columns)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--columns', type=int, default=200)
+    args = parser.parse_args()
+
+    df = create_dataset(args.rows, args.columns)
+    print(f'{"format":>12} {"write (s)":>10} {"read (s)":>10} {"size (MB)":>10}')
+    for name, output_format, compression in FORMATS:
+        start = time.perf_counter()
+        fp = BytesIO()
+        transfer.write(df, fp, output_format=output_format, compression=compression)
+        write_time = time.perf_counter() - start
+        # The server sends results base64 encoded
+        payload = bytes_to_base64s(fp.getvalue())
+
+        start = time.perf_counter()
+        result = transfer.decode(base64s_to_bytes(payload))
+        read_time = time.perf_counter() - start
+
+        pd.testing.assert_frame_equal(df, result)
+        print(f'{name:>12} {write_time:>10.2f} {read_time:>10.2f} {len(fp.getvalue()) / 2 ** 20:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Benchmark streaming, typed ingestion of SPARQL results (`sparql.query`) against reading the whole CSV response into a
+string and letting `pd.read_csv` infer the types, on a stand-in endpoint on localhost.
+
+Usage (from the root of the repository, after installing the package with `pip install .`):
+    python benchmarks/benchmark_sparql_ingestion.py --rows 100000 500000
+"""
+import argparse
+import time
+import tracemalloc
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+import requests
+
+from tests.sparql_server import SparqlServer, to_tsv
+from v6_carrier_py import sparql
+
+
+def create_dataset(n_rows, seed=0):
+    rng = np.random.RandomState(seed)
+    return pd.DataFrame({
+        'id': np.arange(n_rows),
+        'age': rng.randint(18, 90, n_rows),
+        'height': rng.normal(175, 10, n_rows).round(1),
+        'weight': rng.normal(80, 15, n_rows).round(1),
+        'sex': rng.choice(['M', 'F'], n_rows),
+        'postcode': [f'{p:04d}AB' for p in rng.randint(1000, 1100, n_rows)],
+        'visit_date': pd.Timestamp('2010-01-01') + pd.to_timedelta(rng.randint(0, 3650, n_rows), unit='D'),
+    })
+
+
+def read_csv_response(endpoint, query):
+    """
+    Ingestion as it was before streaming: decode the whole response and infer the types.
+    """
+    response = requests.post(endpoint, data={'query': query}, headers={'Accept': 'text/csv'})
+    return pd.read_csv(StringIO(response.content.decode()))
+
+
+def measured(func, *args, **kwargs):
+    """
+    Duration, peak memory and result of a call. Memory is traced in a second call, because tracing slows it down.
+    """
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    duration = time.perf_counter() - start
+
+    tracemalloc.start()
+    func(*args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return duration, peak, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', nargs='+', type=int, default=[100000, 500000])
+    parser.add_argument('--chunk-bytes', type=int, default=sparql.CHUNK_BYTES)
+    args = parser.parse_args()
+
+    print(f'{"rows":>8} {"csv (s)":>8} {"tsv (s)":>8} {"csv peak (MB)":>14} {"tsv peak (MB)":>14} '
+          f'{"csv size (MB)":>14} {"tsv size (MB)":>14}')
+    for n_rows in args.rows:
+        df = create_dataset(n_rows)
+        # Encoded up front, so the stand-in endpoint does not add to the traced memory
+        csv_payload = df.to_csv(index=False).encode()
+        tsv_payload = to_tsv(df).encode()
+
+        with SparqlServer(lambda query: csv_payload) as csv_server, \
+                SparqlServer(lambda query: tsv_payload) as tsv_server:
+            csv_time, csv_peak, csv_result = measured(read_csv_response, csv_server.endpoint, 'SELECT *')
+            tsv_time, tsv_peak, tsv_result = measured(sparql.query, tsv_server.endpoint, 'SELECT *',
+                                                      chunk_bytes=args.chunk_bytes)
+
+        pd.testing.assert_frame_equal(df, tsv_result, check_dtype=False, check_categorical=False)
+        csv_size = csv_result.memory_usage(deep=True).sum() / 2 ** 20
+        tsv_size = tsv_result.memory_usage(deep=True).sum() / 2 ** 20
+        print(f'{n_rows:>8} {csv_time:>8.2f} {tsv_time:>8.2f} {csv_peak / 2 ** 20:>14.1f} {tsv_peak / 2 ** 20:>14.1f} '
+              f'{csv_size:>14.1f} {tsv_size:>14.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -28,7 +28,8 @@ setup(
         'pandas',
         'vantage6-client==1.2.0',
         'scikit-learn',
-        'sparqlwrapper'
+        'requests',
+        'pyarrow'
     ]
     # ,
     # extras_require={
@@ -0,0 +1,115 @@
+import threading
+import time
+from datetime import datetime
+from io import BytesIO
+from typing import Any, Callable, Dict
+
+from vantage6.common import bytes_to_base64s
+
+from v6_carrier_py import transfer
+
+
+class VirtualClock:
+    """
+    Stand-in for the `time` module whose `sleep` advances the clock instead of waiting, so polling can be tested
+    without depending on the speed of the machine.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeContainerClient:
+    """
+    Stand-in for `ContainerClient` whose organizations take a scripted number of seconds to complete a task.
+
+    :param latencies: Number of seconds every organization takes, by organization id
+    :param respond: Function that computes the result of an organization from its id and the task input
+    """
+
+    def __init__(self, latencies: Dict[int, float], respond: Callable[[int, dict], Any]):
+        self.latencies = latencies
+        self.respond = respond
+        self.tasks = {}
+        self.requests = 0
+        # Number of results that were sent with their payload, by task id
+        self.downloads = {}
+        # Tasks whose results have not all been downloaded, and the largest number of such tasks at a time
+        self.in_flight = set()
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def get_organizations_in_my_collaboration(self):
+        return [{'id': organization_id} for organization_id in self.latencies]
+
+    def create_new_task(self, input_, organization_ids=()):
+        with self._lock:
+            task_id = len(self.tasks) + 1
+            self.tasks[task_id] = (time.monotonic(), input_, list(organization_ids))
+            self.in_flight.add(task_id)
+            self.max_in_flight = max(self.max_in_flight, len(self.in_flight))
+        return {'id': task_id}
+
+    def get_task(self, task_id):
+        # Like the server, a task only links to its results
+        self.requests += 1
+        results = self._results(task_id, payload=False)
+        return {'id': task_id, 'complete': all(r['finished_at'] is not None for r in results),
+                'results': [{'id': r['id']} for r in results]}
+
+    def get_results(self, task_id):
+        self.requests += 1
+        return [transfer.decode(self._result(task_id, organization_id))
+                for organization_id in self.tasks[task_id][2]]
+
+    def request(self, endpoint, params=None):
+        self.requests += 1
+        parts = endpoint.split('/')
+        if parts[0] == 'task':
+            return self._download(self._results(int(parts[1])))
+        if len(parts) == 2:
+            result_id = int(parts[1])
+            return self._download([r for r in self._results(result_id // 1000) if r['id'] == result_id])[0]
+        # Open results have no payload yet
+        open_only = params.get('state') == 'open'
+        results = self._results(int(params['task_id']), payload=not open_only)
+        return self._download([r for r in results if not open_only or r['finished_at'] is None])
+
+    def _download(self, results):
+        with self._lock:
+            for result in results:
+                if result['result'] is not None:
+                    task_id = result['id'] // 1000
+                    self.downloads[task_id] = self.downloads.get(task_id, 0) + 1
+                    if self.downloads[task_id] >= len(self.tasks[task_id][2]):
+                        self.in_flight.discard(task_id)
+        return results
+
+    def _results(self, task_id, payload=True):
+        created, input_, organization_ids = self.tasks[task_id]
+        elapsed = time.monotonic() - created
+        results = []
+        for i, organization_id in enumerate(organization_ids):
+            finished = elapsed >= self.latencies[organization_id]
+            results.append({
+                # Result ids are unique over all tasks
+                'id': task_id * 1000 + i,
+                'organization': {'id': organization_id},
+                'finished_at': datetime.now().isoformat() if finished else None,
+                'result': bytes_to_base64s(self._result(task_id, organization_id)) if finished and payload else None,
+            })
+        return results
+
+    def _result(self, task_id, organization_id):
+        # Encoded like the wrapper does on the nodes
+        input_ = self.tasks[task_id][1]
+        fp = BytesIO()
+        transfer.write(self.respond(organization_id, input_), fp, output_format=input_.get('output_format'),
+                       compression=input_.get('compression'), batch_rows=input_.get('batch_rows'))
+        return fp.getvalue()
@@ -0,0 +1,112 @@
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Callable
+from urllib.parse import parse_qs
+
+import numpy as np
+import pandas as pd
+
+XSD = 'http://www.w3.org/2001/XMLSchema#'
+
+
+class SparqlServer:
+    """
+    Stand-in SPARQL endpoint on localhost that answers every query with the TSV results of `respond`. When `respond`
+    raises an exception, the endpoint responds with an internal server error.
+
+    :param respond: Function that returns the result of a query as DataFrame, or as TSV text or bytes
+    """
+
+    def __init__(self, respond: Callable[[str], object]):
+        self.respond = respond
+        self.queries = []
+        # Number of queries that are being answered, and the largest number at a time
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+                query = parse_qs(body)['query'][0]
+                with server._lock:
+                    server.queries.append(query)
+                    server.in_flight += 1
+                    server.max_in_flight = max(server.max_in_flight, server.in_flight)
+
+                try:
+                    result = server.respond(query)
+                except Exception as e:
+                    self.send_error(500, str(e))
+                    return
+                finally:
+                    with server._lock:
+                        server.in_flight -= 1
+
+                if isinstance(result, pd.DataFrame):
+                    result = to_tsv(result)
+                payload = result if isinstance(result, bytes) else result.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/tab-separated-values')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self._server = Server(('127.0.0.1', 0), Handler)
+        self.endpoint = f'http://127.0.0.1:{self._server.server_port}/sparql'
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def paginated(df: pd.DataFrame) -> Callable[[str], pd.DataFrame]:
+    """
+    Respond to queries with the rows of `df`, sorted by all columns, that are selected by `LIMIT` and `OFFSET`.
+    """
+    def respond(query):
+        limit = re.search(r'LIMIT (\d+)', query)
+        offset = re.search(r'OFFSET (\d+)', query)
+        start = int(offset.group(1)) if offset else 0
+        stop = start + int(limit.group(1)) if limit else None
+        return df.sort_values(list(df.columns)).iloc[start:stop]
+    return respond
+
+
+def to_tsv(df: pd.DataFrame) -> str:
+    """
+    SPARQL TSV results with the rows of `df`. Integers and floats are typed literals, strings plain literals.
+    """
+    lines = ['\t'.join(f'?{column}' for column in df.columns)]
+    lines.extend('\t'.join(_term(value) for value in row) for row in df.itertuples(index=False))
+    return '\n'.join(lines) + '\n'
+
+
+def _term(value) -> str:
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return ''
+    if isinstance(value, (bool, np.bool_)):
+        return f'"{str(value).lower()}"^^<{XSD}boolean>'
+    if isinstance(value, (int, np.integer)):
+        return f'"{value}"^^<{XSD}integer>'
+    if isinstance(value, (float, np.floating)):
+        return f'"{float(value)!r}"^^<{XSD}double>'
+    if isinstance(value, pd.Timestamp):
+        return f'"{value.isoformat()}"^^<{XSD}dateTime>'
+    escaped = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\t', '\\t').replace('\n', '\\n')
+    return f'"{escaped}"'
@@ -1,5 +1,8 @@
-from v6_carrier_py import algorithms
+from v6_carrier_py import algorithms, encryption
+from v6_carrier_py.sketches import BloomFilter, HyperLogLog, estimate_overlap, hash_keys
+from v6_carrier_py.statistics import CorrelationStatistics
 import pandas as pd
+import pytest
 
 DATA = pd.DataFrame(data=[[1, 2], [3, 4]], columns=['column1', 'column2'])
 
@@ -16,7 +19,110 @@ def test_corr_matrix_creates_corr_matrix():
     pd.testing.assert_frame_equal(DATA.corr(), result)
 
 
+def test_corr_matrix_spearman():
+    result = algorithms.RPC_correlation_matrix(DATA, method='spearman')
+
+    pd.testing.assert_frame_equal(DATA.corr('spearman'), result)
+
+
+def test_correlation_statistics_give_corr_matrix():
+    result = algorithms.RPC_correlation_statistics(DATA)
+
+    pd.testing.assert_frame_equal(DATA.corr(), CorrelationStatistics.from_dict(result).correlation())
+
+
 def test_get_data_returns_raw_data():
     result = algorithms.RPC_get_data(DATA)
 
     pd.testing.assert_frame_equal(DATA, result)
+
+
+def test_get_data_returns_selected_keys():
+    keys = pd.DataFrame({'column1': [3]})
+
+    result = algorithms.RPC_get_data(DATA, keys=keys)
+
+    pd.testing.assert_frame_equal(DATA.iloc[[1]], result)
+
+
+def test_get_keys_returns_key_columns():
+    result = algorithms.RPC_get_keys(DATA, 'column1')
+
+    pd.testing.assert_frame_equal(DATA[['column1']], result)
+
+
+def test_get_data_applies_bloom_filter():
+    bloom_filter = BloomFilter.for_capacity(2, 0.001)
+    bloom_filter.add(hash_keys(DATA.iloc[[0]], 'column1'))
+
+    result = algorithms.RPC_get_data(DATA, merge_keys='column1', bloom_filter=bloom_filter.to_bytes())
+
+    pd.testing.assert_frame_equal(DATA.iloc[[0]], result)
+
+
+def test_bloom_filter_links_keys_with_different_dtypes():
+    # A missing value turns the integer keys of the other node into floats
+    other = pd.DataFrame({'column1': [3.0, None, 1.0], 'column3': [5, 6, 7]})
+
+    result = algorithms.RPC_get_data(other, merge_keys='column1',
+                                     bloom_filter=algorithms.RPC_bloom_filter(DATA, 'column1', 256, 3))
+
+    pd.testing.assert_frame_equal(other.iloc[[0, 2]], result)
+
+
+def test_key_sketches_overlap_with_different_dtypes():
+    data = pd.DataFrame({'column1': range(1000)})
+    sketches = [HyperLogLog.from_bytes(algorithms.RPC_key_sketch(df, 'column1'))
+                for df in (data, data.astype('float64'), data.astype('int32'))]
+
+    assert estimate_overlap(sketches)['intersection'] == pytest.approx(1000, rel=0.05)
+
+
+def test_bloom_filter_contains_keys():
+    result = algorithms.RPC_bloom_filter(DATA, 'column1', num_bits=64, num_hashes=2)
+
+    assert BloomFilter.from_bytes(result).contains(hash_keys(DATA, 'column1')).all()
+
+
+def test_get_data_returns_requested_columns_that_exist():
+    result = algorithms.RPC_get_data(DATA, columns=['column2', 'other', 'column2'])
+
+    pd.testing.assert_frame_equal(DATA[['column2']], result)
+
+
+def test_get_data_resolves_compact_encrypted_identifier():
+    data = pd.DataFrame({**{c: [1, 2] for c in encryption.UINT64_IDENTIFIER_COLUMNS}, 'value': [3, 4]})
+
+    result = algorithms.RPC_get_data(data, columns=[encryption.ENCRYPTED_IDENTIFIER])
+
+    assert list(result.columns) == encryption.UINT64_IDENTIFIER_COLUMNS
+
+
+@pytest.mark.parametrize('where, rows', [([('column1', '>', 1)], [1]),
+                                         ([('column1', '>=', 1), ('column2', '!=', 4)], [0]),
+                                         ([('column2', 'in', [2, 4]), ('other', '==', 0)], [0, 1]),
+                                         ([('column1', 'not in', [1])], [1])])
+def test_get_data_filters_records(where, rows):
+    result = algorithms.RPC_get_data(DATA, where=where, columns=['column1'])
+
+    pd.testing.assert_frame_equal(DATA.iloc[rows][['column1']], result)
+
+
+def test_filter_excludes_missing_values():
+    data = pd.DataFrame({'column1': [1, None, 3]})
+
+    result = algorithms.RPC_get_keys(data, 'column1', where=[('column1', '!=', 3)])
+
+    pd.testing.assert_frame_equal(data.iloc[[0]], result)
+
+
+def test_filter_rejects_unknown_operator():
+    with pytest.raises(ValueError):
+        algorithms.RPC_get_data(DATA, where=[('column1', 'like', 1)])
+
+
+def test_get_data_optimizes_dtypes_except_merge_keys():
+    result = algorithms.RPC_get_data(DATA, merge_keys='column1', optimize_dtypes=True)
+
+    assert result.dtypes.to_dict() == {'column1': 'int64', 'column2': 'int8'}
+    pd.testing.assert_frame_equal(DATA, result, check_dtype=False)
@@ -0,0 +1,95 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from v6_carrier_py import cache
+
+
+def test_key_depends_on_method_input_and_organizations():
+    input_ = {'method': 'get_data', 'kwargs': {'keys': pd.DataFrame({'id': [1, 2]}), 'merge_keys': 'id'}}
+    key = cache.make_key('get_data', input_, [1, 2])
+
+    # Order of organizations and dict keys does not matter
+    assert key == cache.make_key('get_data', dict(reversed(list(input_.items()))), [2, 1])
+    assert key != cache.make_key('count', input_, [1, 2])
+    assert key != cache.make_key('get_data', input_, [1, 3])
+    assert key != cache.make_key('get_data', {**input_, 'query': 'SELECT * WHERE {?s ?p ?o}'}, [1, 2])
+    changed = {'method': 'get_data', 'kwargs': {'keys': pd.DataFrame({'id': [1, 3]}), 'merge_keys': 'id'}}
+    assert key != cache.make_key('get_data', changed, [1, 2])
+
+
+def test_results_expire_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, 'time', lambda: now[0])
+    result_cache = cache.ResultCache(ttl=10)
+
+    result_cache.put('key', 'count', [1, 2])
+    now[0] += 5
+    assert result_cache.get('key') == [1, 2]
+    now[0] += 6
+    assert result_cache.get('key') is None
+
+
+def test_least_recently_used_results_are_evicted():
+    df = pd.DataFrame({'x': np.arange(100, dtype=np.int64)})
+    size = df.memory_usage(deep=True).sum()
+    result_cache = cache.ResultCache(ttl=None, max_bytes=2 * size)
+
+    result_cache.put('a', 'get_data', [df])
+    result_cache.put('b', 'get_data', [df])
+    result_cache.get('a')
+    result_cache.put('c', 'get_data', [df])
+
+    assert result_cache.get('a') is not None
+    assert result_cache.get('b') is None
+    assert result_cache.get('c') is not None
+
+
+@pytest.mark.parametrize('method, remaining', [('count', ['b']), (None, [])])
+def test_invalidate(tmp_path, method, remaining):
+    result_cache = cache.ResultCache(directory=str(tmp_path))
+    result_cache.put('a', 'count', [1])
+    result_cache.put('b', 'column_names', [['x']])
+
+    result_cache.invalidate(method)
+
+    assert [key for key in 'ab' if result_cache.get(key) is not None] == remaining
+    assert [key for key in 'ab' if cache.ResultCache(directory=str(tmp_path)).get(key) is not None] == remaining
+
+
+def test_disk_tier_stores_dataframes_as_parquet(tmp_path):
+    df = pd.DataFrame({'id': [1, 2, 3], 'name': ['a', 'b', 'c']})
+    cache.ResultCache(directory=str(tmp_path)).put('key', 'get_data', [df, 3])
+
+    result = cache.ResultCache(directory=str(tmp_path)).get('key')
+
+    assert (tmp_path / 'key' / '0.parquet').exists()
+    pd.testing.assert_frame_equal(df, result[0])
+    assert result[1] == 3
+
+
+def test_query_cache_evicts_least_recently_used_results(tmp_path):
+    df = pd.DataFrame({'x': np.arange(1000, dtype=np.int64)})
+    query_cache = cache.QueryCache(str(tmp_path), max_bytes=20000)
+
+    query_cache.put('a', df)
+    query_cache.put('b', df)
+    os.utime(tmp_path / 'a', (0, 0))
+    query_cache.put('c', df)
+
+    assert query_cache.get('a') is None
+    pd.testing.assert_frame_equal(df, query_cache.get('b'))
+    pd.testing.assert_frame_equal(df, query_cache.get('c'))
+
+
+def test_query_cache_results_expire(tmp_path, monkeypatch):
+    query_cache = cache.QueryCache(str(tmp_path), ttl=10)
+    query_cache.put('a', pd.DataFrame({'x': [1]}))
+
+    later = time.time() + 11
+    monkeypatch.setattr(cache.time, 'time', lambda: later)
+
+    assert query_cache.get('a') is None
@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+
+from v6_carrier_py import statistics
+from v6_carrier_py.dtypes import optimize_dtypes
+
+DATASET = 'tests/resources/joined_data.csv'
+
+
+def test_values_keep_their_value():
+    df = pd.DataFrame({'small': [1, -2, 100], 'large': [1, 2, 2 ** 40], 'halves': [0.5, np.nan, 2.0],
+                       'decimals': [1.1, 2.2, 3.3], 'flag': [True, False, True]})
+
+    result = optimize_dtypes(df)
+
+    assert result.dtypes.to_dict() == {'small': np.int8, 'large': np.int64, 'halves': np.float32,
+                                       'decimals': np.float64, 'flag': bool}
+    pd.testing.assert_frame_equal(df, result, check_dtype=False)
+
+
+def test_text_with_few_values_becomes_categorical():
+    df = pd.DataFrame({'sex': ['M', 'F', None, 'M'], 'name': ['a', 'b', 'c', 'd'], 'mixed': ['M', 1, 'M', 'M']})
+
+    result = optimize_dtypes(df)
+
+    assert result.dtypes.to_dict() == {'sex': 'category', 'name': object, 'mixed': object}
+    pd.testing.assert_frame_equal(df, result.astype(object))
+
+
+def test_excluded_and_input_columns_are_not_changed():
+    df = pd.DataFrame({'id': [1, 2], 'value': [3, 4]})
+
+    result = optimize_dtypes(df, exclude=['id'])
+
+    assert result.dtypes.to_dict() == {'id': np.int64, 'value': np.int8}
+    assert df.dtypes.to_dict() == {'id': np.int64, 'value': np.int64}
+
+
+def test_optimized_dataset_is_smaller_with_same_correlation():
+    df = pd.read_csv(DATASET)
+
+    result = optimize_dtypes(df)
+
+    assert result.memory_usage(deep=True).sum() < df.memory_usage(deep=True).sum()
+    for method in statistics.METHODS:
+        pd.testing.assert_frame_equal(statistics.correlation_matrix(df, method),
+                                      statistics.correlation_matrix(result, method), check_exact=False, atol=1e-10)
+
@@ -1,7 +1,13 @@
-import pytest
+from base64 import b64decode
+from io import StringIO
+from unittest.mock import patch
 
-from v6_carrier_py.encryption import salthash, encrypt_identifiers
+import numpy as np
 import pandas as pd
+import pytest
+
+from v6_carrier_py.encryption import salthash, salthash_many, encrypt_identifiers, encrypt_identifiers_chunked, \
+    encrypted_identifier_columns
 
 
 def test_salthash():
@@ -40,3 +46,126 @@ class TestEncryptIdentifiers:
         with pytest.raises(ValueError):
             encrypt_identifiers(test_df, self.test_salt,
                                 identifiers=self.test_identifiers)
+
+    def test_encrypt_identifiers_matches_salthash(self):
+        test_df = pd.DataFrame.from_dict({
+            'identifier1': ['a b', 'c'],
+            'identifier2': [1987, 2001],
+            'value1': [1.5, 2.5]
+        })
+        result_df = encrypt_identifiers(test_df.copy(), self.test_salt,
+                                        identifiers=self.test_identifiers)
+        target = [salthash(self.test_salt, 'ab1987'),
+                  salthash(self.test_salt, 'c2001')]
+        assert result_df['encrypted_identifier'].tolist() == target
+
+    def test_encrypt_identifiers_uses_common_row_dtype(self):
+        # Integer identifiers are formatted as floats when all columns are
+        # numeric, because that is how they appear in a row of the table
+        test_df = pd.DataFrame.from_dict({
+            'identifier1': [1, 2],
+            'identifier2': [3, 4],
+            'value1': [1.5, 2.5]
+        })
+        result_df = encrypt_identifiers(test_df, self.test_salt,
+                                        identifiers=self.test_identifiers)
+        assert result_df['encrypted_identifier'][0] == \
+            salthash(self.test_salt, '1.03.0')
+
+    @pytest.mark.parametrize('test_df', [
+        pd.DataFrame({'a': [1987, 2001], 'b': [3, 4], 'v': [1.5, 2.5]}),
+        pd.DataFrame({'a': [1987, 2001], 'b': [3.0, 4.5], 'v': ['x', 'y']}),
+        pd.DataFrame({'a': [True, False], 'b': [3, 4]}),
+        pd.DataFrame({'a': ['x', 'y'], 'b': [3, 4], 'v': [1.5, 2.5]}),
+    ])
+    def test_encrypt_identifiers_matches_row_wise_hashing(self, test_df):
+        # How identifiers were hashed before hashing was vectorized
+        target = test_df.apply(lambda row: salthash(self.test_salt, ''.join(
+            row[['a', 'b']].apply(str)).replace(' ', '')), axis=1)
+
+        result_df = encrypt_identifiers(test_df.copy(), self.test_salt,
+                                        identifiers=['a', 'b'])
+        assert result_df['encrypted_identifier'].tolist() == target.tolist()
+
+    def test_encrypt_identifiers_multiple_processes(self):
+        test_df = pd.DataFrame.from_dict({
+            'identifier1': [str(i) for i in range(10)],
+            'identifier2': ['x'] * 10,
+        })
+        with patch('v6_carrier_py.encryption.HASH_CHUNK_SIZE', 3):
+            result_df = encrypt_identifiers(test_df.copy(), self.test_salt,
+                                            identifiers=self.test_identifiers,
+                                            n_jobs=2)
+        target = encrypt_identifiers(test_df.copy(), self.test_salt,
+                                     identifiers=self.test_identifiers)
+        pd.testing.assert_frame_equal(target, result_df)
+
+    def test_encrypt_identifiers_chunked(self):
+        test_df = pd.DataFrame.from_dict({
+            'identifier1': [str(i) for i in range(10)],
+            'identifier2': ['x'] * 10,
+            'value1': range(10)
+        })
+        chunks = (test_df.iloc[i:i + 3].copy() for i in range(0, 10, 3))
+
+        result_chunks = list(encrypt_identifiers_chunked(
+            chunks, self.test_salt, identifiers=self.test_identifiers))
+
+        assert [len(chunk) for chunk in result_chunks] == [3, 3, 3, 1]
+        target = encrypt_identifiers(test_df.copy(), self.test_salt,
+                                     identifiers=self.test_identifiers)
+        pd.testing.assert_frame_equal(target, pd.concat(result_chunks))
+
+    def test_encrypt_identifiers_chunked_from_csv(self):
+        csv = StringIO(self.test_df.to_csv(index=False))
+        chunks = pd.read_csv(csv, chunksize=1)
+
+        result = pd.concat(encrypt_identifiers_chunked(
+            chunks, self.test_salt, identifiers=self.test_identifiers))
+
+        target = encrypt_identifiers(self.test_df.copy(), self.test_salt,
+                                     identifiers=self.test_identifiers)
+        pd.testing.assert_frame_equal(target, result)
+
+    def test_encrypt_identifiers_chunked_ignores_dtype_drift(self):
+        # The last chunk has a missing value, so `val` becomes a float. The
+        # identifiers of all chunks are formatted like those of the first
+        csv = 'id1,id2,val\n1,2,3\n4,5,6\n7,8,\n'
+        identifiers = ['id1', 'id2']
+
+        result = pd.concat(encrypt_identifiers_chunked(
+            pd.read_csv(StringIO(csv), chunksize=2), self.test_salt,
+            identifiers=identifiers))
+
+        assert result['encrypted_identifier'].tolist() == \
+            salthash_many(self.test_salt, ['12', '45', '78'])
+
+    def test_encrypt_identifiers_compact_formats(self):
+        base64 = encrypt_identifiers(self.test_df.copy(), self.test_salt,
+                                     identifiers=self.test_identifiers)
+        raw = encrypt_identifiers(self.test_df.copy(), self.test_salt,
+                                  identifiers=self.test_identifiers,
+                                  identifier_format='bytes')
+        compact = encrypt_identifiers(self.test_df.copy(), self.test_salt,
+                                      identifiers=self.test_identifiers,
+                                      identifier_format='uint64')
+
+        digests = [b64decode(h) for h in base64['encrypted_identifier']]
+        assert raw['encrypted_identifier'].tolist() == digests
+        columns = encrypted_identifier_columns('uint64')
+        assert (compact.dtypes[columns] == np.uint64).all()
+        assert compact[columns].iloc[0].tolist() == \
+            list(np.frombuffer(digests[0][:16], dtype='<u8'))
+
+    def test_encrypt_identifiers_unknown_format(self):
+        with pytest.raises(ValueError):
+            encrypt_identifiers(self.test_df.copy(), self.test_salt,
+                                identifiers=self.test_identifiers,
+                                identifier_format='hex')
+
+
+def test_salthash_many():
+    salt = 'a' * 128
+    strings = ['hash me please', 'me too', '']
+    result = salthash_many(salt, strings)
+    assert result == [salthash(salt, string) for string in strings]
@@ -0,0 +1,144 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from v6_carrier_py import join
+
+KEYS = ['birth_date', 'postcode']
+
+
+def create_node_data(seed, n_rows, column, n_people=50):
+    rng = np.random.RandomState(seed)
+    people = rng.choice(n_people, n_rows, replace=False)
+    return pd.DataFrame({
+        'birth_date': 1950 + people % 7,
+        'postcode': [f'{p // 7:04d}AB' for p in people],
+        column: rng.rand(n_rows)
+    })
+
+
+def test_merge_inner_matches_pairwise_merge():
+    df_list = [create_node_data(i, 40, f'column{i}') for i in range(3)]
+
+    result = join.merge_inner(df_list, on=KEYS)
+
+    pd.testing.assert_frame_equal(join.merge_pairwise(df_list, on=KEYS), result)
+
+
+def test_merge_inner_infers_keys():
+    df_list = [create_node_data(i, 40, f'column{i}') for i in range(3)]
+
+    assert join.join_keys(df_list) == KEYS
+    pd.testing.assert_frame_equal(join.merge_pairwise(df_list), join.merge_inner(df_list))
+
+
+def test_merge_inner_duplicate_keys():
+    left = pd.DataFrame({'key': ['A', 'B', 'A', 'C'], 'x': [0, 1, 2, 3]})
+    middle = pd.DataFrame({'key': ['B', 'A', 'A', 'D'], 'y': [10, 11, 12, 13]})
+    right = pd.DataFrame({'key': ['A', 'B', 'B'], 'z': [20, 21, 22]})
+    df_list = [left, middle, right]
+
+    result = join.merge_inner(df_list, on='key')
+    target = join.merge_pairwise(df_list, on='key')
+
+    assert len(result) == 6
+    pd.testing.assert_frame_equal(target.sort_values(['key', 'x', 'y', 'z']).reset_index(drop=True),
+                                  result.sort_values(['key', 'x', 'y', 'z']).reset_index(drop=True))
+
+
+def test_merge_inner_no_linking_records():
+    left = pd.DataFrame({'key': [1, 2], 'x': [0.5, 1.5]})
+    right = pd.DataFrame({'key': [3, 4], 'y': ['a', 'b']})
+
+    result = join.merge_inner([left, right], on='key')
+
+    assert list(result.columns) == ['key', 'x', 'y']
+    assert result.empty
+
+
+@pytest.mark.parametrize('df_list', [
+    # Inferred keys differ between join steps
+    [pd.DataFrame({'a': [1], 'b': [2]}), pd.DataFrame({'a': [1], 'c': [3]}), pd.DataFrame({'a': [1], 'c': [3]})],
+    # Missing values in the keys
+    [pd.DataFrame({'a': [1.0, np.nan], 'b': [2, 3]}), pd.DataFrame({'a': [1.0, np.nan], 'c': [3, 4]})],
+    # Missing values in the keys of a later dataset only
+    [pd.DataFrame({'a': [1.0, 2.0], 'b': [2, 3]}), pd.DataFrame({'a': [1.0, np.nan], 'c': [3, 4]})],
+    # Different key dtypes
+    [pd.DataFrame({'a': [1, 2], 'b': [2, 3]}), pd.DataFrame({'a': [1.0, 2.0], 'c': [3, 4]})],
+])
+def test_merge_inner_edge_cases_match_pairwise_merge(df_list):
+    pd.testing.assert_frame_equal(join.merge_pairwise(df_list), join.merge_inner(df_list))
+
+
+def test_merge_inner_overlapping_columns_raise():
+    left = pd.DataFrame({'key': [1], 'x': [0]})
+    right = pd.DataFrame({'key': [1], 'x': [1]})
+
+    with pytest.raises(ValueError):
+        join.merge_inner([left, right], on='key')
+
+
+@pytest.mark.parametrize('order', [[0, 1, 2], [2, 0, 1], [1, 2, 0]])
+def test_incremental_join_matches_merge_inner_in_any_order(order):
+    left = pd.DataFrame({'key': ['A', 'B', 'A', 'C'], 'x': [0, 1, 2, 3]})
+    middle = pd.DataFrame({'key': ['B', 'A', 'A', 'D'], 'y': [10, 11, 12, 13]})
+    right = pd.DataFrame({'key': ['A', 'B', 'B'], 'z': [20, 21, 22]})
+    df_list = [left, middle, right]
+
+    joiner = join.IncrementalJoin('key')
+    for i in order:
+        joiner.add(i, df_list[i])
+
+    assert joiner.size() == 6
+    pd.testing.assert_frame_equal(join.merge_inner(df_list, on='key'), joiner.result())
+
+
+@pytest.mark.parametrize('on', [None, 'a'])
+def test_incremental_join_falls_back_to_merge_inner(on):
+    # Missing values in the keys of a later dataset
+    df_list = [pd.DataFrame({'a': [1.0, 2.0], 'b': [2, 3]}), pd.DataFrame({'a': [1.0, np.nan], 'c': [3, 4]})]
+
+    joiner = join.IncrementalJoin(on)
+    for i, df in reversed(list(enumerate(df_list))):
+        joiner.add(i, df)
+
+    pd.testing.assert_frame_equal(join.merge_inner(df_list, on=on), joiner.result())
+
+
+def test_linking_keys_drop_duplicated_and_missing_keys():
+    left = pd.DataFrame({'key': ['A', 'B', 'C', 'D', 'E'], 'x': range(5)})
+    right = pd.DataFrame({'key': ['E', 'B', 'B', 'A', 'F', 'D'], 'y': range(6)})
+
+    result = join.linking_keys([left, right], 'key')
+
+    pd.testing.assert_frame_equal(pd.DataFrame({'key': ['A', 'D', 'E']}), result)
+
+
+def test_linking_keys_match_deduplicated_join():
+    df_list = [create_node_data(i, 25, f'column{i}', n_people=30) for i in range(3)]
+    df_list[1] = pd.concat([df_list[1], df_list[1].iloc[:5]])
+
+    joined = join.merge_pairwise(df_list, on=KEYS).drop_duplicates(subset=KEYS, keep=False)
+    result = join.linking_keys(df_list, KEYS)
+
+    pd.testing.assert_frame_equal(joined[KEYS].reset_index(drop=True), result)
+
+
+def test_select_keys_multiple_columns():
+    df = create_node_data(0, 10, 'column0')
+    keys = df[KEYS].iloc[[7, 2]]
+
+    mask = join.select_keys(df, keys)
+
+    assert mask.index.equals(df.index)
+    assert list(mask[mask].index) == [2, 7]
+
+
+def test_expected_size_matches_join():
+    left = pd.DataFrame({'key': ['A', 'B', 'A', 'C'], 'x': [0, 1, 2, 3]})
+    middle = pd.DataFrame({'key': ['B', 'A', 'A', 'D'], 'y': [10, 11, 12, 13]})
+    right = pd.DataFrame({'key': ['A', 'B', 'B'], 'z': [20, 21, 22]})
+    df_list = [left, middle, right]
+
+    assert join.expected_size(df_list, 'key') == len(join.merge_pairwise(df_list, 'key'))
+    assert join.expected_size([join.drop_duplicate_keys(df, 'key') for df in df_list], 'key') == 0
@@ -1,12 +1,22 @@
+import os
+import pickle
+import weakref
 from unittest.mock import MagicMock, patch
 
+import numpy as np
 import pandas as pd
 import pytest
 from sklearn import pipeline
 from sklearn.naive_bayes import GaussianNB
 from sklearn.preprocessing import StandardScaler
+from vantage6.common import bytes_to_base64s
 
-from v6_carrier_py import master
+from v6_carrier_py import algorithms, join, master, transfer
+from v6_carrier_py.encryption import encrypt_identifiers
+from v6_carrier_py.sketches import BloomFilter, HyperLogLog, hash_keys
+from v6_carrier_py.statistics import CorrelationStatistics
+from . import fake_client
+from .fake_client import FakeContainerClient, VirtualClock
 
 ID = 1
 TRIES = 1
@@ -51,12 +61,222 @@ def test_column_names_master_node_excluded_from_task():
 
 def test_column_names_raise_exception_when_task_timeout():
     client = create_base_mock_client()
+    client.get_task.side_effect = None
     client.get_task.return_value = {'complete': False}
 
     with pytest.raises(Exception):
         master.column_names(client, None, tries=TRIES)
 
 
+@pytest.fixture
+def clock(monkeypatch):
+    clock = VirtualClock()
+    monkeypatch.setattr(master, 'time', clock)
+    monkeypatch.setattr(fake_client, 'time', clock)
+    return clock
+
+
+def test_results_are_collected_soon_after_nodes_finish(clock):
+    client = FakeContainerClient({1: 0.1, 2: 0.2}, lambda organization_id, input_: [f'column{organization_id}'])
+
+    result = master.column_names(client, None)
+
+    # Polling once per second would take at least a second
+    assert clock.now < 0.6
+    assert result == {'column1', 'column2'}
+    # A few status checks while the nodes are working, and one request for the results
+    assert client.requests <= 6
+
+
+def test_results_time_out_after_deadline(clock):
+    client = FakeContainerClient({1: 0.1, 2: 10}, lambda organization_id, input_: [])
+
+    with pytest.raises(TimeoutError, match='column_names'):
+        master.column_names(client, None, timeout=0.3)
+
+    # The last status check is at the deadline
+    assert clock.now == pytest.approx(0.3)
+
+
+def test_results_are_passed_to_callback_as_they_arrive():
+    client = FakeContainerClient({1: 1, 2: 0.05, 3: 0.3}, lambda organization_id, input_: organization_id)
+    arrived = []
+
+    result = master._dispatch_tasks(client, None, 'count', on_result=lambda organization_id, r: arrived.append(r))
+
+    assert arrived == [2, 3, 1]
+    # The callback consumes the results, they are not kept
+    assert result is None
+
+
+def test_results_are_freed_after_callback():
+    # Organization 2 only responds once the table of organization 1 is no longer referenced
+    client = FakeContainerClient({1: 0, 2: float('inf')},
+                                 lambda organization_id, input_: pd.DataFrame({'x': range(1000)}))
+    freed = []
+
+    def on_result(organization_id, df):
+        if organization_id == 1:
+            weakref.finalize(df, freed.append, organization_id)
+            weakref.finalize(df, client.latencies.update, {2: 0})
+
+    master._dispatch_tasks(client, None, 'get_data', timeout=10, on_result=on_result)
+
+    assert freed == [1]
+
+
+def test_results_are_downloaded_once_while_waiting_for_other_organizations():
+    client = FakeContainerClient({1: 0, 2: 0.3}, lambda organization_id, input_: organization_id)
+
+    with patch('v6_carrier_py.master.MAX_POLL_INTERVAL', 0.02):
+        result = master._dispatch_tasks(client, None, 'count', on_result=lambda organization_id, r: None)
+
+    assert result is None
+    # Only the status is polled, every result is downloaded once
+    assert client.downloads == {1: 2}
+
+
+def test_quorum_continues_without_slow_organization():
+    # Organization 3 never responds, waiting for it would end in the timeout of the task
+    client = FakeContainerClient({1: 0, 2: 0, 3: float('inf')},
+                                 lambda organization_id, input_: [f'column{organization_id}'])
+
+    result = master.column_names(client, None, timeout=60, quorum={'min_organizations': 2, 'partial_timeout': 0.3})
+
+    assert result == {'column1', 'column2'}
+    assert client.downloads == {1: 2}
+
+
+@pytest.mark.parametrize('quorum', [
+    {'min_organizations': 3, 'partial_timeout': 0.2},
+    {'min_organizations': 1, 'partial_timeout': 0.2, 'allow_partial': False},
+])
+def test_quorum_not_met_reports_missing_organizations(quorum):
+    client = FakeContainerClient({1: 0, 2: 0, 3: float('inf')}, lambda organization_id, input_: [])
+
+    with pytest.raises(TimeoutError, match=r'Organizations \[3\] did not respond in time, 2 organizations did'):
+        master.column_names(client, None, timeout=60, quorum=quorum)
+
+
+def test_quorum_requires_enough_organizations():
+    client = FakeContainerClient({1: 0, 2: 0}, lambda organization_id, input_: [])
+
+    with pytest.raises(ValueError):
+        master.column_names(client, None, quorum=master.Quorum(min_organizations=3))
+
+
+def test_correlation_matrix_with_quorum_joins_responding_nodes():
+    node_data = {1: pd.DataFrame({'id': range(200), COLUMN1: range(200)}),
+                 2: pd.DataFrame({'id': range(200), COLUMN2: [i % 7 for i in range(200)]}),
+                 3: pd.DataFrame({'id': range(200), 'column3': [i % 5 for i in range(200)]})}
+    client = FakeContainerClient({1: 0, 2: float('inf'), 3: 0},
+                                 lambda organization_id, input_: node_data[organization_id])
+
+    result = master.correlation_matrix(client, None, 'id', timeout=60,
+                                       quorum={'min_organizations': 2, 'partial_timeout': 0.3})
+
+    target = join.merge_inner([node_data[1], node_data[3]], 'id').corr()
+    pd.testing.assert_frame_equal(target, result)
+
+
+def hold_tasks_until_in_flight(client, n_tasks):
+    """
+    Let the organizations of `client` only finish tasks once `n_tasks` tasks are in flight at the same time, or time
+    out otherwise.
+    """
+    latencies = dict(client.latencies)
+    client.latencies.update({organization_id: float('inf') for organization_id in latencies})
+    create_new_task = client.create_new_task
+
+    def create_and_release(*args, **kwargs):
+        task = create_new_task(*args, **kwargs)
+        if len(client.in_flight) >= n_tasks:
+            client.latencies.update(latencies)
+        return task
+
+    client.create_new_task = create_and_release
+
+
+@pytest.mark.parametrize('max_concurrent', [3, 1])
+def test_run_async_runs_bounded_number_of_tasks_concurrently(max_concurrent):
+    client = FakeContainerClient({1: 0, 2: 0}, lambda organization_id, input_: input_['method'])
+    hold_tasks_until_in_flight(client, max_concurrent)
+
+    with patch('v6_carrier_py.master.MAX_POLL_INTERVAL', 0.02):
+        result = master._run_async(*[master._dispatch_tasks_async(client, None, method, timeout=60)
+                                     for method in ['column_names', 'count', 'key_sketch']],
+                                   max_concurrent=max_concurrent)
+
+    assert client.max_in_flight == max_concurrent
+    assert result == [['column_names'] * 2, ['count'] * 2, ['key_sketch'] * 2]
+
+
+def test_correlation_matrix_prepares_join_concurrently():
+    node_data = {1: pd.DataFrame({'id': range(200), COLUMN1: range(200)}),
+                 2: pd.DataFrame({'id': range(50, 250), COLUMN2: [i % 7 for i in range(200)]})}
+
+    def run_algorithm(organization_id, input_):
+        method = getattr(algorithms, f'RPC_{input_["method"]}')
+        return method(node_data[organization_id], **input_.get('kwargs', {}))
+
+    client = FakeContainerClient({1: 0, 2: 0}, run_algorithm)
+    # Key sketches and counts are requested at the same time
+    hold_tasks_until_in_flight(client, 2)
+
+    with patch('v6_carrier_py.master.MAX_POLL_INTERVAL', 0.02):
+        result = master.correlation_matrix(client, None, 'id', check_overlap=True, bloom_filter_fpr=0.01, timeout=60)
+
+    assert client.max_in_flight == 2
+    assert sorted(client.tasks[i][1]['method'] for i in (1, 2)) == ['count', 'key_sketch']
+    target = join.merge_inner(list(node_data.values()), 'id').corr()
+    pd.testing.assert_frame_equal(target, result)
+
+
+def test_poll_interval_backs_off_exponentially():
+    with patch('v6_carrier_py.master.time.sleep') as sleep, pytest.raises(TimeoutError):
+        for _ in master._poll(tries=8, timeout=None, message=''):
+            pass
+
+    intervals = [c.args[0] for c in sleep.call_args_list]
+    assert len(intervals) == 7
+    assert all(master.POLL_INTERVAL * 2 ** i / 2 <= interval <= master.POLL_INTERVAL * 2 ** i
+               for i, interval in enumerate(intervals))
+
+
+def test_node_data_is_joined_while_other_nodes_are_working():
+    node_data = {1: pd.DataFrame({'id': range(200), COLUMN1: range(200)}),
+                 2: pd.DataFrame({'id': range(200), COLUMN2: [i % 7 for i in range(200)]}),
+                 3: pd.DataFrame({'id': range(200), 'column3': [i % 5 for i in range(200)]})}
+    # Organization 3 only finishes once the data of another organization has been joined
+    client = FakeContainerClient({1: 0, 2: 0, 3: float('inf')},
+                                 lambda organization_id, input_: node_data[organization_id])
+    events = []
+    add = join.IncrementalJoin.add
+
+    def record_add(joiner, dataset_id, df):
+        add(joiner, dataset_id, df)
+        events.append(('joined', dataset_id))
+        client.latencies[3] = 0
+
+    request = client.request
+
+    def record_request(endpoint, params=None):
+        response = request(endpoint, params)
+        if endpoint.startswith('result/'):
+            events.append(('received', response['organization']['id']))
+        return response
+
+    client.request = record_request
+    with patch('v6_carrier_py.master.join.IncrementalJoin.add', record_add):
+        result = master.correlation_matrix(client, None, 'id')
+
+    assert events.index(('joined', 1)) < events.index(('received', 3))
+    # The node data is downloaded once per organization
+    assert client.downloads == {1: 3}
+    target = join.merge_inner(list(node_data.values()), 'id').corr()
+    pd.testing.assert_frame_equal(target, result)
+
+
 def test_master_corr_matrix_is_combined_corr_matrix():
     df1 = pd.DataFrame({'id': [1], COLUMN1: [123]})
     df2 = pd.DataFrame({'id': [1], COLUMN2: [321]})
@@ -120,6 +340,132 @@ def test_correlation_matrix_dont_mix_up_partly_matching_keys():
         assert result[COLUMN1][COLUMN2] == 1
 
 
+def test_correlation_matrix_joins_on_compact_encrypted_identifier():
+    identifiers = pd.DataFrame({'name': [f'person{i}' for i in range(5)]})
+    salt = 'a' * 128
+    df1 = encrypt_identifiers(identifiers.assign(**{COLUMN1: range(5)}), salt, ['name'], identifier_format='uint64')
+    df2 = encrypt_identifiers(identifiers.assign(**{COLUMN2: [0, 2, 1, 3, 5]}), salt, ['name'],
+                              identifier_format='uint64')
+
+    client = create_basic_data_client(df1, df2.iloc[::-1])
+
+    with patch('v6_carrier_py.master.MIN_RECORDS', 0):
+        result = master.correlation_matrix(client, None, merge_keys='encrypted_identifier', tries=TRIES)
+
+    target = pd.DataFrame({COLUMN1: range(5), COLUMN2: [0, 2, 1, 3, 5]}).corr()
+    pd.testing.assert_frame_equal(target, result.loc[[COLUMN1, COLUMN2], [COLUMN1, COLUMN2]])
+
+
+def test_correlation_matrix_two_phase_only_retrieves_linking_records():
+    df1 = pd.DataFrame({'id': [1, 2, 3, 4, 5], COLUMN1: [1, 2, 3, 4, 5]})
+    df2 = pd.DataFrame({'id': [2, 3, 3, 4, 5, 6], COLUMN2: [2, 3, 3, 5, 4, 6]})
+    linked = [2, 4, 5]
+
+    client = create_base_mock_client()
+    client.get_results.side_effect = [
+        [df1[['id']], df2[['id']]],
+        [df1[df1['id'].isin(linked)], df2[df2['id'].isin(linked)]],
+    ]
+
+    with patch('v6_carrier_py.master.MIN_RECORDS', 0):
+        result = master.correlation_matrix(client, None, merge_keys='id', tries=TRIES, two_phase=True)
+
+    keys_call, data_call = client.create_new_task.call_args_list
+    assert keys_call[1]['input_'] == {'method': 'get_keys', 'kwargs': {'merge_keys': 'id'}}
+    assert data_call[1]['input_']['method'] == 'get_data'
+    assert data_call[1]['input_']['kwargs']['keys']['id'].tolist() == linked
+
+    target = pd.DataFrame({'id': linked, COLUMN1: [2, 4, 5], COLUMN2: [2, 5, 4]}).corr()
+    pd.testing.assert_frame_equal(target, result)
+
+
+def test_correlation_matrix_two_phase_requires_merge_keys():
+    client = create_base_mock_client()
+
+    with pytest.raises(ValueError):
+        master.correlation_matrix(client, None, tries=TRIES, two_phase=True)
+
+
+def test_correlation_matrix_bloom_filter_prefilters_node_data():
+    df1 = pd.DataFrame({'id': [1, 2, 3], COLUMN1: [1, 2, 4]})
+    df2 = pd.DataFrame({'id': [2, 3, 4], COLUMN2: [2, 3, 4]})
+
+    def create_filter(df, num_bits, num_hashes):
+        bloom_filter = BloomFilter(num_bits, num_hashes)
+        bloom_filter.add(hash_keys(df, 'id'))
+        return bloom_filter.to_bytes()
+
+    size = BloomFilter.for_capacity(3, 0.01)
+    client = create_base_mock_client()
+    client.get_results.side_effect = [
+        [3, 3],
+        [create_filter(df1, size.num_bits, size.num_hashes), create_filter(df2, size.num_bits, size.num_hashes)],
+        [df1.iloc[1:], df2.iloc[:2]],
+    ]
+
+    with patch('v6_carrier_py.master.MIN_RECORDS', 0):
+        result = master.correlation_matrix(client, None, merge_keys='id', tries=TRIES, bloom_filter_fpr=0.01)
+
+    methods = [c[1]['input_']['method'] for c in client.create_new_task.call_args_list]
+    assert methods == ['count', 'bloom_filter', 'get_data']
+
+    combined = BloomFilter.from_bytes(client.create_new_task.call_args[1]['input_']['kwargs']['bloom_filter'])
+    assert combined.contains(hash_keys(pd.DataFrame({'id': [2, 3]}), 'id')).all()
+
+    target = pd.DataFrame({'id': [2, 3], COLUMN1: [2, 4], COLUMN2: [2, 3]}).corr()
+    pd.testing.assert_frame_equal(target, result)
+
+
+def create_key_sketch(keys):
+    sketch = HyperLogLog()
+    sketch.add(hash_keys(pd.DataFrame({'id': keys}), 'id'))
+    return sketch.to_bytes()
+
+
+def test_estimate_overlap_combines_key_sketches():
+    client = create_basic_data_client(create_key_sketch(range(1000)), create_key_sketch(range(500, 2000)))
+
+    result = master.estimate_overlap(client, None, 'id', tries=TRIES)
+
+    client.create_new_task.assert_called_once_with(
+        input_={'method': 'key_sketch', 'kwargs': {'merge_keys': 'id', 'precision': 14}}, organization_ids=[])
+    assert result['intersection'] == pytest.approx(500, rel=0.1)
+
+
+def test_correlation_matrix_check_overlap_fails_before_retrieving_data():
+    client = create_basic_data_client(create_key_sketch(range(1000)), create_key_sketch(range(1000, 1500)))
+
+    with pytest.raises(ValueError):
+        master.correlation_matrix(client, None, merge_keys='id', tries=TRIES, check_overlap=True)
+
+    client.create_new_task.assert_called_once()
+
+
+def test_correlation_matrix_drops_duplicate_keys_before_joining():
+    # Every key is duplicated at both nodes, which would produce 4 records per key in the join
+    df1 = pd.DataFrame({'id': [1, 1, 2, 3, 4], COLUMN1: [1, 1, 2, 3, 5]})
+    df2 = pd.DataFrame({'id': [1, 1, 2, 3, 4], COLUMN2: [1, 1, 2, 4, 3]})
+    client = create_basic_data_client(df1, df2)
+
+    with patch('v6_carrier_py.master.MIN_RECORDS', 0), \
+            patch('v6_carrier_py.master._merge_multiple_dfs', wraps=master._merge_multiple_dfs) as merge:
+        result = master.correlation_matrix(client, None, merge_keys='id', tries=TRIES)
+
+    assert [len(df) for df in merge.call_args[0][0].frames.values()] == [3, 3]
+    target = pd.DataFrame({'id': [2, 3, 4], COLUMN1: [2, 3, 5], COLUMN2: [2, 4, 3]}).corr()
+    pd.testing.assert_frame_equal(target, result)
+
+
+def test_correlation_matrix_fails_when_join_exceeds_memory_budget():
+    df1 = pd.DataFrame({'key': [1] * 100, COLUMN1: range(100)})
+    df2 = pd.DataFrame({'key': [1] * 100, COLUMN2: range(100)})
+    client = create_basic_data_client(df1, df2)
+
+    with pytest.raises(ValueError, match='memory budget'):
+        # Keys are inferred, so duplicates are not dropped before joining
+        master.correlation_matrix(client, None, tries=TRIES, memory_budget=10000)
+
+
 def test_train_model_accepts_dataset():
     dataset = load_dataset()
 
@@ -133,6 +479,44 @@ def test_train_model_accepts_dataset():
         result = master.fit_pipeline(client, None, pipe, FEATURES, TARGET, IDENTIFIER_KEYS)
 
         assert result is not None
+        rpc_kwargs = client.create_new_task.call_args[1]['input_']['kwargs']
+        assert rpc_kwargs['columns'] == IDENTIFIER_KEYS + FEATURES + [TARGET]
+
+
+def test_correlation_matrix_two_phase_pushes_down_columns_and_predicates():
+    node_data = {1: pd.DataFrame({'id': range(200), COLUMN1: range(200), 'unused': 0}),
+                 2: pd.DataFrame({'id': range(200), COLUMN2: [i % 7 for i in range(200)]})}
+    where = [(COLUMN1, '<', 150)]
+
+    def run_algorithm(organization_id, input_):
+        return getattr(algorithms, f'RPC_{input_["method"]}')(node_data[organization_id], **input_.get('kwargs', {}))
+
+    client = FakeContainerClient({1: 0, 2: 0}, run_algorithm)
+
+    result = master.correlation_matrix(client, None, 'id', two_phase=True, columns=[COLUMN1, COLUMN2], where=where)
+
+    inputs = {input_['method']: input_ for _, input_, _ in client.tasks.values()}
+    keys_input, data_input = inputs['get_keys'], inputs['get_data']
+    assert keys_input['kwargs']['where'] == where
+    assert data_input['kwargs']['columns'] == ['id', COLUMN1, COLUMN2]
+    target = join.merge_inner([node_data[1].iloc[:150, :2], node_data[2]], 'id').corr()
+    pd.testing.assert_frame_equal(target, result)
+
+
+def test_predicates_on_columns_that_no_node_has_are_rejected():
+    node_data = {1: pd.DataFrame({'id': range(200), COLUMN1: range(200)}),
+                 2: pd.DataFrame({'id': range(200), COLUMN2: range(200)})}
+
+    def run_algorithm(organization_id, input_):
+        return getattr(algorithms, f'RPC_{input_["method"]}')(node_data[organization_id], **input_.get('kwargs', {}))
+
+    client = FakeContainerClient({1: 0, 2: 0}, run_algorithm)
+
+    with pytest.raises(ValueError, match=r"\['Colum1'\]"):
+        master.correlation_matrix(client, None, 'id', where=[(COLUMN1, '<', 150), ('Colum1', '<', 150)])
+
+    # No data was retrieved
+    assert [input_['method'] for _, input_, _ in client.tasks.values()] == ['column_names']
 
 
 def test_corr_matrix_blocks_with_few_records():
@@ -146,6 +530,34 @@ def test_corr_matrix_blocks_with_few_records():
         master.correlation_matrix(client, None, tries=TRIES)
 
 
+def test_horizontal_correlation_matrix_combines_node_statistics():
+    df = load_dataset()[FEATURES]
+    parts = [df.iloc[:7], df.iloc[7:14], df.iloc[14:]]
+    client = create_basic_data_client(*[CorrelationStatistics.from_data(part).to_dict() for part in parts])
+
+    with patch('v6_carrier_py.master.MIN_RECORDS', 0):
+        result = master.correlation_matrix(client, None, horizontal=True, tries=TRIES)
+
+    client.create_new_task.assert_called_once_with(input_={'method': 'correlation_statistics'},
+                                                   organization_ids=[])
+    pd.testing.assert_frame_equal(df.corr(), result, check_exact=False, atol=1e-10)
+
+
+def test_horizontal_correlation_matrix_blocks_with_few_records():
+    statistics = CorrelationStatistics.from_data(pd.DataFrame({'a': [1, 2], 'b': [2, 1]}))
+    client = create_basic_data_client(statistics.to_dict())
+
+    with pytest.raises(ValueError):
+        master.correlation_matrix(client, None, horizontal=True, tries=TRIES)
+
+
+def test_horizontal_correlation_matrix_only_supports_pearson():
+    client = create_base_mock_client()
+
+    with pytest.raises(ValueError):
+        master.correlation_matrix(client, None, horizontal=True, method='spearman', tries=TRIES)
+
+
 def create_basic_data_client(*node_data):
     client = create_base_mock_client()
 
@@ -159,8 +571,231 @@ def create_base_mock_client():
     client.get_task.return_value = {'complete': True}
     client.get_results.return_value = [COLUMN1, COLUMN2]
 
-    return client()
+    client = client()
+
+    # Results of the organizations one by one are derived from the results of the complete task, which are
+    # retrieved once per task
+    task_results = []
+
+    def create_new_task(*args, **kwargs):
+        task_results.clear()
+        return MOCK_TASK
+
+    def results():
+        if not task_results:
+            task_results.extend({'id': i, 'organization': {'id': i}, 'finished_at': 'now',
+                                 'result': bytes_to_base64s(pickle.dumps(result))}
+                                for i, result in enumerate(client.get_results(task_id=ID)))
+        return task_results
+
+    def request(endpoint, params=None):
+        if endpoint.startswith('result/'):
+            return results()[int(endpoint.split('/')[1])]
+        return results()
+
+    client.get_task.side_effect = lambda task_id: {'complete': True, 'results': [{'id': r['id']} for r in results()]}
+    client.create_new_task.side_effect = create_new_task
+    client.request.side_effect = request
+    return client
 
 
 def load_dataset(path=DATASET):
     return pd.read_csv(path)
+
+
+def test_cached_results_are_reused(monkeypatch):
+    monkeypatch.setattr(master, '_result_cache', None)
+    client = FakeContainerClient({1: 0, 2: 0}, lambda organization_id, input_: [f'column{organization_id}'])
+
+    first = master.column_names(client, None, use_cache=True)
+    received = []
+    second = master._dispatch_tasks(client, None, 'column_names', use_cache=True,
+                                    on_result=lambda organization_id, result: received.append(organization_id))
+
+    assert first == {'column1', 'column2'}
+    assert second is None
+    assert received == [1, 2]
+    assert len(client.tasks) == 1
+
+    master.invalidate_cache(client, None, method='column_names')
+    master.column_names(client, None, use_cache=True)
+    assert len(client.tasks) == 2
+
+
+@pytest.mark.parametrize('configure', ['environment', 'input'])
+def test_cached_results_are_reused_by_later_master_containers(monkeypatch, tmp_path, configure):
+    kwargs = {'cache_dir': str(tmp_path)} if configure == 'input' else {}
+    if configure == 'environment':
+        monkeypatch.setenv(master.RESULT_CACHE_DIR, str(tmp_path))
+    client = FakeContainerClient({1: 0, 2: 0}, lambda organization_id, input_: [f'column{organization_id}'])
+
+    # Every master task runs in a new container, which starts without results in memory
+    for _ in range(2):
+        monkeypatch.setattr(master, '_result_cache', None)
+        assert master.column_names(client, None, use_cache=True, **kwargs) == {'column1', 'column2'}
+    assert len(client.tasks) == 1
+
+    monkeypatch.setattr(master, '_result_cache', None)
+    master.invalidate_cache(client, None, method='column_names', **kwargs)
+    monkeypatch.setattr(master, '_result_cache', None)
+    master.column_names(client, None, use_cache=True, **kwargs)
+    assert len(client.tasks) == 2
+
+
+def test_partial_results_are_not_cached(monkeypatch):
+    monkeypatch.setattr(master, '_result_cache', None)
+    client = FakeContainerClient({1: 0, 2: 10}, lambda organization_id, input_: [f'column{organization_id}'])
+    quorum = {'min_organizations': 1, 'partial_timeout': 0.1}
+
+    master.column_names(client, None, use_cache=True, quorum=quorum)
+    master.column_names(client, None, use_cache=True, quorum=quorum)
+
+    assert len(client.tasks) == 2
+
+
+@pytest.mark.parametrize('compression', [None, 'lz4'])
+def test_correlation_matrix_reads_arrow_node_data(monkeypatch, tmp_path, compression):
+    monkeypatch.setattr(master, 'RESULT_DIR', str(tmp_path))
+    node_data = {1: pd.DataFrame({'id': range(200), COLUMN1: range(200)}),
+                 2: pd.DataFrame({'id': range(200), COLUMN2: [i % 7 for i in range(200)]})}
+    client = FakeContainerClient({1: 0, 2: 0}, lambda organization_id, input_: node_data[organization_id])
+
+    result = master.correlation_matrix(client, None, 'id', output_format='arrow', compression=compression)
+
+    _, input_, _ = client.tasks[1]
+    assert input_['output_format'] == 'arrow' and input_.get('compression') == compression
+    pd.testing.assert_frame_equal(join.merge_inner(list(node_data.values()), 'id').corr(), result)
+
+
+def test_combine_reads_node_data_in_batches(monkeypatch):
+    monkeypatch.setattr(master, 'MIN_RECORDS', 0)
+    node_data = {1: pd.DataFrame({'id': range(200), COLUMN1: range(200)}),
+                 2: pd.DataFrame({'id': [i % 150 for i in range(200)], COLUMN2: [i % 7 for i in range(200)]})}
+    client = FakeContainerClient({1: 0, 2: 0}, lambda organization_id, input_: node_data[organization_id])
+    read_columns = []
+    iter_frames = transfer.RecordBatches.iter_frames
+
+    def record_iter_frames(batches, columns=None):
+        for batch in iter_frames(batches, columns):
+            read_columns.append(list(batch.columns))
+            yield batch
+
+    with patch('v6_carrier_py.transfer.RecordBatches.iter_frames', record_iter_frames):
+        result = master._combine_all_node_data(client, None, 'id', batch_rows=32)
+
+    _, input_, _ = client.tasks[1]
+    assert (input_['batch_rows'], input_['compression']) == (32, 'zstd')
+    # Only the key columns are read first, then every batch with all columns
+    assert read_columns == [['id']] * 7 * 2 + [['id', COLUMN1]] * 7 + [['id', COLUMN2]] * 7
+    target = master._combine_all_node_data(FakeContainerClient({1: 0, 2: 0}, client.respond), None, 'id')
+    pd.testing.assert_frame_equal(target.reset_index(drop=True), result.reset_index(drop=True))
+
+
+def test_correlation_matrix_with_optimized_dtypes_is_unchanged():
+    dataset = load_dataset()
+    node_data = {1: dataset[IDENTIFIER_KEYS + FEATURES[:10]], 2: dataset[IDENTIFIER_KEYS + FEATURES[10:] + [TARGET]]}
+
+    def run_algorithm(organization_id, input_):
+        return algorithms.RPC_get_data(node_data[organization_id], **input_.get('kwargs', {}))
+
+    with patch('v6_carrier_py.master.MIN_RECORDS', 0):
+        target = master.correlation_matrix(FakeContainerClient({1: 0, 2: 0}, run_algorithm), None, IDENTIFIER_KEYS)
+        client = FakeContainerClient({1: 0, 2: 0}, run_algorithm)
+        result = master.correlation_matrix(client, None, IDENTIFIER_KEYS, optimize_dtypes=True)
+
+    assert client.tasks[1][1]['kwargs'] == {'optimize_dtypes': True, 'merge_keys': IDENTIFIER_KEYS}
+    pd.testing.assert_frame_equal(target, result, check_exact=False, atol=1e-10)
+
+
+OPTIMIZABLE_NODE_DATA = {1: pd.DataFrame({'id': range(200), COLUMN1: [100 + i % 20 for i in range(200)]}),
+                         2: pd.DataFrame({'id': range(200), COLUMN2: [i / 2 for i in range(200)]})}
+
+
+def run_get_data(organization_id, input_):
+    return algorithms.RPC_get_data(OPTIMIZABLE_NODE_DATA[organization_id], **input_.get('kwargs', {}))
+
+
+def test_optimized_dtypes_are_kept_in_joined_table(monkeypatch):
+    monkeypatch.setattr(master, 'MIN_RECORDS', 0)
+
+    result = master._combine_all_node_data(FakeContainerClient({1: 0, 2: 0}, run_get_data), None, 'id',
+                                           optimize_dtypes=True)
+
+    assert result.dtypes.to_dict() == {'id': np.int64, COLUMN1: np.int8, COLUMN2: np.float32}
+    pd.testing.assert_frame_equal(OPTIMIZABLE_NODE_DATA[1].merge(OPTIMIZABLE_NODE_DATA[2]), result, check_dtype=False)
+
+
+@pytest.mark.parametrize('out_of_core', [False, True])
+def test_fit_pipeline_trains_on_64_bit_values_of_optimized_dtypes(monkeypatch, out_of_core):
+    monkeypatch.setattr(master, 'MIN_RECORDS', 0)
+    fitted = []
+
+    class RecordingPipeline(pipeline.Pipeline):
+        def fit(self, X, y=None, **fit_params):
+            fitted.append((X, y))
+            return super().fit(X, y, **fit_params)
+
+    pipe = RecordingPipeline([('scaler', StandardScaler()), ('model', GaussianNB())])
+    with patch('v6_carrier_py.master.pipeline.reconstruct_pipeline', return_value=pipe):
+        master.fit_pipeline(FakeContainerClient({1: 0, 2: 0}, run_get_data), None, pipe, [COLUMN1], COLUMN2, 'id',
+                            optimize_dtypes=True, out_of_core=out_of_core, n_partitions=3)
+
+    X, y = fitted[0]
+    assert X.dtype == y.dtype == np.float64
+    # Squaring int8 values of 100 and more would overflow
+    assert set((X[:, 0] ** 2).tolist()) == {float(v ** 2) for v in range(100, 120)}
+
+
+@pytest.mark.parametrize('batch_rows', [None, 8])
+def test_out_of_core_correlation_matrix_equals_in_memory(monkeypatch, tmp_path, batch_rows):
+    monkeypatch.setattr(master, 'MIN_RECORDS', 0)
+    monkeypatch.setattr(master, 'SPILL_DIR', str(tmp_path))
+    dataset = load_dataset()
+    node_data = {1: dataset[IDENTIFIER_KEYS + FEATURES[:10]], 2: dataset[IDENTIFIER_KEYS + FEATURES[10:] + [TARGET]]}
+    client = FakeContainerClient({1: 0, 2: 0}, lambda organization_id, input_: node_data[organization_id])
+
+    target = master.correlation_matrix(client, None, IDENTIFIER_KEYS)
+    result = master.correlation_matrix(client, None, IDENTIFIER_KEYS, out_of_core=True, n_partitions=4,
+                                       batch_rows=batch_rows)
+
+    pd.testing.assert_frame_equal(target, result, check_exact=False, atol=1e-10)
+    # The partitions are removed
+    assert os.listdir(tmp_path) == []
+
+
+def test_out_of_core_correlation_matrix_only_supports_pearson():
+    with pytest.raises(ValueError):
+        master.correlation_matrix(create_base_mock_client(), None, 'id', out_of_core=True, method='spearman')
+
+
+def test_out_of_core_correlation_matrix_blocks_with_few_records(tmp_path):
+    client = create_basic_data_client(pd.DataFrame({'id': [1], COLUMN1: [123]}),
+                                      pd.DataFrame({'id': [1], COLUMN2: [321]}))
+
+    with pytest.raises(ValueError):
+        master.correlation_matrix(client, None, 'id', out_of_core=True, spill_dir=str(tmp_path), tries=TRIES)
+    assert os.listdir(tmp_path) == []
+
+
+def test_out_of_core_fit_pipeline_uses_joined_chunks(monkeypatch):
+    monkeypatch.setattr(master, 'MIN_RECORDS', 0)
+    dataset = load_dataset()
+    node_data = {1: dataset[IDENTIFIER_KEYS + FEATURES], 2: dataset[IDENTIFIER_KEYS + [TARGET]]}
+    client = FakeContainerClient({1: 0, 2: 0}, lambda organization_id, input_: node_data[organization_id])
+    fitted = []
+
+    class RecordingPipeline(pipeline.Pipeline):
+        def fit(self, X, y=None, **fit_params):
+            fitted.append((X, y))
+            return super().fit(X, y, **fit_params)
+
+    pipe = RecordingPipeline([('scaler', StandardScaler()), ('model', GaussianNB())])
+    with patch('v6_carrier_py.master.pipeline.reconstruct_pipeline', return_value=pipe):
+        result = master.fit_pipeline(client, None, pipe, FEATURES, TARGET, IDENTIFIER_KEYS, out_of_core=True,
+                                     n_partitions=3)
+
+    assert result is not None
+    X, y = fitted[0]
+    assert X.shape[1] == len(FEATURES)
+    # The training set is a split of all joined records
+    assert len(X) == len(y) > len(dataset) // 2
@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from v6_carrier_py.sketches import BloomFilter, HyperLogLog, estimate_overlap, hash_keys
+
+N_KEYS = 10000
+
+
+def create_keys(start, stop):
+    return pd.DataFrame({'key': [f'person{i}' for i in range(start, stop)], 'year': 1950})
+
+
+def test_hash_keys_is_deterministic_per_key():
+    df1 = create_keys(0, 10)
+    df2 = create_keys(5, 15)
+
+    np.testing.assert_array_equal(hash_keys(df1, ['key', 'year'])[5:], hash_keys(df2, ['key', 'year'])[:5])
+
+
+@pytest.mark.parametrize('other', [
+    pd.Series([1987.0, 2001.0, -3.0, 0.0]),
+    pd.Series([1987, 2001, -3, 0], dtype='int16'),
+    pd.Series([1987, 2001, -3, 0], dtype='Int64'),
+    pd.Categorical([1987, 2001, -3, -0.0]),
+])
+def test_hash_keys_ignores_key_dtypes(other):
+    keys = pd.DataFrame({'key': [1987, 2001, -3, 0], 'name': ['a', 'b', 'c', 'd']})
+
+    np.testing.assert_array_equal(hash_keys(keys, ['key', 'name']),
+                                  hash_keys(keys.assign(key=other, name=keys['name'].astype('category')),
+                                            ['key', 'name']))
+
+
+def test_bloom_filter_has_no_false_negatives():
+    hashes = hash_keys(create_keys(0, N_KEYS), 'key')
+    bloom_filter = BloomFilter.for_capacity(N_KEYS, 0.01)
+    bloom_filter.add(hashes)
+
+    assert bloom_filter.contains(hashes).all()
+
+
+def test_bloom_filter_false_positive_rate():
+    bloom_filter = BloomFilter.for_capacity(N_KEYS, 0.01)
+    bloom_filter.add(hash_keys(create_keys(0, N_KEYS), 'key'))
+
+    false_positives = bloom_filter.contains(hash_keys(create_keys(N_KEYS, 2 * N_KEYS), 'key'))
+
+    assert false_positives.mean() < 0.02
+
+
+def test_combined_bloom_filter_contains_intersection():
+    filter1 = BloomFilter.for_capacity(N_KEYS, 0.01)
+    filter1.add(hash_keys(create_keys(0, N_KEYS), 'key'))
+    filter2 = BloomFilter.for_capacity(N_KEYS, 0.01)
+    filter2.add(hash_keys(create_keys(N_KEYS // 2, N_KEYS * 3 // 2), 'key'))
+
+    combined = BloomFilter.from_bytes((filter1 & filter2).to_bytes())
+
+    found = combined.contains(hash_keys(create_keys(0, 2 * N_KEYS), 'key'))
+    assert found[N_KEYS // 2:N_KEYS].all()
+    assert found[:N_KEYS // 2].mean() < 0.05
+    assert found[N_KEYS:].mean() < 0.05
+
+
+def test_bloom_filters_of_different_size_cannot_be_combined():
+    with pytest.raises(ValueError):
+        BloomFilter(64, 2) & BloomFilter(128, 2)
+
+
+def create_sketch(start, stop):
+    sketch = HyperLogLog()
+    sketch.add(hash_keys(create_keys(start, stop), 'key'))
+    return sketch
+
+
+@pytest.mark.parametrize('n_keys', [10, 1000, 100000])
+def test_hyperloglog_cardinality(n_keys):
+    sketch = HyperLogLog.from_bytes(create_sketch(0, n_keys).to_bytes())
+
+    assert sketch.cardinality() == pytest.approx(n_keys, rel=4 * sketch.relative_error)
+
+
+def test_estimate_overlap():
+    sketches = [create_sketch(0, 10000), create_sketch(5000, 15000), create_sketch(8000, 20000)]
+
+    overlap = estimate_overlap(sketches)
+
+    assert overlap['cardinality'] == pytest.approx([10000, 10000, 12000], rel=0.05)
+    assert overlap['pairwise_intersection'][0][1] == pytest.approx(5000, rel=0.1)
+    assert overlap['pairwise_intersection'][1][2] == overlap['pairwise_intersection'][2][1]
+    assert overlap['intersection'] == pytest.approx(2000, rel=0.25)
+    assert overlap['intersection_upper_bound'] > 2000
+
+
+def test_estimate_overlap_upper_bound_of_disjoint_small_datasets():
+    overlap = estimate_overlap([create_sketch(0, 50), create_sketch(50, 1000)])
+
+    assert overlap['intersection_upper_bound'] < 100
@@ -0,0 +1,175 @@
+import io
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from v6_carrier_py import sparql
+from .sparql_server import SparqlServer, XSD, paginated, to_tsv
+
+QUERY = """
+PREFIX ex: <http://example.org/>  # example data
+SELECT ?id ?value WHERE { ?s ex:id ?id ; ex:value ?value }  # all records
+"""
+
+
+def test_query_maps_xsd_datatypes_to_compact_dtypes(monkeypatch):
+    monkeypatch.setattr(sparql, 'SAMPLE_BYTES', 1000)
+    n_rows = 100
+    df = pd.DataFrame({'id': range(n_rows),
+                       'height': [170.5 + i for i in range(n_rows)],
+                       'sex': ['M', 'F'] * (n_rows // 2),
+                       'name': [f'person "{i}"\t' for i in range(n_rows)],
+                       'birth_date': pd.date_range('1950-01-01', periods=n_rows),
+                       'smoker': [True, False] * (n_rows // 2)})
+    tsv = to_tsv(df).replace(f'"0"^^<{XSD}integer>', '0').replace(f'"1"^^<{XSD}integer>', '1')
+
+    with SparqlServer(lambda query: tsv) as server:
+        result = sparql.query(server.endpoint, 'SELECT * WHERE {?s ?p ?o}', chunk_bytes=2000)
+
+    assert result.dtypes.to_dict() == {'id': 'int32', 'height': 'float32', 'sex': 'category', 'name': 'object',
+                                       'birth_date': 'datetime64[ns]', 'smoker': 'bool'}
+    pd.testing.assert_frame_equal(df, result, check_dtype=False, check_categorical=False)
+
+
+def test_read_tsv_handles_unbound_values_and_iris():
+    tsv = (f'?person\t?age\t?weight\n'
+           f'<http://example.org/1>\t"31"^^<{XSD}int>\t\n'
+           f'<http://example.org/2>\t\t72.5\n'
+           f'_:b0\t"45"^^<{XSD}int>\t"80"^^<{XSD}decimal>\n')
+
+    result = sparql.read_tsv(io.BytesIO(tsv.encode()), chunk_bytes=80)
+
+    assert list(result['person']) == ['http://example.org/1', 'http://example.org/2', '_:b0']
+    assert result['age'].dtype == 'float64'
+    assert result['age'].isna().tolist() == [False, True, False]
+    assert result['weight'].dtype == 'float32'
+    assert result['weight'].tolist()[1:] == [72.5, 80]
+
+
+@pytest.mark.parametrize('sample_bytes', [sparql.SAMPLE_BYTES, 40])
+def test_read_tsv_keeps_decimals_that_float32_can_not_hold(monkeypatch, sample_bytes):
+    monkeypatch.setattr(sparql, 'SAMPLE_BYTES', sample_bytes)
+    rows = [(f'"{i}.5"^^<{XSD}decimal>', f'"{i}.1"^^<{XSD}decimal>') for i in range(10)]
+    rows[7] = (f'"7.5"^^<{XSD}decimal>', f'"1234567.89"^^<{XSD}decimal>')
+    tsv = '?half\t?price\n' + ''.join(f'{half}\t{price}\n' for half, price in rows)
+
+    result = sparql.read_tsv(io.BytesIO(tsv.encode()), chunk_bytes=80)
+
+    assert result.dtypes.to_dict() == {'half': 'float32', 'price': 'float64'}
+    assert result['half'].tolist() == [i + 0.5 for i in range(10)]
+    assert result['price'].tolist() == [1234567.89 if i == 7 else float(f'{i}.1') for i in range(10)]
+
+
+def test_read_tsv_handles_escapes_and_language_tags_after_sample(monkeypatch):
+    monkeypatch.setattr(sparql, 'SAMPLE_BYTES', 100)
+    rows = [f'"{i}"^^<{XSD}integer>\t"name {i}"@en\t"{i % 2}"^^<{XSD}boolean>\n' for i in range(20)]
+    rows[15] = f'"15"^^<{XSD}integer>\t"say \\"hi\\"\\tnow"\t"1"^^<{XSD}boolean>\n'
+    tsv = '?id\t?name\t?flag\n' + ''.join(rows)
+
+    result = sparql.read_tsv(io.BytesIO(tsv.encode()), chunk_bytes=200)
+
+    assert result['id'].tolist() == list(range(20))
+    assert result['name'][3] == 'name 3'
+    assert result['name'][15] == 'say "hi"\tnow'
+    assert result['flag'].dtype == bool
+    assert result['flag'].tolist() == [i % 2 == 1 for i in range(20)]
+
+
+@pytest.mark.parametrize('n_rows', [250, 200])
+def test_query_pages_concatenates_pages_in_order(n_rows):
+    # With 200 rows, the page after the last full page is empty
+    df = pd.DataFrame({'id': np.arange(n_rows, dtype=np.int32), 'value': np.arange(n_rows) / 4,
+                       'group': [f'group {i % 60}' for i in range(n_rows)]})
+
+    with SparqlServer(paginated(df)) as server:
+        result = sparql.query_pages(server.endpoint, QUERY, page_size=100, max_workers=2)
+        n_queries = len(server.queries)
+        unpaged = sparql.query(server.endpoint, QUERY)
+
+    # The same dtypes as without pages: `group` is categorical, although every page has too many distinct groups
+    pd.testing.assert_frame_equal(unpaged, result)
+    pd.testing.assert_frame_equal(df, result, check_dtype=False, check_categorical=False)
+    assert result.dtypes.to_dict() == {'id': 'int32', 'value': 'float32', 'group': 'category'}
+    # One query for the variables and the pages up to the first page that is not full
+    assert n_queries <= 5
+    assert all('ORDER BY ?id ?value LIMIT 100' in query for query in server.queries[1:n_queries])
+    assert server.queries[0].startswith('PREFIX ex: <http://example.org/> SELECT * WHERE { SELECT ?id ?value')
+
+
+def test_concat_chunks_makes_strings_categorical_over_all_chunks():
+    chunks = [pd.DataFrame({'group': pd.Categorical(['a', 'a', 'b', 'b'])}),
+              pd.DataFrame({'group': ['a', 'b', 'c']}),
+              pd.DataFrame({'group': np.full(2, np.nan, dtype=np.float32)})]
+
+    result = sparql.concat_chunks(chunks)
+
+    assert isinstance(result['group'].dtype, pd.CategoricalDtype)
+    assert result['group'].tolist()[:7] == ['a', 'a', 'b', 'b', 'a', 'b', 'c']
+    assert result['group'][7:].isna().all()
+
+
+def test_query_pages_requests_pages_concurrently():
+    df = pd.DataFrame({'id': np.arange(400, dtype=np.int32)})
+    respond = paginated(df)
+
+    def respond_when_all_pages_are_requested(query):
+        # Pages are only answered once 5 pages are requested at the same time, or after a while otherwise
+        deadline = time.monotonic() + 10
+        while server.max_in_flight < 5 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return respond(query)
+
+    with SparqlServer(respond_when_all_pages_are_requested) as server:
+        result = sparql.query_pages(server.endpoint, 'SELECT ?id WHERE { ?s ?p ?id }', page_size=100, max_workers=5)
+
+    # Pages 0 to 4 at the same time, the variables are read from the query
+    assert server.max_in_flight == 5
+    assert len(result) == 400
+
+
+def test_query_pages_retries_failed_pages(monkeypatch):
+    monkeypatch.setattr(sparql, 'RETRY_INTERVAL', 0.01)
+    df = pd.DataFrame({'id': np.arange(30, dtype=np.int32)})
+    respond = paginated(df)
+    failed = set()
+
+    def flaky(query):
+        if 'OFFSET 10' in query and query not in failed:
+            failed.add(query)
+            raise RuntimeError('Triplestore is busy')
+        return respond(query)
+
+    with SparqlServer(flaky) as server:
+        result = sparql.query_pages(server.endpoint, 'SELECT ?id WHERE { ?s ?p ?id }', page_size=10)
+
+    assert failed
+    pd.testing.assert_frame_equal(df, result, check_dtype=False)
+
+
+def test_query_pages_gives_up_after_retries(monkeypatch):
+    monkeypatch.setattr(sparql, 'RETRY_INTERVAL', 0.01)
+
+    def failing(query):
+        if 'OFFSET' in query:
+            raise RuntimeError('Triplestore is down')
+        return '?id\n'
+
+    with SparqlServer(failing) as server, pytest.raises(sparql.requests.HTTPError):
+        sparql.query_pages(server.endpoint, 'SELECT ?id WHERE { ?s ?p ?id }', page_size=10, retries=2)
+
+
+@pytest.mark.parametrize('query, expected', [
+    (QUERY, ['id', 'value']),
+    ('SELECT DISTINCT $a ?b FROM <http://example.org/g> WHERE { ?a ?p ?b }', ['a', 'b']),
+    ('SELECT * WHERE { ?s ?p ?o }', None),
+    ('SELECT ?s (COUNT(?o) AS ?n) WHERE { ?s ?p ?o } GROUP BY ?s', None),
+])
+def test_variables_are_read_from_projection(query, expected):
+    assert sparql.variables(query) == expected
+
+
+def test_count_query_keeps_prologue():
+    assert sparql.count_query(QUERY) == ('PREFIX ex: <http://example.org/> SELECT (COUNT(*) AS ?count) WHERE '
+                                         '{ SELECT ?id ?value WHERE { ?s ex:id ?id ; ex:value ?value } }')
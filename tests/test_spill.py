@@ -0,0 +1,73 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from v6_carrier_py import join, spill
+
+
+def join_in_memory(df_list, on):
+    joined = join.merge_inner([join.drop_duplicate_keys(df, on) for df in df_list], on)
+    return joined.drop_duplicates(keep=False, subset=on)
+
+
+def sort(df, on):
+    return df.sort_values(on).reset_index(drop=True)
+
+
+@pytest.mark.parametrize('n_partitions', [1, 4, 16])
+def test_partitioned_join_equals_in_memory_join(tmp_path, n_partitions):
+    rng = np.random.RandomState(0)
+    df1 = pd.DataFrame({'id': rng.randint(0, 300, 400), 'sex': rng.choice(['M', 'F'], 400),
+                        'height': rng.normal(170, 10, 400)})
+    df2 = pd.DataFrame({'id': rng.randint(0, 300, 300), 'sex': rng.choice(['M', 'F'], 300),
+                        'weight': rng.normal(70, 10, 300)})
+    on = ['id', 'sex']
+
+    with spill.PartitionedJoin(on, n_partitions, directory=str(tmp_path)) as joiner:
+        joiner.add(2, df2)
+        # Chunks of a dataset may end up in the same partition
+        joiner.add(1, [df1.iloc[:250], df1.iloc[250:]])
+        chunks = list(joiner.chunks())
+
+    assert len(chunks) <= n_partitions
+    pd.testing.assert_frame_equal(sort(join_in_memory([df1, df2], on), on), sort(pd.concat(chunks), on))
+    assert os.listdir(tmp_path) == []
+
+
+def test_partitions_match_for_different_integer_widths():
+    keys = pd.DataFrame({'id': [-5, 0, 7, 1000]})
+
+    assert (spill.partition(keys, 'id', 8) == spill.partition(keys.astype('int16'), 'id', 8)).all()
+
+
+def test_partitioned_join_of_integer_and_float_keys(tmp_path):
+    df1 = pd.DataFrame({'id': range(100), 'x': range(100)})
+    # A missing key makes the keys of the other dataset floats
+    df2 = pd.DataFrame({'id': [np.nan] + list(range(1, 100)), 'y': range(100)})
+
+    with spill.PartitionedJoin('id', 16, directory=str(tmp_path)) as joiner:
+        joiner.add(1, df1)
+        joiner.add(2, df2)
+        result = pd.concat(joiner.chunks())
+
+    pd.testing.assert_frame_equal(sort(join_in_memory([df1, df2], 'id'), 'id'), sort(result, 'id'))
+    assert len(result) == 99
+
+
+def test_partitioned_join_of_categorical_keys(tmp_path):
+    df1 = pd.DataFrame({'name': pd.Categorical(['a', 'b', 'c']), 'x': [1, 2, 3]})
+    df2 = pd.DataFrame({'name': ['c', 'a', 'd'], 'y': [4, 5, 6]})
+
+    with spill.PartitionedJoin('name', 4, directory=str(tmp_path)) as joiner:
+        joiner.add(1, df1)
+        joiner.add(2, df2)
+        result = sort(pd.concat(joiner.chunks()).astype({'name': str}), 'name')
+
+    pd.testing.assert_frame_equal(pd.DataFrame({'name': ['a', 'c'], 'x': [1, 3], 'y': [5, 4]}), result)
+
+
+def test_partitioned_join_requires_keys():
+    with pytest.raises(ValueError):
+        spill.PartitionedJoin(None)
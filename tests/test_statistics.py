@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from v6_carrier_py.statistics import CorrelationStatistics, correlation_matrix
+
+N_RECORDS = 1000
+
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(0)
+    values = rng.normal(size=(N_RECORDS, 4)) @ rng.normal(size=(4, 4))
+    df = pd.DataFrame(1e6 + values, columns=['a', 'b', 'c', 'd'])
+    df = df.mask(rng.random(df.shape) < 0.2)
+    df['flag'] = rng.random(N_RECORDS) > 0.5
+    df['name'] = 'text'
+    return df
+
+
+def test_correlation_equals_pandas(data):
+    result = CorrelationStatistics.from_data(data).correlation()
+
+    pd.testing.assert_frame_equal(data.corr(), result, check_exact=False, atol=1e-10)
+
+
+def test_added_statistics_equal_statistics_of_all_data(data):
+    parts = [data.iloc[:10], data.iloc[10:11], data.iloc[11:600], data.iloc[600:]]
+
+    statistics = sum((CorrelationStatistics.from_data(part) for part in parts[1:]),
+                     CorrelationStatistics.from_data(parts[0]))
+
+    assert statistics.n_records == N_RECORDS
+    pd.testing.assert_frame_equal(data.corr(), statistics.correlation(), check_exact=False, atol=1e-10)
+
+
+def test_statistics_from_batches(data):
+    statistics = CorrelationStatistics.from_batches(data.iloc[i:i + 128] for i in range(0, N_RECORDS, 128))
+
+    assert statistics.n_records == N_RECORDS
+    pd.testing.assert_frame_equal(data.corr(), statistics.correlation(), check_exact=False, atol=1e-10)
+
+
+def test_missing_columns_are_treated_as_missing_values(data):
+    first, second = data.iloc[:500], data.iloc[500:].drop(columns='b')
+
+    statistics = CorrelationStatistics.from_data(first) + CorrelationStatistics.from_data(second)
+
+    expected = pd.concat([first, second]).corr()
+    pd.testing.assert_frame_equal(expected, statistics.correlation(), check_exact=False, atol=1e-10)
+
+
+def test_correlation_is_nan_without_variance():
+    df = pd.DataFrame({'a': [1., 2, 3], 'b': [1., 1, 1], 'c': [np.nan, 1, np.nan]})
+
+    result = CorrelationStatistics.from_data(df).correlation()
+
+    pd.testing.assert_frame_equal(df.corr(), result)
+
+
+# Column 'a' is constant in the records where 'b' has a value, but the rounding error of the sums is not 0
+CONSTANT_IN_OVERLAP = pd.DataFrame({'a': [0.1, 0.1, 0.1, 5.3, 7.9, 1.7], 'b': [1., 2, 3, np.nan, np.nan, np.nan],
+                                    'c': [0.3, 1.2, 0.7, 0.2, 2.5, 1.1]})
+
+
+def test_correlation_matrix_is_nan_for_constant_values_in_overlap():
+    result = correlation_matrix(CONSTANT_IN_OVERLAP)
+
+    pd.testing.assert_frame_equal(CONSTANT_IN_OVERLAP.corr(), result)
+
+
+def test_added_statistics_are_nan_for_constant_values_in_overlap():
+    statistics = (CorrelationStatistics.from_data(CONSTANT_IN_OVERLAP.iloc[:2])
+                  + CorrelationStatistics.from_data(CONSTANT_IN_OVERLAP.iloc[2:]))
+
+    pd.testing.assert_frame_equal(CONSTANT_IN_OVERLAP.corr(), statistics.correlation())
+
+
+def test_statistics_survive_dict_conversion(data):
+    statistics = CorrelationStatistics.from_data(data)
+
+    result = CorrelationStatistics.from_dict(statistics.to_dict())
+
+    pd.testing.assert_frame_equal(statistics.correlation(), result.correlation())
+
+
+@pytest.mark.parametrize('method', ['pearson', 'spearman'])
+@pytest.mark.parametrize('missing', [0, 0.2])
+def test_correlation_matrix_equals_pandas(data, method, missing):
+    rng = np.random.default_rng(1)
+    data = data.mask(rng.random(data.shape) < missing)
+    data['rounded'] = data['a'].round(-1)
+    data['constant'] = 1
+
+    result = correlation_matrix(data, method=method, block_size=3)
+
+    pd.testing.assert_frame_equal(data.corr(method), result, check_exact=False, atol=1e-10)
+
+
+@pytest.mark.parametrize('method', ['pearson', 'spearman'])
+def test_correlation_matrix_float32(data, method):
+    result = correlation_matrix(data, method=method, dtype='float32')
+
+    pd.testing.assert_frame_equal(data.corr(method), result, check_exact=False, atol=1e-5)
+
+
+def test_correlation_matrix_unknown_method(data):
+    with pytest.raises(ValueError):
+        correlation_matrix(data, method='kendall')
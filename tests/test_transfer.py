@@ -0,0 +1,98 @@
+import os
+import pickle
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from v6_carrier_py import transfer
+
+DF = pd.DataFrame({'id': np.arange(100, dtype='int32'), 'height': np.linspace(150, 200, 100),
+                   'sex': pd.Categorical(['M', 'F'] * 50), 'name': [f'name{i}' for i in range(100)]})
+
+
+def encode(output, output_format=None, compression=None, batch_rows=None):
+    fp = BytesIO()
+    transfer.write(output, fp, output_format=output_format, compression=compression, batch_rows=batch_rows)
+    return fp.getvalue()
+
+
+@pytest.mark.parametrize('compression', [None, 'lz4', 'zstd'])
+def test_dataframe_round_trips_as_arrow(compression):
+    data = encode(DF, 'arrow', compression)
+
+    assert data.startswith(b'arrow.')
+    pd.testing.assert_frame_equal(DF, transfer.decode(data))
+
+
+def test_compression_reduces_size():
+    df = pd.DataFrame({'value': np.repeat(np.arange(10), 1000)})
+
+    assert len(encode(df, 'arrow', 'zstd')) < len(encode(df, 'arrow')) / 10
+
+
+def test_uncompressed_arrow_is_read_in_place():
+    data = encode(DF, 'arrow')
+
+    result = transfer.decode(data)
+
+    assert np.shares_memory(result['height'].values, np.frombuffer(data, dtype='uint8'))
+    assert not result['height'].values.flags.writeable
+
+
+def test_arrow_is_memory_mapped_from_directory(tmp_path):
+    result = transfer.decode(encode(DF, 'arrow'), directory=str(tmp_path))
+
+    pd.testing.assert_frame_equal(DF, result)
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.parametrize('output', [['column1', 'column2'], pd.DataFrame({'mixed': [1, 'a']})])
+def test_arrow_falls_back_to_pickle(output):
+    data = encode(output, 'arrow')
+
+    assert data.startswith(b'pickle.')
+    if isinstance(output, pd.DataFrame):
+        pd.testing.assert_frame_equal(output, transfer.decode(data))
+    else:
+        assert transfer.decode(data) == output
+
+
+@pytest.mark.parametrize('output_format, output', [(None, 1), (None, DF), ('pickle', DF), ('json', {'count': 1}),
+                                                   ('JSON', [1, 2])])
+def test_other_formats_round_trip(output_format, output):
+    data = encode(output, output_format)
+
+    if isinstance(output, pd.DataFrame):
+        pd.testing.assert_frame_equal(output, transfer.decode(data))
+    else:
+        assert transfer.decode(data) == output
+
+
+def test_results_without_format_are_pickles():
+    assert encode(DF) == pickle.dumps(DF)
+
+
+def test_unknown_compression_is_rejected():
+    with pytest.raises(ValueError):
+        encode(DF, 'arrow', 'gzip')
+
+
+@pytest.mark.parametrize('directory', [False, True])
+def test_batches_are_read_one_at_a_time(tmp_path, directory):
+    batches = transfer.decode(encode(DF, compression='zstd', batch_rows=30), str(tmp_path) if directory else None)
+
+    assert isinstance(batches, transfer.RecordBatches)
+    assert (len(batches), batches.num_batches, batches.columns) == (100, 4, list(DF.columns))
+    assert [len(batch) for batch in batches] == [30, 30, 30, 10]
+    pd.testing.assert_frame_equal(DF, pd.concat(batches, ignore_index=True))
+    pd.testing.assert_frame_equal(DF[['sex', 'id']], batches.to_pandas(['sex', 'id']))
+    assert [list(batch.columns) for batch in batches.iter_frames(['height'])] == [['height']] * 4
+    pd.testing.assert_frame_equal(DF.iloc[:0], batches.empty())
+
+
+def test_batches_can_be_pickled():
+    batches = transfer.decode(encode(DF, batch_rows=30))
+
+    pd.testing.assert_frame_equal(DF, pickle.loads(pickle.dumps(batches)).to_pandas())
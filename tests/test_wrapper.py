@@ -3,26 +3,33 @@ from pathlib import Path
 from unittest.mock import patch, MagicMock
 
 import pandas as pd
+import pytest
 
-from v6_carrier_py import wrapper
+from v6_carrier_py import transfer, wrapper
+from v6_carrier_py.cache import QueryCache
+from .sparql_server import SparqlServer
 
 MOCK_MODULE = 'mock_module'
 MOCK_TOKEN = 'token'
-MOCK_ENDPOINT = 'http://example.org'
-MOCK_SPARQL_RESULT = 's,p,o\nthis,is,fake'
+MOCK_SPARQL_RESULT = '?s\t?p\t?o\n"this"\t"is"\t"fake"\n'
+
+
+@pytest.fixture
+def server():
+    with SparqlServer(lambda query: MOCK_SPARQL_RESULT) as server:
+        yield server
 
 
 @patch('v6_carrier_py.wrapper.dispact_rpc')
 @patch('v6_carrier_py.wrapper.os')
-@patch('v6_carrier_py.wrapper.SPARQLWrapper')
-def test_wrapper_passes_dataframe(SPARQLWrapper: MagicMock, os: MagicMock, dispact_rpc: MagicMock, tmp_path: Path):
+def test_wrapper_passes_dataframe(os: MagicMock, dispact_rpc: MagicMock, server: SparqlServer, tmp_path: Path):
     input_file = tmp_path / 'input_file.pkl'
     token_file = tmp_path / 'token.txt'
     output_file = tmp_path / 'output.pkl'
 
     environ = {'INPUT_FILE': str(input_file),
                'TOKEN_FILE': str(token_file),
-               'DATABASE_URI': MOCK_ENDPOINT,
+               'DATABASE_URI': server.endpoint,
                'OUTPUT_FILE': str(output_file)}
 
     os.environ = environ
@@ -36,7 +43,6 @@ def test_wrapper_passes_dataframe(SPARQLWrapper: MagicMock, os: MagicMock, dispa
         f.write(MOCK_TOKEN)
 
     dispact_rpc.return_value = pd.DataFrame()
-    SPARQLWrapper.return_value.query.return_value.convert.return_value = MOCK_SPARQL_RESULT.encode()
 
     wrapper.sparql_wrapper(MOCK_MODULE)
 
@@ -44,3 +50,104 @@ def test_wrapper_passes_dataframe(SPARQLWrapper: MagicMock, os: MagicMock, dispa
 
     target_df = pd.DataFrame([['this', 'is', 'fake']], columns=['s', 'p', 'o'])
     pd.testing.assert_frame_equal(target_df, dispact_rpc.call_args[0][0])
+
+
+@patch('v6_carrier_py.wrapper.os')
+def test_wrapper_runs_batch_on_single_query_result(os: MagicMock, server: SparqlServer, tmp_path: Path):
+    input_args = {'query': 'select *',
+                  'batch': [{'method': 'column_names'},
+                            {'method': 'count'},
+                            {'method': 'get_data', 'kwargs': {'keys': pd.DataFrame({'s': ['this']})}, 'name': 'this'}]}
+
+    result = run_wrapper('v6_carrier_py', input_args, os, server.endpoint, tmp_path)
+
+    assert len(server.queries) == 1
+    assert list(result) == ['column_names', 'count', 'this']
+    assert result['column_names'] == ['s', 'p', 'o']
+    assert result['count'] == 1
+    pd.testing.assert_frame_equal(pd.DataFrame([['this', 'is', 'fake']], columns=['s', 'p', 'o']), result['this'])
+
+
+@patch('v6_carrier_py.wrapper.os')
+def test_wrapper_batch_requires_unique_names(os: MagicMock, server: SparqlServer, tmp_path: Path):
+    input_args = {'query': 'select *', 'batch': [{'method': 'count'}, {'method': 'count'}]}
+
+    with pytest.raises(ValueError):
+        run_wrapper('v6_carrier_py', input_args, os, server.endpoint, tmp_path)
+
+
+def run_wrapper(module, input_args, os, endpoint, tmp_path):
+    input_file = tmp_path / 'input_file.pkl'
+    token_file = tmp_path / 'token.txt'
+    output_file = tmp_path / 'output.pkl'
+
+    os.environ = {'INPUT_FILE': str(input_file),
+                  'TOKEN_FILE': str(token_file),
+                  'DATABASE_URI': endpoint,
+                  'OUTPUT_FILE': str(output_file)}
+
+    with input_file.open('wb') as f:
+        pickle.dump(input_args, f)
+
+    with token_file.open('w') as f:
+        f.write(MOCK_TOKEN)
+
+    wrapper.sparql_wrapper(module)
+
+    return transfer.decode(output_file.read_bytes())
+
+
+def test_query_triplestore_reuses_cached_result(server: SparqlServer, tmp_path: Path):
+    cache = QueryCache(str(tmp_path))
+
+    first = wrapper.query_triplestore(server.endpoint, 'SELECT *  WHERE {?s ?p ?o}', cache=cache)
+    second = wrapper.query_triplestore(server.endpoint, 'SELECT * # all triples\nWHERE {?s ?p ?o}', cache=cache)
+    wrapper.query_triplestore(server.endpoint, 'SELECT * WHERE {?s ?p ?o}', cache=cache, dataset_version='2')
+
+    assert len(server.queries) == 2
+    pd.testing.assert_frame_equal(first, second)
+
+
+@pytest.mark.parametrize('query, n_requests', [('SELECT ?s ?p ?o WHERE { ?s ?p ?o }', 0), ('SELECT * WHERE { ?s ?p ?o }', 1)])
+@patch('v6_carrier_py.wrapper.os')
+def test_wrapper_column_names_does_not_retrieve_result(os: MagicMock, tmp_path: Path, query, n_requests):
+    with SparqlServer(lambda query: '?s\t?p\t?o\n' if 'LIMIT 0' in query else MOCK_SPARQL_RESULT) as server:
+        result = run_wrapper('v6_carrier_py', {'query': query, 'method': 'column_names'}, os, server.endpoint,
+                             tmp_path)
+
+    assert result == ['s', 'p', 'o']
+    assert len(server.queries) == n_requests
+
+
+@patch('v6_carrier_py.wrapper.dispact_rpc')
+@patch('v6_carrier_py.wrapper.os')
+def test_wrapper_dispatches_master_column_names(os: MagicMock, dispact_rpc: MagicMock, server: SparqlServer,
+                                                tmp_path: Path):
+    dispact_rpc.return_value = ['s', 'p', 'o', 'other']
+    input_args = {'query': 'SELECT ?s ?p ?o WHERE { ?s ?p ?o }', 'method': 'column_names', 'master': True}
+
+    result = run_wrapper('v6_carrier_py', input_args, os, server.endpoint, tmp_path)
+
+    dispact_rpc.assert_called_once()
+    assert dispact_rpc.call_args[0][1] == input_args
+    assert result == ['s', 'p', 'o', 'other']
+
+
+@patch('v6_carrier_py.wrapper.os')
+def test_wrapper_count_is_computed_by_triplestore(os: MagicMock, tmp_path: Path):
+    with SparqlServer(lambda query: '?count\n"42"^^<http://www.w3.org/2001/XMLSchema#integer>\n') as server:
+        result = run_wrapper('v6_carrier_py', {'query': 'SELECT * WHERE { ?s ?p ?o }', 'method': 'count'}, os,
+                             server.endpoint, tmp_path)
+
+    assert result == 42
+    assert server.queries == ['SELECT (COUNT(*) AS ?count) WHERE { SELECT * WHERE { ?s ?p ?o } }']
+
+
+@patch('v6_carrier_py.wrapper.os')
+def test_wrapper_writes_dataframe_as_arrow(os: MagicMock, server: SparqlServer, tmp_path: Path):
+    input_args = {'query': 'select *', 'method': 'get_data', 'output_format': 'arrow', 'compression': 'zstd'}
+
+    result = run_wrapper('v6_carrier_py', input_args, os, server.endpoint, tmp_path)
+
+    assert (tmp_path / 'output.pkl').read_bytes().startswith(b'arrow.')
+    pd.testing.assert_frame_equal(pd.DataFrame([['this', 'is', 'fake']], columns=['s', 'p', 'o']), result)
@@ -1,6 +1,25 @@
+import operator
+from typing import List, Sequence, Tuple
+
 import pandas as pd
 from vantage6.tools.util import info
 
+from . import dtypes, join
+from .sketches import BloomFilter, HyperLogLog, hash_keys
+from .statistics import CorrelationStatistics, correlation_matrix
+
+# Comparison operators of `where` predicates, see `_filter_records`
+OPERATORS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': lambda column, values: column.isin(values),
+    'not in': lambda column, values: ~column.isin(values),
+}
+
 
 def RPC_column_names(data: pd.DataFrame, *args, **kwargs):
     """Column names
@@ -14,21 +33,82 @@ def RPC_column_names(data: pd.DataFrame, *args, **kwargs):
     return data.columns.to_list()
 
 
-def RPC_correlation_matrix(data: pd.DataFrame, *args, **kwargs):
-    return data.corr()
+def RPC_correlation_matrix(data: pd.DataFrame, *args, method: str = 'pearson', dtype: str = 'float64', **kwargs):
+    return correlation_matrix(data, method=method, dtype=dtype)
 
 
-def RPC_get_data(data: pd.DataFrame, *args, **kwargs):
+def RPC_correlation_statistics(data: pd.DataFrame, *args, **kwargs):
+    """
+    Compute the sufficient statistics of the correlation matrix of the numeric columns. The master adds up the
+    statistics of all nodes to compute the correlation matrix of the records of all nodes together.
+
+    :param data:
+    :return: `CorrelationStatistics` as dict
+    """
+    statistics = CorrelationStatistics.from_data(data)
+    info(f'Returning correlation statistics of {statistics.n_records} records')
+    return statistics.to_dict()
+
+
+def RPC_get_data(data: pd.DataFrame, *args, keys: pd.DataFrame = None, merge_keys=None, bloom_filter: bytes = None,
+                 columns: List[str] = None, where: Sequence[Tuple[str, str, object]] = None,
+                 optimize_dtypes: bool = False, **kwargs):
     """
     Return the raw data.
     TODO: This function should not exist in the final version of the code! The data should be pseudonymized at the very
         least!
 
+    :param data:
+    :param keys: Only return the records whose key is one of the rows in `keys`. The key columns are the columns of
+                 `keys`.
+    :param merge_keys: Column name or list of column names of the keys that are checked against `bloom_filter`
+    :param bloom_filter: Serialized `BloomFilter`. Only records whose merge keys are (probably) in the filter are
+                         returned.
+    :param columns: Only return these columns. Columns that this node does not have are left out, so the same list
+                    can be sent to all nodes.
+    :param where: Only return the records that satisfy all predicates, see `_filter_records`
+    :param optimize_dtypes: Convert the columns to smaller dtypes without changing their values, to transfer less
+                            data, see `dtypes.optimize_dtypes`. The merge keys keep their dtype, so they can be joined
+                            with the keys of other nodes.
     """
-    info(f'Returning raw data with {len(data)} records')
+    if where:
+        data = _filter_records(data, where)
+    if keys is not None:
+        data = data[join.select_keys(data, keys)]
+    if bloom_filter is not None:
+        data = _apply_bloom_filter(data, merge_keys, bloom_filter)
+    if columns is not None:
+        data = data[_select_columns(data, columns)]
+    if optimize_dtypes:
+        key_columns = join.resolve_keys([data], merge_keys) or []
+        data = dtypes.optimize_dtypes(data, exclude=[key_columns] if isinstance(key_columns, str) else key_columns)
+    info(f'Returning raw data with {len(data)} records and {len(data.columns)} columns')
     return data
 
 
+def RPC_get_keys(data: pd.DataFrame, merge_keys, *args, bloom_filter: bytes = None,
+                 where: Sequence[Tuple[str, str, object]] = None, **kwargs):
+    """
+    Return only the key columns that are used to join datasets of different nodes.
+
+    :param data:
+    :param merge_keys: Column name or list of column names of the keys
+    :param bloom_filter: Serialized `BloomFilter`. Only keys that are (probably) in the filter are returned.
+    :param where: Only return the keys of the records that satisfy all predicates, see `_filter_records`
+    :return: DataFrame with the key columns
+    """
+    if where:
+        data = _filter_records(data, where)
+    if bloom_filter is not None:
+        data = _apply_bloom_filter(data, merge_keys, bloom_filter)
+
+    merge_keys = join.resolve_keys([data], merge_keys)
+    keys = [merge_keys] if isinstance(merge_keys, str) else merge_keys
+
+    info(f'Returning keys of {len(data)} records')
+    return data[keys]
+
+
 def RPC_count(data: pd.DataFrame, *args, **kwargs):
     """
     Count the number of rows in the result.
@@ -39,3 +119,77 @@ def RPC_count(data: pd.DataFrame, *args, **kwargs):
     :return:
     """
     return len(data.index)
+
+
+def RPC_bloom_filter(data: pd.DataFrame, merge_keys, num_bits: int, num_hashes: int, *args, **kwargs):
+    """
+    Build a bloom filter over the merge keys of all records. The master combines the filters of all nodes to find
+    out which records can possibly be linked.
+
+    :param data:
+    :param merge_keys: Column name or list of column names of the keys
+    :param num_bits: Size of the filter in bits
+    :param num_hashes: Number of hash functions
+    :return: Serialized `BloomFilter`
+    """
+    merge_keys = join.resolve_keys([data], merge_keys)
+    bloom_filter = BloomFilter(num_bits, num_hashes)
+    bloom_filter.add(hash_keys(data, merge_keys))
+
+    info(f'Created bloom filter of {num_bits} bits with fill ratio {bloom_filter.fill_ratio():.3f}')
+    return bloom_filter.to_bytes()
+
+
+def RPC_key_sketch(data: pd.DataFrame, merge_keys, *args, precision: int = 14, **kwargs):
+    """
+    Build a HyperLogLog sketch of the merge keys, which the master uses to estimate how many records can be linked
+    between nodes.
+
+    :param data:
+    :param merge_keys: Column name or list of column names of the keys
+    :param precision: Precision of the sketch
+    :return: Serialized `HyperLogLog` sketch
+    """
+    merge_keys = join.resolve_keys([data], merge_keys)
+    sketch = HyperLogLog(precision)
+    sketch.add(hash_keys(data, merge_keys))
+    return sketch.to_bytes()
+
+
+def _apply_bloom_filter(data: pd.DataFrame, merge_keys, bloom_filter: bytes) -> pd.DataFrame:
+    merge_keys = join.resolve_keys([data], merge_keys)
+    bloom_filter = BloomFilter.from_bytes(bloom_filter)
+
+    filtered = data[bloom_filter.contains(hash_keys(data, merge_keys))]
+    info(f'Bloom filter removed {len(data) - len(filtered)} of {len(data)} records')
+    return filtered
+
+
+def _filter_records(data: pd.DataFrame, where: Sequence[Tuple[str, str, object]]) -> pd.DataFrame:
+    """
+    Keep the records that satisfy all predicates. A predicate is a tuple `(column, operator, value)` with one of the
+    `OPERATORS`, for example `('Age', '>=', 18)` or `('GBAGeslacht', 'in', [1, 2])`. Records with a missing value in
+    the column never satisfy the predicate. Predicates on columns that this node does not have are skipped: in an inner
+    join they are applied by the node that has the column. The master checks that some node has the column.
+    """
+    mask = pd.Series(True, index=data.index)
+    for column, op, value in where:
+        if op not in OPERATORS:
+            raise ValueError(f'Unknown operator {op} in predicate on {column}, use one of {list(OPERATORS)}')
+        if column not in data.columns:
+            info(f'Skipping predicate on {column}, which is not in the data')
+            continue
+        mask &= OPERATORS[op](data[column], value) & data[column].notna()
+
+    filtered = data[mask]
+    info(f'Predicates removed {len(data) - len(filtered)} of {len(data)} records')
+    return filtered
+
+
+def _select_columns(data: pd.DataFrame, columns: List[str]) -> List[str]:
+    """
+    The requested columns that are in `data`. The key `encrypted_identifier` is replaced by its compact columns when
+    the data uses that format, see `join.resolve_keys`.
+    """
+    columns = join.resolve_keys([data], list(columns))
+    return [c for c in dict.fromkeys(columns) if c in data.columns]
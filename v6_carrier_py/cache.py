@@ -0,0 +1,310 @@
+"""
+Caches that avoid repeating work.
+
+`ResultCache` holds the results of node tasks, so the master can skip a federation round when the same task was run
+before. Results are kept in memory, and optionally on disk in a directory that outlives the master container. On disk,
+DataFrames are stored as Parquet files (this requires `pyarrow` or `fastparquet`), other results are pickled.
+
+`QueryCache` holds the results of SPARQL queries on a node, so the triplestore does not run the same query again.
+"""
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+from vantage6.tools.util import info
+
+from .sparql import normalize_query
+
+_META_FILE = 'meta.json'
+_DATA_FILE = 'data.arrow'
+
+
+def make_key(method: str, input_: Dict[str, Any], organization_ids: Sequence[int]) -> str:
+    """
+    Hash of everything that determines the results of a task: the method, the input payload (including the query
+    and keyword arguments) and the organizations that run it.
+    """
+    hasher = hashlib.sha256()
+    _fingerprint({'method': method, 'input': input_, 'organizations': sorted(organization_ids)}, hasher)
+    return hasher.hexdigest()
+
+
+class ResultCache:
+    """
+    Results of tasks by key (see `make_key`), with a time to live and least recently used eviction.
+
+    :param ttl: Number of seconds after which results expire, `None` means they do not expire
+    :param max_bytes: Maximum estimated size of the results in memory, and separately on disk
+    :param directory: Directory for the on-disk tier, `None` keeps results in memory only
+    """
+
+    def __init__(self, ttl: Optional[float] = 600, max_bytes: int = 2 ** 30, directory: Optional[str] = None):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.directory = directory
+        # key -> (method, creation time, size in bytes, results)
+        self._entries = OrderedDict()
+        # Subtasks can be dispatched from several threads, see `master._run_async`
+        self._lock = threading.RLock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self, key: str) -> Optional[List[Any]]:
+        """
+        Results stored under `key`, or `None` when there are no results that have not expired.
+        """
+        with self._lock:
+            return self._get(key)
+
+    def put(self, key: str, method: str, results: List[Any]):
+        with self._lock:
+            self._put(key, method, results)
+
+    def invalidate(self, method: Optional[str] = None):
+        """
+        Remove the results of `method`, or all results when `method` is `None`.
+        """
+        with self._lock:
+            for key in [k for k, entry in self._entries.items() if method is None or entry[0] == method]:
+                del self._entries[key]
+
+            for key, meta in list(self._disk_entries()):
+                if method is None or meta['method'] == method:
+                    shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+
+    def _get(self, key: str) -> Optional[List[Any]]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            if self._expired(entry[1]):
+                del self._entries[key]
+            else:
+                self._entries.move_to_end(key)
+                return entry[3]
+
+        if self.directory is not None:
+            return self._read(key)
+        return None
+
+    def _put(self, key: str, method: str, results: List[Any]):
+        size = sum(_result_size(r) for r in results)
+        if size <= self.max_bytes:
+            self._entries[key] = (method, time.time(), size, results)
+            self._entries.move_to_end(key)
+            while sum(entry[2] for entry in self._entries.values()) > self.max_bytes:
+                self._entries.popitem(last=False)
+
+        if self.directory is not None:
+            self._write(key, method, results)
+            self._evict_disk()
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def _read(self, key: str) -> Optional[List[Any]]:
+        path = os.path.join(self.directory, key)
+        try:
+            with open(os.path.join(path, _META_FILE)) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+
+        if self._expired(meta['created']):
+            shutil.rmtree(path, ignore_errors=True)
+            return None
+
+        results = []
+        for file_name in meta['files']:
+            file_path = os.path.join(path, file_name)
+            if file_name.endswith('.parquet'):
+                results.append(pd.read_parquet(file_path))
+            else:
+                with open(file_path, 'rb') as f:
+                    results.append(pickle.load(f))
+
+        # The modification time of the directory marks the last use
+        os.utime(path)
+        self._entries[key] = (meta['method'], meta['created'], sum(_result_size(r) for r in results), results)
+        info(f'Loaded cached results of {meta["method"]} from disk')
+        return results
+
+    def _write(self, key: str, method: str, results: List[Any]):
+        path = os.path.join(self.directory, key)
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+
+        files = []
+        for i, result in enumerate(results):
+            if isinstance(result, pd.DataFrame) and _write_parquet(result, os.path.join(path, f'{i}.parquet')):
+                files.append(f'{i}.parquet')
+                continue
+            with open(os.path.join(path, f'{i}.pkl'), 'wb') as f:
+                pickle.dump(result, f)
+            files.append(f'{i}.pkl')
+
+        # The meta file is written last, so incomplete entries are never read
+        with open(os.path.join(path, _META_FILE), 'w') as f:
+            json.dump({'method': method, 'created': time.time(), 'files': files}, f)
+
+    def _disk_entries(self):
+        if self.directory is None:
+            return []
+        return _disk_entries(self.directory)
+
+    def _evict_disk(self):
+        _evict_directory(self.directory, self.max_bytes, self._expired)
+
+
+class QueryCache:
+    """
+    Node-side cache of SPARQL query results on disk, typically on a mounted volume, so repeated tasks with the same
+    query do not run it on the triplestore again. Results are stored as uncompressed Arrow IPC (Feather) files and
+    read through memory mapping. This requires `pyarrow`.
+
+    :param directory: Directory of the cache
+    :param ttl: Number of seconds after which results expire, `None` means they do not expire
+    :param max_bytes: Maximum size of the cached files, least recently used results are removed first
+    """
+
+    def __init__(self, directory: str, ttl: Optional[float] = 3600, max_bytes: int = 2 ** 32):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def make_key(endpoint: str, query: str, dataset_version: Optional[str] = None) -> str:
+        """
+        Queries that only differ in whitespace or comments share a key. Changing `dataset_version` invalidates all
+        earlier results.
+        """
+        hasher = hashlib.sha256()
+        _fingerprint((endpoint, normalize_query(query), dataset_version), hasher)
+        return hasher.hexdigest()
+
+    def get(self, key: str) -> Optional[pd.DataFrame]:
+        from pyarrow import feather
+
+        path = os.path.join(self.directory, key)
+        try:
+            with open(os.path.join(path, _META_FILE)) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+
+        if self._expired(meta['created']):
+            shutil.rmtree(path, ignore_errors=True)
+            return None
+
+        os.utime(path)
+        return feather.read_table(os.path.join(path, _DATA_FILE), memory_map=True).to_pandas()
+
+    def put(self, key: str, data: pd.DataFrame):
+        from pyarrow import feather
+
+        path = os.path.join(self.directory, key)
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+
+        # Uncompressed, so the file can be memory mapped without decoding
+        feather.write_feather(data, os.path.join(path, _DATA_FILE), compression='uncompressed')
+        with open(os.path.join(path, _META_FILE), 'w') as f:
+            json.dump({'created': time.time()}, f)
+
+        _evict_directory(self.directory, self.max_bytes, self._expired)
+
+    def invalidate(self):
+        for key, _ in list(_disk_entries(self.directory)):
+            shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+
+def _disk_entries(directory: str):
+    """
+    Yield the key and metadata of every complete entry in `directory`.
+    """
+    for key in os.listdir(directory):
+        try:
+            with open(os.path.join(directory, key, _META_FILE)) as f:
+                yield key, json.load(f)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+
+
+def _evict_directory(directory: str, max_bytes: int, expired: Callable[[float], bool]):
+    """
+    Remove expired entries, and the least recently used entries until `directory` fits in `max_bytes`. The
+    modification time of the directory of an entry marks its last use.
+    """
+    entries = []
+    for key, meta in list(_disk_entries(directory)):
+        path = os.path.join(directory, key)
+        if expired(meta['created']):
+            shutil.rmtree(path, ignore_errors=True)
+            continue
+        size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+        entries.append((os.path.getmtime(path), size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def _write_parquet(df: pd.DataFrame, path: str) -> bool:
+    """
+    Write `df` as Parquet file. Returns `False` when Parquet can not represent it, for example when column names are
+    not strings.
+    """
+    try:
+        df.to_parquet(path)
+        return True
+    except (ValueError, TypeError):
+        if os.path.exists(path):
+            os.remove(path)
+        return False
+
+
+def _result_size(result: Any) -> int:
+    if isinstance(result, (pd.DataFrame, pd.Series)):
+        return int(result.memory_usage(deep=True).sum())
+    return len(pickle.dumps(result))
+
+
+def _fingerprint(value: Any, hasher):
+    """
+    Feed a canonical representation of `value` to `hasher`. Dicts are hashed independent of the order of their keys,
+    DataFrames and arrays by their contents.
+    """
+    hasher.update(type(value).__name__.encode())
+    if isinstance(value, dict):
+        for key in sorted(value, key=str):
+            _fingerprint(key, hasher)
+            _fingerprint(value[key], hasher)
+    elif isinstance(value, (list, tuple)):
+        hasher.update(str(len(value)).encode())
+        for item in value:
+            _fingerprint(item, hasher)
+    elif isinstance(value, (pd.DataFrame, pd.Series)):
+        _fingerprint(list(map(str, value.dtypes)) if isinstance(value, pd.DataFrame) else str(value.dtype), hasher)
+        if isinstance(value, pd.DataFrame):
+            _fingerprint(list(value.columns), hasher)
+        hasher.update(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+    elif isinstance(value, np.ndarray):
+        hasher.update(f'{value.dtype}{value.shape}'.encode())
+        hasher.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, bytes):
+        hasher.update(value)
+    else:
+        hasher.update(repr(value).encode())
@@ -0,0 +1,97 @@
+"""
+Smaller dtypes for DataFrames, to transfer and store tables more compactly.
+
+`optimize_dtypes` only makes changes that keep every value: integers get the smallest integer dtype that holds their
+range, floats become float32 when all values are exactly representable (for example counts or values with few decimal
+places in binary, such as 0.5), and text columns with few distinct values become categorical.
+
+Arithmetic on the optimized columns is not the same though: integers overflow in their smaller dtype (100 * 2 is -56
+in int8) and float32 arithmetic is less precise. The optimized tables are kept as they are, computations cast the
+values to 64 bits, like `statistics` and `master.fit_pipeline` do.
+"""
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+from vantage6.tools.util import info
+
+# Text columns become categorical when the number of distinct values is at most this share of the records
+CATEGORY_RATIO = 0.5
+# Integer dtypes from small to large
+_INTEGER_DTYPES = (np.int8, np.int16, np.int32, np.int64)
+
+
+def optimize_dtypes(df: pd.DataFrame, exclude: Iterable[str] = (), category_ratio: float = CATEGORY_RATIO
+                    ) -> pd.DataFrame:
+    """
+    Convert the columns of `df` to smaller dtypes without changing any value, and log the number of bytes saved.
+
+    :param exclude: Columns that keep their dtype, for example merge keys that are joined with other datasets and
+                    need the same dtype everywhere
+    :param category_ratio: Maximum number of distinct values of text columns that become categorical, as share of the
+                           number of records
+    :return: DataFrame with the optimized columns, `df` itself is not changed
+    """
+    # Duplicate column names can not be replaced one by one
+    exclude = set(exclude).union(df.columns[df.columns.duplicated()])
+    before = df.memory_usage(deep=True).sum()
+
+    columns = {}
+    for column, values in df.items():
+        if column in exclude:
+            continue
+        optimized = _optimize_column(values, category_ratio)
+        if optimized is not values:
+            columns[column] = optimized
+
+    if columns:
+        df = df.copy(deep=False)
+        for column, values in columns.items():
+            df[column] = values
+
+    after = df.memory_usage(deep=True).sum()
+    info(f'Optimized the dtypes of {len(columns)} columns, saving {(before - after) / 2 ** 20:.1f} MiB '
+         f'({before / 2 ** 20:.1f} MiB to {after / 2 ** 20:.1f} MiB)')
+    return df
+
+
+def downcast_floats(values: pd.Series) -> pd.Series:
+    """
+    The float column as float32 when all values are exactly representable, otherwise `values` itself.
+    """
+    if values.dtype.itemsize <= 4:
+        return values
+    converted = values.astype(np.float32)
+    # Exactly representable values survive the round trip, missing values stay missing
+    exact = np.array_equal(converted.values.astype(values.dtype), values.values, equal_nan=True)
+    return converted if exact else values
+
+
+def _optimize_column(values: pd.Series, category_ratio: float) -> pd.Series:
+    """
+    The column with a smaller dtype, or `values` itself when there is none.
+    """
+    kind = values.dtype.kind
+    if kind == 'i':
+        return _downcast_integers(values)
+    if kind == 'f':
+        return downcast_floats(values)
+    if kind == 'O' and pd.api.types.infer_dtype(values, skipna=True) == 'string':
+        if values.nunique() <= category_ratio * len(values):
+            return values.astype('category')
+    return values
+
+
+def _downcast_integers(values: pd.Series) -> pd.Series:
+    if values.empty:
+        return values
+
+    low, high = values.min(), values.max()
+    for dtype in _INTEGER_DTYPES:
+        if dtype().itemsize >= values.dtype.itemsize:
+            break
+        limits = np.iinfo(dtype)
+        if limits.min <= low and high <= limits.max:
+            return values.astype(dtype)
+    return values
+
@@ -1,8 +1,31 @@
+import os
 from base64 import b64encode
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 from hashlib import sha512
-from typing import List
+from typing import Iterable, Iterator, List, Optional
 
+import numpy as np
 import pandas as pd
+from pandas.api.types import is_object_dtype
+
+# Number of rows that is hashed by a single worker process at a time
+HASH_CHUNK_SIZE = 100000
+
+ENCRYPTED_IDENTIFIER = 'encrypted_identifier'
+
+# Supported formats of the encrypted identifier:
+# - 'base64': base64 encoded SHA 512 digest, same as `salthash`
+# - 'bytes': raw 64 byte SHA 512 digest. Only saves the base64 overhead: the
+#   column holds Python `bytes` objects, because pandas stores fixed-width
+#   byte strings in DataFrames as objects as well
+# - 'uint64': first 128 bits of the digest as a pair of uint64 columns
+IDENTIFIER_FORMATS = ('base64', 'bytes', 'uint64')
+UINT64_IDENTIFIER_COLUMNS = [f'{ENCRYPTED_IDENTIFIER}_0',
+                             f'{ENCRYPTED_IDENTIFIER}_1']
+
+_DIGEST_SIZE = 64
 
 
 def salthash(salt, string):
@@ -24,8 +47,47 @@ def salthash(salt, string):
     return b64encode(hashed).decode('utf-8')
 
 
+def salthash_many(salt: str, strings: List[str]) -> List[str]:
+    """
+    Hash multiple strings with the same salt. Gives the same result as
+    calling `salthash` for every string, but the salt is only hashed once:
+    it fills exactly one SHA 512 block, so the intermediate hash state can
+    be reused for every string.
+
+    Args:
+        salt (str): (random) string of length 128
+        strings (List(str)): arbitrary length strings
+    Returns:
+        (List(str)) hashed 'salt + string' for every string
+    Raises:
+        ValueError: if salt is not of length 128
+    """
+    digests = _salted_digests(salt, strings)
+    return [b64encode(digests[i:i + _DIGEST_SIZE]).decode('utf-8')
+            for i in range(0, len(digests), _DIGEST_SIZE)]
+
+
+def encrypted_identifier_columns(identifier_format: str = 'base64'
+                                 ) -> List[str]:
+    """
+    Names of the columns that hold the encrypted identifier in the given
+    format.
+
+    Args:
+        identifier_format (str): one of `IDENTIFIER_FORMATS`
+    Returns:
+        (List(str)) column names
+    """
+    _check_identifier_format(identifier_format)
+    if identifier_format == 'uint64':
+        return list(UINT64_IDENTIFIER_COLUMNS)
+    return [ENCRYPTED_IDENTIFIER]
+
+
 def encrypt_identifiers(df: pd.DataFrame, salt: str,
-                        identifiers: List[str]) -> pd.DataFrame:
+                        identifiers: List[str],
+                        n_jobs: Optional[int] = None,
+                        identifier_format: str = 'base64') -> pd.DataFrame:
     """
     Join identifiers (i.e. columns identifying a record) and hash them to
     form an encrypted identifier. Drop original identifying columns.
@@ -34,20 +96,194 @@ def encrypt_identifiers(df: pd.DataFrame, salt: str,
         df (pd.DataFrame): pandas dataframe
         salt (str): salt to be used when hashing
         identifiers (List(str)): column names of record identifiers
+        n_jobs (int): number of processes used for hashing. By default
+            hashing is done in the current process, -1 uses all cpus.
+        identifier_format (str): one of `IDENTIFIER_FORMATS`. The compact
+            'uint64' format stores the identifier in the two columns
+            `UINT64_IDENTIFIER_COLUMNS`, which use much less memory and are
+            faster to join on than strings. The 'bytes' format is an object
+            column of 64 byte digests, which is neither fixed-width nor much
+            smaller than 'base64': it only saves the base64 overhead.
 
     Returns:
         (pd.DataFrame) with the column 'encrypted_identifier' instead of the
             original identifier columns.
     """
-    def _hash_identifiers(row):
-        try:
-            identifier_values = row[identifiers]
-        except KeyError as m:
-            raise KeyError(f'One of the identifying variables is not found in '
-                           f'the dataset, see original error: {m}')
-        if any(pd.isna(identifier_values)):
-            raise ValueError('One of the identifier values is NaN or None')
-        joined_ids = ''.join(identifier_values.apply(str)).replace(' ', '')
-        return salthash(salt, joined_ids)
-    df['encrypted_identifier'] = df.apply(_hash_identifiers, axis=1)
+    _check_identifier_format(identifier_format)
+    joined_ids = _join_identifiers(df, identifiers)
+    with _hash_executor(n_jobs) as executor:
+        encrypted = _hash_identifiers(joined_ids, salt, executor,
+                                      identifier_format)
+    for name in encrypted:
+        df[name] = encrypted[name]
     return df.drop(columns=identifiers)
+
+
+def encrypt_identifiers_chunked(chunks: Iterable[pd.DataFrame], salt: str,
+                                identifiers: List[str],
+                                n_jobs: Optional[int] = None,
+                                identifier_format: str = 'base64'
+                                ) -> Iterator[pd.DataFrame]:
+    """
+    Streaming variant of `encrypt_identifiers` for tables that do not fit
+    in memory. Only one chunk is processed at a time, so memory use is
+    bounded by the chunk size.
+
+    Chunks can come from any iterator of DataFrames, for example
+    `pd.read_csv(path, chunksize=100000)` or
+    `(batch.to_pandas() for batch in ParquetFile(path).iter_batches())`.
+
+    Every chunk is modified in place: the original identifier columns are
+    dropped and the column 'encrypted_identifier' is added.
+
+    Args:
+        chunks (Iterable(pd.DataFrame)): pandas dataframes with the same
+            columns
+        salt (str): salt to be used when hashing
+        identifiers (List(str)): column names of record identifiers
+        n_jobs (int): number of processes used for hashing. By default
+            hashing is done in the current process, -1 uses all cpus.
+        identifier_format (str): one of `IDENTIFIER_FORMATS`
+
+    Returns:
+        (Iterator(pd.DataFrame)) the chunks with the column
+            'encrypted_identifier' instead of the original identifier
+            columns.
+    """
+    _check_identifier_format(identifier_format)
+    # The identifiers of all chunks are formatted like those of the first
+    # chunk, other chunks may infer other dtypes (e.g. `read_csv`)
+    row_dtype = None
+    with _hash_executor(n_jobs) as executor:
+        for chunk in chunks:
+            if row_dtype is None:
+                row_dtype = _row_dtype(chunk)
+            joined_ids = _join_identifiers(chunk, identifiers, row_dtype)
+            encrypted = _hash_identifiers(joined_ids, salt, executor,
+                                          identifier_format)
+            chunk.drop(columns=identifiers, inplace=True)
+            for name in encrypted:
+                chunk[name] = encrypted[name]
+            yield chunk
+
+
+def _join_identifiers(df: pd.DataFrame, identifiers: List[str],
+                      row_dtype=None) -> pd.Series:
+    """
+    Convert the identifier values of every record to strings and join them,
+    without spaces.
+
+    The values are formatted the same way as they would be when taking a
+    row out of `df`: when the columns of `df` share a common dtype (for
+    example int and float) the identifiers are cast to that dtype first,
+    see `_row_dtype`.
+
+    Args:
+        row_dtype: dtype of the rows, by default derived from the columns
+            of `df`
+    """
+    try:
+        identifier_df = df[identifiers]
+    except KeyError as m:
+        raise KeyError(f'One of the identifying variables is not found in '
+                       f'the dataset, see original error: {m}')
+    if identifier_df.isna().values.any():
+        raise ValueError('One of the identifier values is NaN or None')
+
+    if row_dtype is None:
+        row_dtype = _row_dtype(df)
+
+    joined_ids = np.full(len(df), '', dtype=object)
+    for name in identifiers:
+        joined_ids = joined_ids + _to_strings(df[name], row_dtype)
+
+    return pd.Series(joined_ids, index=df.index,
+                     dtype=object).str.replace(' ', '', regex=False)
+
+
+def _row_dtype(df: pd.DataFrame):
+    """
+    Common dtype of all columns of `df`, which is the dtype of its rows: the
+    dtype the columns share, the promoted dtype of numeric columns (like
+    `np.result_type`), or object.
+    """
+    dtypes = list(df.dtypes)
+    if all(dtype == dtypes[0] for dtype in dtypes):
+        return dtypes[0]
+    if all(isinstance(dtype, np.dtype) and dtype.kind in 'iuf'
+           for dtype in dtypes):
+        return np.result_type(*dtypes)
+    return np.dtype(object)
+
+
+def _to_strings(column: pd.Series, row_dtype) -> np.ndarray:
+    if not is_object_dtype(row_dtype):
+        column = column.astype(row_dtype)
+    if column.dtype.kind in 'biu':
+        # Numpy formats integers and booleans exactly like `str` does
+        return column.values.astype(str).astype(object)
+    return np.array([str(value) for value in column.astype(object)],
+                    dtype=object)
+
+
+@contextmanager
+def _hash_executor(n_jobs: Optional[int]):
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+
+    if n_jobs is None or n_jobs <= 1:
+        yield None
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            yield executor
+
+
+def _check_identifier_format(identifier_format: str):
+    if identifier_format not in IDENTIFIER_FORMATS:
+        raise ValueError(f'Unknown identifier format {identifier_format}, '
+                         f'choose one of {IDENTIFIER_FORMATS}')
+
+
+def _salted_digests(salt: str, strings: List[str]) -> bytes:
+    """
+    Concatenated SHA 512 digests of 'salt + string' for every string. The
+    salt fills exactly one SHA 512 block, so the intermediate hash state is
+    computed once and reused for every string.
+    """
+    if len(salt) != 128:
+        raise ValueError('Salt must be 128 bytes long.')
+    salted = sha512(salt.encode('utf-8'))
+
+    digests = bytearray()
+    for string in strings:
+        hashed = salted.copy()
+        hashed.update(string.encode('utf-8'))
+        digests += hashed.digest()
+    return bytes(digests)
+
+
+def _hash_identifiers(joined_ids: pd.Series, salt: str,
+                      executor: Optional[Executor] = None,
+                      identifier_format: str = 'base64') -> pd.DataFrame:
+    strings = joined_ids.tolist()
+
+    if executor is None or len(strings) <= HASH_CHUNK_SIZE:
+        digests = _salted_digests(salt, strings)
+    else:
+        chunks = [strings[i:i + HASH_CHUNK_SIZE]
+                  for i in range(0, len(strings), HASH_CHUNK_SIZE)]
+        digests = b''.join(executor.map(partial(_salted_digests, salt),
+                                        chunks))
+
+    if identifier_format == 'uint64':
+        values = np.frombuffer(digests, dtype='<u8').reshape(-1, 8)[:, :2]
+        values = values.copy()
+        return pd.DataFrame(values, index=joined_ids.index,
+                            columns=UINT64_IDENTIFIER_COLUMNS)
+
+    hashes = [digests[i:i + _DIGEST_SIZE]
+              for i in range(0, len(digests), _DIGEST_SIZE)]
+    if identifier_format == 'base64':
+        hashes = [b64encode(h).decode('utf-8') for h in hashes]
+    return pd.DataFrame({ENCRYPTED_IDENTIFIER: pd.Series(
+        hashes, index=joined_ids.index, dtype=object)})
@@ -0,0 +1,381 @@
+"""
+Multi-way inner join of the datasets of multiple nodes.
+
+Instead of folding `pd.merge` pairwise over all datasets, which copies the
+growing intermediate table and hashes the join keys again in every step, the
+join keys of all datasets are factorized once into integer codes. The key
+sets are intersected on those codes and every dataset is gathered by position
+in a single pass. The cost grows with the total number of rows instead of
+with the number of datasets times the size of the intermediate table.
+
+The result is the same as the one of successive inner `pd.merge` calls
+without suffixes. When the join cannot be expressed with a single set of
+keys (for example because inferred keys differ between datasets) the
+pairwise merge is used.
+
+`IncrementalJoin` computes the same join while the datasets arrive one by
+one, so the join can overlap with waiting for the remaining datasets.
+"""
+from functools import reduce
+from typing import Dict, Hashable, List, Optional, Sequence, Union
+
+import numpy as np
+import pandas as pd
+
+from . import encryption
+
+Keys = Union[str, Sequence[str], None]
+
+
+def merge_inner(df_list: List[pd.DataFrame], on: Keys = None) -> pd.DataFrame:
+    """
+    Inner join all DataFrames in `df_list` on the columns `on`.
+
+    :param df_list: DataFrames to join
+    :param on: column name or list of column names to join on. When `None`, the columns that the datasets have in
+               common are used, just like `pd.merge` does.
+    :return: the joined DataFrame
+    """
+    if len(df_list) == 1:
+        return df_list[0]
+
+    keys = join_keys(df_list, on)
+    if keys is None:
+        return merge_pairwise(df_list, on)
+
+    indices = _join_indices(factorize_keys(df_list, keys))
+    return _gather(df_list, keys, indices)
+
+
+class IncrementalJoin:
+    """
+    Inner join of datasets that arrive one at a time, in any order. Every dataset is joined with the keys of the
+    datasets that arrived before it as soon as it is added, only the final gathering of the columns waits for the
+    last dataset.
+
+    The result is the same as `merge_inner` of the datasets ordered by their id. When the datasets can not be joined
+    on a single set of keys, they are kept and joined by `merge_inner` at the end.
+    """
+
+    def __init__(self, on: Keys):
+        self.on = on
+        self.frames: Dict[Hashable, pd.DataFrame] = {}
+        self._keys = None
+        self._key_frame = None
+        self._value_columns = set()
+        # Positions of the records of every dataset in the join so far
+        self._indices: Dict[Hashable, np.ndarray] = {}
+        self._fallback = on is None
+
+    def add(self, dataset_id: Hashable, df: pd.DataFrame):
+        """
+        Join a dataset with the datasets that were added before.
+
+        :param dataset_id: Sortable id of the dataset, which determines its position in the result
+        :param df: the dataset
+        """
+        self.frames[dataset_id] = df
+        if self._fallback:
+            return
+
+        keys = resolve_keys([df], self.on)
+        keys = [keys] if isinstance(keys, str) else list(keys)
+        if not self._can_join(df, keys):
+            self._fallback = True
+            return
+
+        if self._key_frame is None:
+            self._keys = keys
+            self._key_frame = df[keys].reset_index(drop=True)
+            self._indices[dataset_id] = np.arange(len(df))
+        else:
+            previous, current = _join_indices(factorize_keys([self._key_frame, df], keys))
+            self._key_frame = self._key_frame.take(previous).reset_index(drop=True)
+            self._indices = {i: idx[previous] for i, idx in self._indices.items()}
+            self._indices[dataset_id] = current
+
+        self._value_columns.update(c for c in df.columns if c not in keys)
+
+    def size(self) -> Optional[int]:
+        """
+        Number of records of the join of the datasets added so far, see `expected_size`.
+        """
+        if self._fallback:
+            frames = self._ordered_frames()
+            return expected_size(frames, resolve_keys(frames, self.on)) if frames else 0
+        return len(self._key_frame) if self._key_frame is not None else 0
+
+    def result(self) -> pd.DataFrame:
+        """
+        Gather the joined table of all datasets that were added.
+        """
+        frames = self._ordered_frames()
+        if self._fallback:
+            return merge_inner(frames, resolve_keys(frames, self.on))
+        if len(frames) == 1:
+            return frames[0]
+
+        dataset_ids = sorted(self.frames)
+        indices = [self._indices[i] for i in dataset_ids]
+
+        # Restore the order of `merge_inner`: by order of first appearance of the key in the first dataset, then by
+        # position in every dataset
+        first_codes = factorize_keys([frames[0]], self._keys)[0][indices[0]]
+        order = np.lexsort(indices[::-1] + [first_codes])
+        return _gather(frames, self._keys, [idx[order] for idx in indices])
+
+    def _ordered_frames(self) -> List[pd.DataFrame]:
+        return [self.frames[i] for i in sorted(self.frames)]
+
+    def _can_join(self, df: pd.DataFrame, keys: List[str]) -> bool:
+        """
+        Same conditions as `join_keys`, missing keys are not allowed in any dataset because it is not known yet which
+        dataset comes first.
+        """
+        if not df.columns.is_unique or not set(keys).issubset(df.columns) or df[keys].isna().values.any():
+            return False
+        if self._key_frame is None:
+            return True
+        if keys != self._keys or (df[keys].dtypes != self._key_frame.dtypes).any():
+            return False
+        return not self._value_columns.intersection(c for c in df.columns if c not in keys)
+
+
+def linking_keys(df_list: List[pd.DataFrame], on: Keys) -> pd.DataFrame:
+    """
+    Find the keys that link records across all datasets.
+
+    A key links when it occurs exactly once in every dataset. Keys that occur multiple times in one of the datasets
+    would produce duplicate records in the inner join, which are dropped before analysis anyway.
+
+    :param df_list: DataFrames containing (at least) the key columns
+    :param on: column name or list of column names of the keys
+    :return: DataFrame with the linking keys, in order of appearance in the first dataset
+    """
+    keys = [on] if isinstance(on, str) else list(on)
+    codes = factorize_keys(df_list, keys)
+    n_keys = int(codes[0].max()) + 1 if len(codes[0]) else 0
+
+    linked = np.ones(n_keys, dtype=bool)
+    for c in codes:
+        linked &= np.bincount(c[c >= 0], minlength=n_keys) == 1
+
+    first_codes = codes[0]
+    rows = np.flatnonzero(first_codes >= 0)
+    rows = rows[linked[first_codes[rows]]]
+    return df_list[0][keys].iloc[rows].reset_index(drop=True)
+
+
+def drop_duplicate_keys(df: pd.DataFrame, on: Keys) -> pd.DataFrame:
+    """
+    Drop all records whose key occurs more than once. In an inner join these records would produce duplicate keys,
+    which are removed before analysis anyway, and they can make the join grow many-to-many.
+    """
+    keys = [on] if isinstance(on, str) else list(on)
+    return df[~df.duplicated(subset=keys, keep=False)]
+
+
+def expected_size(df_list: List[pd.DataFrame], on: Keys = None) -> Optional[int]:
+    """
+    Number of records of the inner join of all datasets, computed from histograms of the keys without performing
+    the join. For every key this is the product of the number of times the key occurs in every dataset.
+
+    :return: the number of records, or `None` if the datasets cannot be joined on a single set of keys (see
+             `join_keys`)
+    """
+    if len(df_list) == 1:
+        return len(df_list[0])
+
+    keys = join_keys(df_list, on)
+    if keys is None:
+        return None
+
+    codes = factorize_keys(df_list, keys)
+    n_keys = int(codes[0].max()) + 1 if len(codes[0]) else 0
+
+    # Floats, because the product of the key multiplicities can exceed the range of integers
+    sizes = np.ones(n_keys)
+    for c in codes:
+        sizes *= np.bincount(c[c >= 0], minlength=n_keys)
+    return int(sizes.sum())
+
+
+def select_keys(df: pd.DataFrame, keys: pd.DataFrame) -> pd.Series:
+    """
+    Boolean mask of the rows of `df` whose key is one of the rows of `keys`. The key columns are the columns of
+    `keys`.
+    """
+    columns = list(keys.columns)
+    if len(columns) == 1:
+        return df[columns[0]].isin(keys[columns[0]])
+
+    mask = pd.MultiIndex.from_frame(df[columns]).isin(pd.MultiIndex.from_frame(keys))
+    return pd.Series(mask, index=df.index)
+
+
+def merge_pairwise(df_list: List[pd.DataFrame], on: Keys = None) -> pd.DataFrame:
+    """
+    Reference implementation of the join: fold `pd.merge` over all DataFrames.
+    """
+    return reduce(lambda left, right: pd.merge(left, right, on=on, how='inner', suffixes=(False, False)), df_list)
+
+
+def resolve_keys(df_list: List[pd.DataFrame], on: Keys) -> Keys:
+    """
+    Nodes can send the encrypted identifier in the compact 'uint64' format (see `encryption.IDENTIFIER_FORMATS`),
+    which is stored in two integer columns. When all datasets use that format, the key 'encrypted_identifier' is
+    replaced by these integer columns so that the join does not need to hash long strings.
+    """
+    if on is None:
+        return None
+
+    keys = [on] if isinstance(on, str) else list(on)
+    if encryption.ENCRYPTED_IDENTIFIER not in keys:
+        return on
+
+    compact_columns = encryption.UINT64_IDENTIFIER_COLUMNS
+    if all(set(compact_columns).issubset(df.columns) and encryption.ENCRYPTED_IDENTIFIER not in df.columns
+           for df in df_list):
+        idx = keys.index(encryption.ENCRYPTED_IDENTIFIER)
+        return keys[:idx] + compact_columns + keys[idx + 1:]
+
+    return on
+
+
+def join_keys(df_list: List[pd.DataFrame], on: Keys = None) -> Optional[List[str]]:
+    """
+    Determine the list of key columns that can be used to join all datasets at once.
+
+    Returns `None` when that is not possible and the datasets have to be merged pairwise. This happens when the keys
+    are inferred and differ between join steps, when key columns are missing or have different dtypes, when the keys of
+    the first dataset contain missing values, or when non-key columns overlap.
+    """
+    if on is None:
+        keys = _infer_keys(df_list)
+    else:
+        keys = [on] if isinstance(on, str) else list(on)
+
+    if not keys:
+        return None
+
+    for df in df_list:
+        if not df.columns.is_unique or not set(keys).issubset(df.columns):
+            return None
+
+    # Missing keys only need to be checked in the first dataset: missing keys in the other datasets can not match
+    # any of its keys
+    first = df_list[0]
+    if first[keys].isna().values.any():
+        return None
+
+    if any((df[keys].dtypes != first[keys].dtypes).any() for df in df_list[1:]):
+        return None
+
+    non_key_columns = [c for df in df_list for c in df.columns if c not in keys]
+    if len(non_key_columns) != len(set(non_key_columns)):
+        return None
+
+    return keys
+
+
+def factorize_keys(df_list: List[pd.DataFrame], keys: List[str]) -> List[np.ndarray]:
+    """
+    Encode the join keys of every dataset as integer codes that are shared between the datasets. Codes refer to the
+    unique keys of the first dataset, in order of first appearance. Keys that do not occur in the first dataset can
+    never be part of the inner join and get code -1.
+    """
+    first, others = df_list[0], df_list[1:]
+    codes = None
+    for key in keys:
+        key_codes, uniques = pd.factorize(first[key])
+        uniques = pd.Index(uniques)
+        other_key_codes = [uniques.get_indexer(df[key]) for df in others]
+
+        if codes is None:
+            codes, other_codes = key_codes, other_key_codes
+        else:
+            # Combine with the codes of the previous key columns and number the combinations again, to keep the
+            # codes small
+            codes, combinations = pd.factorize(codes * len(uniques) + key_codes)
+            combinations = pd.Index(combinations)
+            other_codes = [_combine_codes(combinations, c, k, len(uniques))
+                           for c, k in zip(other_codes, other_key_codes)]
+
+    return [codes] + other_codes
+
+
+def _gather(df_list: List[pd.DataFrame], keys: List[str], indices: List[np.ndarray]) -> pd.DataFrame:
+    """
+    Build the joined table from the positions of the records of every dataset. The key columns are taken from the
+    first dataset.
+    """
+    columns = [df_list[0].take(indices[0])]
+    for df, idx in zip(df_list[1:], indices[1:]):
+        value_positions = [i for i, column in enumerate(df.columns) if column not in keys]
+        columns.append(df.iloc[idx, value_positions])
+
+    for frame in columns:
+        frame.index = pd.RangeIndex(len(indices[0]))
+
+    return pd.concat(columns, axis=1, copy=False)
+
+
+def _combine_codes(combinations: pd.Index, codes: np.ndarray, key_codes: np.ndarray, n_uniques: int) -> np.ndarray:
+    missing = (codes < 0) | (key_codes < 0)
+    combined = combinations.get_indexer(codes * n_uniques + key_codes)
+    combined[missing] = -1
+    return combined
+
+
+def _infer_keys(df_list: List[pd.DataFrame]) -> Optional[List[str]]:
+    """
+    Infer the keys like successive `pd.merge` calls would: at every step the join keys are the columns that the
+    intermediate result and the next dataset have in common. Returns `None` if these differ between steps.
+    """
+    columns = df_list[0].columns
+    keys = None
+    for df in df_list[1:]:
+        common = list(columns.intersection(df.columns))
+        if keys is not None and common != keys:
+            return None
+        keys = common
+        columns = columns.append(df.columns.difference(keys, sort=False))
+    return keys
+
+
+def _join_indices(codes: List[np.ndarray]) -> List[np.ndarray]:
+    """
+    Compute, for every dataset, the positions of its rows in the inner join of all datasets.
+
+    Rows are grouped by key, in order of first appearance in the first dataset. Within a key the rows form the
+    cartesian product of the matching rows of every dataset, with the first dataset varying slowest.
+    """
+    n_keys = int(codes[0].max()) + 1 if len(codes[0]) else 0
+
+    rows = [np.flatnonzero(c >= 0) for c in codes]
+    codes = [c[r] for c, r in zip(codes, rows)]
+
+    counts = [np.bincount(c, minlength=n_keys) for c in codes]
+    linked = np.flatnonzero(np.logical_and.reduce([count > 0 for count in counts]))
+
+    sizes = np.ones(len(linked), dtype=np.int64)
+    for count in counts:
+        sizes *= count[linked]
+
+    total = int(sizes.sum())
+    key_of_row = np.repeat(np.arange(len(linked)), sizes)
+    remaining = np.arange(total) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    inner_size = sizes[key_of_row]
+
+    indices = []
+    for c, r, count in zip(codes, rows, counts):
+        order = r[np.argsort(c, kind='stable')]
+        starts = np.cumsum(count) - count
+
+        inner_size = inner_size // count[linked][key_of_row]
+        digit = remaining // inner_size
+        remaining = remaining % inner_size
+
+        indices.append(order[starts[linked][key_of_row] + digit])
+
+    return indices
@@ -7,31 +7,109 @@ node just the same as any other method.
 When a return statement is reached the result is send to the central
 server after encryption.
 """
+import asyncio
+import operator
+import os
+import random
 import time
-from functools import reduce
-from itertools import chain
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, reduce
+from itertools import chain, count
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
 
+import numpy as np
 import pandas as pd
 from sklearn import metrics
 from sklearn.model_selection import train_test_split
 from sklearn.pipeline import Pipeline
 from vantage6.client import ContainerClient
+from vantage6.common import base64s_to_bytes
 from vantage6.tools.util import info
 import traceback
-from . import pipeline
-
-NUM_TRIES = 40
+from . import cache, join, pipeline, sketches, spill, statistics, transfer
+
+# Maximum number of status checks of a task, None means that only the timeout applies
+NUM_TRIES = None
+# Maximum number of seconds to wait for the results of a task
+TIMEOUT = 3600
+# Status checks start after POLL_INTERVAL seconds, the interval grows by BACKOFF_FACTOR up to MAX_POLL_INTERVAL
+POLL_INTERVAL = 0.05
+MAX_POLL_INTERVAL = 5
+BACKOFF_FACTOR = 2
+# Maximum number of tasks that `_run_async` has in flight at the same time
+MAX_CONCURRENT_TASKS = 4
 TOKEN_FILE = 'TOKEN_FILE'
 RANDOM_SEED = 5
 MIN_RECORDS = 100
+# Maximum estimated size in bytes of the joined table of all node data, None means no limit
+MEMORY_BUDGET = None
+# Number of records that is used to estimate the size of a record
+ROW_SIZE_SAMPLE = 1000
+# Results of tasks that are dispatched with `use_cache=True` are reused for CACHE_TTL seconds. The cache holds up to
+# CACHE_MAX_BYTES in memory and, if CACHE_DIR is set (for example to a mounted volume), the same amount on disk. Every
+# master task runs in a new container, so only results on disk are reused by later tasks, see `_get_result_cache`.
+CACHE_TTL = 600
+CACHE_MAX_BYTES = 2 ** 30
+CACHE_DIR = None
+# Environment variables that override CACHE_DIR, CACHE_TTL and CACHE_MAX_BYTES
+RESULT_CACHE_DIR = 'RESULT_CACHE_DIR'
+RESULT_CACHE_TTL = 'RESULT_CACHE_TTL'
+RESULT_CACHE_MAX_BYTES = 'RESULT_CACHE_MAX_BYTES'
+# Arrow results of nodes (see `transfer`) are written to RESULT_DIR and memory mapped, so their data is paged in from
+# disk instead of staying on the heap. None reads them in place from the received bytes.
+RESULT_DIR = None
+# The out-of-core join (`out_of_core=True`) spills node data to SPILL_PARTITIONS partitions in a temporary directory in
+# SPILL_DIR, None uses the default temporary directory
+SPILL_DIR = None
+SPILL_PARTITIONS = 16
+
+_result_cache = None
+
+
+class Quorum(NamedTuple):
+    """
+    Policy for continuing without organizations that are slow or do not respond at all.
+
+    When `partial_timeout` seconds have passed since the task was dispatched (or the timeout of the task, whichever
+    comes first), the master stops waiting. It continues with the organizations that returned results if
+    `allow_partial` is set and at least `min_organizations` organizations responded. The organizations that were left
+    out are reported in the log. Otherwise a `TimeoutError` listing the missing organizations is raised.
+    """
+    min_organizations: int = 1
+    partial_timeout: Optional[float] = None
+    allow_partial: bool = True
 
+    def accepts(self, n_results: int) -> bool:
+        return self.allow_partial and n_results >= self.min_organizations
 
-def _dispatch_tasks(client: ContainerClient, data, method, *args, exclude_orgs=(), **kwargs):
+
+def _dispatch_tasks(client: ContainerClient, data, method, *args, exclude_orgs=(), rpc_kwargs=None, on_result=None,
+                    **kwargs):
     """
     Generic master algorithm
+
+    :param rpc_kwargs: Keyword arguments that are passed to the method on the nodes
+    :param on_result: Function that is called with the organization id and the result of every organization as soon
+                      as that result is available. The results are then not kept, and None is returned, so every
+                      result can be freed as soon as the function is done with it.
+    :param quorum: `Quorum`, or dict with its fields, that allows continuing without some of the organizations. Only
+                   the results of the organizations that responded in time are returned.
+    :param query: SPARQL query that the nodes run to obtain their data
+    :param page_size: Let the nodes fetch the result of the query in pages of this many rows
+    :param output_format: Format in which the nodes send their results, `arrow` sends DataFrames as Arrow IPC files
+                          that are read without unpickling, see `transfer.write`
+    :param compression: Compression of Arrow results, `lz4` or `zstd`. Defaults to `zstd` when `batch_rows` is set.
+    :param batch_rows: Let the nodes send DataFrames as record batches of at most this many rows, which are returned
+                       as `transfer.RecordBatches` and read one batch at a time
+    :param use_cache: Reuse the results of an earlier task with the same method, input and organizations, see
+                      `_get_result_cache`. Only complete sets of results are cached.
+    :param cache_dir: Directory of the on-disk tier of the cache, see `_get_result_cache`
+    :return: The results in order of organization id, or None when `on_result` is given
     """
     tries = kwargs.get('tries', NUM_TRIES)
+    timeout = kwargs.get('timeout', TIMEOUT)
+    quorum = _as_quorum(kwargs.get('quorum'))
+    use_cache = kwargs.get('use_cache', False)
 
     # Get all organizations (ids) that are within the collaboration
     # FlaskIO knows the collaboration to which the container belongs
@@ -46,12 +124,40 @@ def _dispatch_tasks(client: ContainerClient, data, method, *args, exclude_orgs=(
 
     info(f'Dispatching task to organizations with ids {ids}.\n{exclude_orgs} will be excluded.')
 
+    if quorum is not None and len(ids) < quorum.min_organizations:
+        raise ValueError(f'Task can only be dispatched to {len(ids)} organizations, the quorum requires at least '
+                         f'{quorum.min_organizations}')
+
     # The input for the algorithm is the same for all organizations
     # in this case
     info("Defining input parameters")
     input_ = {
         "method": method,
     }
+    if rpc_kwargs:
+        input_["kwargs"] = rpc_kwargs
+    for field in ('query', 'page_size', 'output_format', 'batch_rows'):
+        if kwargs.get(field) is not None:
+            input_[field] = kwargs[field]
+    compression = kwargs.get('compression', 'zstd' if kwargs.get('batch_rows') else None)
+    if compression is not None:
+        input_['compression'] = compression
+
+    if use_cache:
+        key = cache.make_key(method, input_, ids)
+        results = _get_result_cache(kwargs.get('cache_dir')).get(key)
+        if results is not None:
+            info(f'Using cached results of {method}')
+            if on_result is None:
+                return results
+            for organization_id, result in zip(sorted(ids), results):
+                on_result(organization_id, result)
+            return None
+
+        # The results are collected for the cache, also when `on_result` consumes them
+        received = {}
+        consume = on_result
+        on_result = _chain_callbacks(received.__setitem__, on_result)
 
     # create a new task for all organizations in the collaboration.
     info("Dispatching node-tasks")
@@ -60,31 +166,202 @@ def _dispatch_tasks(client: ContainerClient, data, method, *args, exclude_orgs=(
         organization_ids=list(ids)
     )
 
-    return _get_results(client, tries, task)
+    results = _get_results(client, tries, task, method=method, timeout=timeout, on_result=on_result, quorum=quorum)
+    if use_cache:
+        # Cached results are in order of organization id
+        results = [received[organization_id] for organization_id in sorted(received)]
+        if len(received) == len(ids):
+            _get_result_cache(kwargs.get('cache_dir')).put(key, method, results)
+        if consume is not None:
+            return None
+    return results
 
 
-def _get_results(client, tries, task):
+def _get_results(client, tries, task, method=None, timeout=None, on_result: Callable[[int, Any], None] = None,
+                 quorum: Quorum = None):
     """
-    Check up to n times if a task has completed, return the results if possible. Otherwise, raise an exception.
+    Wait until a task has completed and return the results. Raise a `TimeoutError` when the task has not completed
+    within `tries` status checks or `timeout` seconds.
+
+    :param on_result: Function that is called with the organization id and the result of every organization as soon
+                      as that result is available, see `_iter_results`. The results are then not kept and None is
+                      returned.
+    :param quorum: Policy for continuing without some of the organizations, see `Quorum`
     """
-    # Wait for node to return results. Instead of polling it is also
-    # possible to subscribe to a websocket channel to get status
-    # updates
-    info("Waiting for results")
+    if on_result is not None:
+        for organization_id, result in _iter_results(client, task, tries, timeout, method, quorum):
+            on_result(organization_id, result)
+            # Do not hold on to the result while waiting for the other organizations
+            del result
+        return None
+
+    if quorum is not None:
+        results = {}
+        for organization_id, result in _iter_results(client, task, tries, timeout, method, quorum):
+            results[organization_id] = result
+        return [results[organization_id] for organization_id in sorted(results)]
+
     task_id = task.get("id")
-    for r in range(tries):
+    info("Waiting for results")
+    for _ in _poll(tries, timeout, f'Task timeout for master function {method}\ntask id: {task_id}'):
         task = client.get_task(task_id)
         if task.get('complete'):
             break
 
-        info("Waiting for results")
-        time.sleep(1)
-    # Raise Exception if task has still not completed
-    if not task.get('complete'):
-        raise Exception(f'Task timeout for master function column names\ntask id: {task_id}')
     info("Obtaining results")
-    results = client.get_results(task_id=task.get("id"))
-    return results
+    # Not `client.get_results`, which can only unpickle results
+    results = client.request(f'task/{task_id}/result')
+    return [_decode_result(result) for result in results]
+
+
+def _iter_results(client, task, tries=None, timeout=None, method=None, quorum: Quorum = None
+                  ) -> Iterator[Tuple[int, Any]]:
+    """
+    Yield the organization id and result of every organization of a task as soon as that result is available.
+    Raise a `TimeoutError` when not all results are available within `tries` status checks or `timeout` seconds,
+    unless the `quorum` allows continuing without the missing organizations.
+    """
+    task_id = task.get("id")
+    if quorum is not None and quorum.partial_timeout is not None:
+        timeout = quorum.partial_timeout if timeout is None else min(timeout, quorum.partial_timeout)
+
+    received = set()
+    open_results = []
+    try:
+        for _ in _poll(tries, timeout, f'Task timeout for master function {method}\ntask id: {task_id}'):
+            # The task only links to its results, and open results have no payload yet. Every finished result is
+            # downloaded once.
+            task = client.get_task(task_id)
+            result_ids = [r['id'] for r in task.get('results', [])]
+            open_results = [] if task.get('complete') else client.request(
+                'result', params={'task_id': task_id, 'state': 'open'})
+            open_ids = {r['id'] for r in open_results}
+            for result_id in result_ids:
+                if result_id in received or result_id in open_ids:
+                    continue
+                result = client.request(f'result/{result_id}')
+                received.add(result_id)
+                yield _organization_id(result), _decode_result(result)
+                del result
+
+            if result_ids and len(received) == len(result_ids):
+                return
+    except TimeoutError as e:
+        missing = [_organization_id(r) for r in open_results]
+        if quorum is None or not quorum.accepts(len(received)):
+            raise TimeoutError(f'{e}\nOrganizations {missing} did not respond in time, {len(received)} organizations '
+                               f'did') from e
+        info(f'Organizations {missing} did not respond in time and are left out of {method}')
+
+
+def _decode_result(result: dict) -> Any:
+    return transfer.decode(base64s_to_bytes(result.get('result')), directory=RESULT_DIR)
+
+
+def _poll(tries: Optional[int], timeout: Optional[float], message: str) -> Iterator[int]:
+    """
+    Yield every time a status check is due, until the caller stops iterating. Checks are spaced by exponentially
+    growing intervals with random jitter, so short tasks are picked up quickly and long tasks do not flood the server.
+    Raise a `TimeoutError` when the caller did not stop after `tries` checks or `timeout` seconds.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    interval = POLL_INTERVAL
+    for attempt in count(1):
+        yield attempt
+
+        remaining = float('inf') if deadline is None else deadline - time.monotonic()
+        if (tries is not None and attempt >= tries) or remaining <= 0:
+            raise TimeoutError(message)
+
+        # Equal jitter: sleep between half and the full interval
+        time.sleep(min(interval * random.uniform(0.5, 1), remaining))
+        interval = min(interval * BACKOFF_FACTOR, MAX_POLL_INTERVAL)
+
+
+def _get_result_cache(directory: Optional[str] = None) -> cache.ResultCache:
+    """
+    Cache of task results that is shared by all master algorithms in this container.
+
+    Every master task runs in a new container, so results in memory are only reused within one run, for example by
+    the subtasks of one analysis. Results on disk are reused by later master tasks when the directory outlives the
+    container, for example on a mounted volume. The directory is `directory` (the `cache_dir` input of a master
+    algorithm), the `RESULT_CACHE_DIR` environment variable or `CACHE_DIR`, in that order.
+    """
+    global _result_cache
+    directory = directory or os.environ.get(RESULT_CACHE_DIR) or CACHE_DIR
+    if _result_cache is None or _result_cache.directory != directory:
+        ttl = float(os.environ[RESULT_CACHE_TTL]) if RESULT_CACHE_TTL in os.environ else CACHE_TTL
+        max_bytes = int(os.environ.get(RESULT_CACHE_MAX_BYTES, CACHE_MAX_BYTES))
+        _result_cache = cache.ResultCache(ttl=ttl, max_bytes=max_bytes, directory=directory)
+    return _result_cache
+
+
+def _chain_callbacks(collect: Callable[[int, Any], None], on_result: Optional[Callable[[int, Any], None]]):
+    def callback(organization_id, result):
+        collect(organization_id, result)
+        if on_result is not None:
+            on_result(organization_id, result)
+    return callback
+
+
+def _as_quorum(quorum: Union[Quorum, dict, None]) -> Optional[Quorum]:
+    # Quorum policies that are passed by the researcher arrive as dict
+    if isinstance(quorum, dict):
+        return Quorum(**quorum)
+    return quorum
+
+
+async def _call_async(func: Callable, *args, **kwargs):
+    """
+    Run a blocking function, such as `_dispatch_tasks`, in the executor of the event loop. Subtasks that do not
+    depend on each other can then be in flight at the same time, see `_run_async`.
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, partial(func, *args, **kwargs))
+
+
+async def _dispatch_tasks_async(client: ContainerClient, data, method, *args, **kwargs):
+    """
+    Asynchronous version of `_dispatch_tasks`.
+    """
+    return await _call_async(_dispatch_tasks, client, data, method, *args, **kwargs)
+
+
+def _run_async(*coroutines, max_concurrent: int = None) -> list:
+    """
+    Run coroutines, such as `_dispatch_tasks_async` calls, concurrently and return their results in order. The
+    executor has `max_concurrent` threads, defaulting to `MAX_CONCURRENT_TASKS`, so at most that many blocking calls
+    are in flight at a time.
+    """
+    async def gather():
+        return await asyncio.gather(*coroutines)
+
+    loop = asyncio.new_event_loop()
+    with ThreadPoolExecutor(max_workers=max_concurrent or MAX_CONCURRENT_TASKS) as executor:
+        loop.set_default_executor(executor)
+        try:
+            return loop.run_until_complete(gather())
+        finally:
+            loop.close()
+
+
+def _organization_id(result: dict) -> int:
+    organization = result.get('organization')
+    return organization.get('id') if isinstance(organization, dict) else organization
+
+
+def invalidate_cache(client: ContainerClient, data, *args, method: str = None, cache_dir: str = None, **kwargs):
+    """Master algorithm.
+
+    Remove cached results of `method`, or all cached results when no method is given, from the cache directory (see
+    `_get_result_cache`). This master task runs in a new container, so there are no results in memory to remove.
+    """
+    result_cache = _get_result_cache(cache_dir)
+    result_cache.invalidate(method)
+    if result_cache.directory is None:
+        info('No cache directory is configured, only results in memory of this container were invalidated')
+    else:
+        info(f'Invalidated cached results of {method or "all methods"} in {result_cache.directory}')
 
 
 def column_names(client: ContainerClient, data, *args, exclude_orgs=(), **kwargs):
@@ -104,7 +381,8 @@ def column_names(client: ContainerClient, data, *args, exclude_orgs=(), **kwargs
     return column_set
 
 
-def correlation_matrix(client: ContainerClient, data, merge_keys=None, *args, **kwargs):
+def correlation_matrix(client: ContainerClient, data, merge_keys=None, *args, horizontal=False, method='pearson',
+                       dtype='float64', out_of_core=False, **kwargs):
     """
     Compute a correlation matrix over all datasets together. Data will be joined using the specified key. Right now
     the datasets are merged using outer join, which means that keys without matches will get empty values for the
@@ -114,14 +392,74 @@ def correlation_matrix(client: ContainerClient, data, merge_keys=None, *args, **
 
     If no keys are specified the datasets are joined on all columns with the same name.
     TODO: What if different datasets use different keys to mean the same thing? How do we specify this?
+
+    Keyword arguments such as `two_phase`, `columns` and `where` are passed on to `_combine_all_node_data`.
+
+    :param horizontal: The nodes hold different records with the same columns instead of different columns of the same
+                       records. The records are not joined but stacked. No records are retrieved: every node sends
+                       sufficient statistics from which the exact correlation matrix is computed. Only supports
+                       the 'pearson' method.
+    :param method: 'pearson' or 'spearman'
+    :param dtype: Precision of the computation, 'float32' is faster and uses less memory
+    :param out_of_core: Join the data on disk for cohorts that do not fit in memory, see `_iter_combined_node_data`.
+                        The correlation matrix is computed from sufficient statistics of the joined chunks, so only
+                        the 'pearson' method is supported. Requires `merge_keys`.
     """
+    if horizontal or out_of_core:
+        if method != 'pearson':
+            raise ValueError(f'The {method} correlation can not be computed from sufficient statistics')
+    if horizontal:
+        return _horizontal_correlation_matrix(client, data, *args, **kwargs)
+    if out_of_core:
+        chunks = _iter_combined_node_data(client, data, merge_keys, *args, **kwargs)
+        return statistics.CorrelationStatistics.from_batches(chunks).correlation()
+
     combined_df = _combine_all_node_data(client, data, merge_keys, *args, **kwargs)
 
-    return combined_df.corr()
+    return statistics.correlation_matrix(combined_df, method=method, dtype=dtype)
+
+
+def _horizontal_correlation_matrix(client: ContainerClient, data, *args, **kwargs) -> pd.DataFrame:
+    combined = None
+
+    def add_statistics(organization_id, result):
+        # Add up the statistics as they arrive
+        nonlocal combined
+        node_statistics = statistics.CorrelationStatistics.from_dict(result)
+        combined = node_statistics if combined is None else combined + node_statistics
+
+    _dispatch_tasks(client, data, 'correlation_statistics', *args, on_result=add_statistics, **kwargs)
+    n_records = combined.n_records if combined is not None else 0
+    info(f'Combined correlation statistics of {n_records} records')
+
+    if n_records < MIN_RECORDS:
+        raise ValueError(f'Only {n_records} records available for analysis! Privacy is not ensured.')
+
+    return combined.correlation()
+
+
+def estimate_overlap(client: ContainerClient, data, merge_keys, *args, precision=14, **kwargs):
+    """
+    Estimate how many records can be linked between the datasets, without retrieving any records. Every node sends a
+    HyperLogLog sketch of its merge keys, see `sketches.estimate_overlap` for the returned estimates.
+
+    :param client: Client for accessing Vantage6 proxy server. Is a parameter for all master algorithms
+    :param data: Data from datastation as Pandas DataFrame. Is handled by wrapper
+    :param merge_keys: The identifying fields for joining datasets.
+    :param precision: Precision of the sketches, between 4 and 18. Higher precision gives more accurate estimates
+                      but larger sketches.
+    :return: dict with the estimated number of distinct keys per dataset, per pair of datasets and in all datasets
+    """
+    rpc_kwargs = {'merge_keys': merge_keys, 'precision': precision}
+    results = _dispatch_tasks(client, data, 'key_sketch', *args, rpc_kwargs=rpc_kwargs, **kwargs)
+
+    overlap = sketches.estimate_overlap([sketches.HyperLogLog.from_bytes(r) for r in results])
+    info(f'Estimated number of linked records: {overlap["intersection"]:.0f}')
+    return overlap
 
 
 def fit_pipeline(client: ContainerClient, data, pipe: Pipeline, features: List[str], target: str,
-                 merge_keys=None, *args, **kwargs):
+                 merge_keys=None, *args, out_of_core=False, **kwargs):
     """
     Retrieve data from nodes and train data analysis pipeline on it. Returns the performance of the resulting model.
     TODO: How and where do we save our model?
@@ -133,6 +471,8 @@ def fit_pipeline(client: ContainerClient, data, pipe: Pipeline, features: List[s
     :param features: The features that should be used in the fitting of the pipeline.
     :param target: The field that should be used as target for the machine learning algorithm.
     :param merge_keys: The identifying fields for joining datasets.
+    :param out_of_core: Join the data on disk for cohorts that do not fit in memory, see `_iter_combined_node_data`.
+                        Only the features and the target of the joined records are kept in memory.
     :param args:
     :param kwargs:
     :return:
@@ -140,10 +480,20 @@ def fit_pipeline(client: ContainerClient, data, pipe: Pipeline, features: List[s
     pipe = pipeline.reconstruct_pipeline(pipe)
     try:
         info(f'Training pipeline with the following steps: {pipe.named_steps}')
-        results = _combine_all_node_data(client, data, merge_keys, *args, **kwargs)
-
-        X = results[features].values
-        y = results[target].values
+        # Only the features and the target are retrieved
+        columns = list(features) + [target]
+        if out_of_core:
+            X, y = [], []
+            for chunk in _iter_combined_node_data(client, data, merge_keys, *args, columns=columns, **kwargs):
+                X.append(chunk[features].to_numpy(dtype=np.float64))
+                y.append(chunk[target].to_numpy(dtype=np.float64))
+            X, y = np.concatenate(X), np.concatenate(y)
+        else:
+            results = _combine_all_node_data(client, data, merge_keys, *args, columns=columns, **kwargs)
+
+            # The joined table can have optimized dtypes, the pipeline is trained on 64 bit values
+            X = results[features].to_numpy(dtype=np.float64)
+            y = results[target].to_numpy(dtype=np.float64)
 
         # Split data
         # TODO: Make splitting of dataset controllable from client-side
@@ -161,13 +511,48 @@ def fit_pipeline(client: ContainerClient, data, pipe: Pipeline, features: List[s
         traceback.print_exc()
 
 
-def _combine_all_node_data(client, data, merge_keys, *args, **kwargs) -> pd.DataFrame:
-    results = _dispatch_tasks(client, data, method='get_data', *args, **kwargs)
-
-    for r in results:
-        info(f'Retrieved node data with shape {r.shape}')
-
-    combined_df = _merge_multiple_dfs(results, on=merge_keys)
+def _combine_all_node_data(client, data, merge_keys, *args, memory_budget=None, optimize_dtypes=False,
+                           **kwargs) -> pd.DataFrame:
+    """
+    Retrieve the data of all nodes and join it on `merge_keys`. Keyword arguments such as `two_phase`, `columns` and
+    `where` are passed on to `_retrieve_node_data`.
+
+    :param memory_budget: Maximum estimated size of the joined table in bytes, defaults to `MEMORY_BUDGET`. The size
+                          is estimated from the key histograms of the node data before joining.
+    :param optimize_dtypes: Let the nodes send their data in smaller dtypes without changing the values, see
+                            `dtypes.optimize_dtypes`. The joined table keeps these dtypes, so it takes less memory.
+                            Computations on it should cast the values to 64 bits. Only when `merge_keys` is given,
+                            otherwise the nodes do not know which columns are keys.
+    """
+    # Every node's data is deduplicated and joined as soon as it arrives, while the other nodes are still working
+    joiner = join.IncrementalJoin(merge_keys)
+    batched = {}
+
+    def add_node_data(organization_id, df):
+        if isinstance(df, transfer.RecordBatches):
+            # Batches are read once the keys of all nodes are known
+            info(f'Retrieved node data with {len(df)} records in {df.num_batches} batches')
+            batched[organization_id] = df
+            return
+
+        info(f'Retrieved node data with shape {df.shape}')
+        if merge_keys is not None:
+            # Records with duplicate keys are dropped after joining anyway, dropping them beforehand prevents
+            # many-to-many joins
+            df = _drop_duplicate_keys(df, join.resolve_keys([df], merge_keys))
+        joiner.add(organization_id, df)
+
+    _retrieve_node_data(client, data, merge_keys, *args, on_result=add_node_data, optimize_dtypes=optimize_dtypes,
+                        **kwargs)
+    for organization_id, df in _read_linked_batches(batched, merge_keys).items():
+        joiner.add(organization_id, df)
+
+    results = [joiner.frames[organization_id] for organization_id in sorted(joiner.frames)]
+    merge_keys = join.resolve_keys(results, merge_keys)
+    _check_join_size(results, merge_keys, memory_budget if memory_budget is not None else MEMORY_BUDGET,
+                     n_rows=joiner.size())
+
+    combined_df = _merge_multiple_dfs(joiner)
     info(','.join(combined_df.columns))
 
     info(f'Joined table has shape {combined_df.shape}')
@@ -187,7 +572,222 @@ def _combine_all_node_data(client, data, merge_keys, *args, **kwargs) -> pd.Data
     return combined_df
 
 
-def _merge_multiple_dfs(df_list, on):
+def _iter_combined_node_data(client, data, merge_keys, *args, spill_dir=None, n_partitions=None,
+                             optimize_dtypes=False, **kwargs) -> Iterator[pd.DataFrame]:
+    """
+    Out-of-core version of `_combine_all_node_data`: the node data is spilled to disk as it arrives, hash partitioned
+    on the merge keys, and the joined table is yielded in chunks of one partition each, see `spill.PartitionedJoin`.
+    Neither the node data nor the joined table need to fit in memory. Keyword arguments such as `two_phase`, `columns`
+    and `where` are passed on to `_retrieve_node_data`.
+
+    The data is only retrieved when iteration starts. A `ValueError` is raised after the last chunk when there are
+    fewer than `MIN_RECORDS` records.
+
+    :param spill_dir: Directory for the partitions, defaults to `SPILL_DIR`
+    :param n_partitions: Number of partitions, defaults to `SPILL_PARTITIONS`
+    :param optimize_dtypes: Let the nodes send their data in smaller dtypes, which are also spilled to disk and kept
+                            in the chunks, see `dtypes.optimize_dtypes`
+    """
+    with spill.PartitionedJoin(merge_keys, n_partitions or SPILL_PARTITIONS, spill_dir or SPILL_DIR) as joiner:
+        def add_node_data(organization_id, df):
+            info(f'Retrieved node data with {len(df)} records')
+            joiner.add(organization_id, df)
+
+        _retrieve_node_data(client, data, merge_keys, *args, on_result=add_node_data, optimize_dtypes=optimize_dtypes,
+                            **kwargs)
+
+        n_records = 0
+        for chunk in joiner.chunks():
+            n_records += len(chunk)
+            yield chunk
+
+    info(f'Joined table has {n_records} records')
+    if n_records < MIN_RECORDS:
+        raise ValueError(f'Only {n_records} records available for analysis! Privacy is not ensured.')
+
+
+def _retrieve_node_data(client, data, merge_keys, *args, on_result, two_phase=False, bloom_filter_fpr=None,
+                        check_overlap=False, columns=None, where=None, optimize_dtypes=False, **kwargs):
+    """
+    Retrieve the data of all nodes, and call `on_result` with the organization id and the data of every node as soon
+    as it arrives.
+
+    :param two_phase: Retrieve the data in two rounds. First only the merge keys are retrieved, then only the records
+                      whose keys link across all nodes. This reduces the amount of transferred data when only a small
+                      share of the records link. Requires `merge_keys`.
+    :param bloom_filter_fpr: When set, the nodes first send a bloom filter of their merge keys with this false
+                             positive rate. The combined filter is sent back so that nodes only send records that can
+                             (probably) be linked. Requires `merge_keys`.
+    :param check_overlap: Estimate the number of linked records from sketches of the merge keys before retrieving
+                          any data, and fail when it is certainly below `MIN_RECORDS`. Requires `merge_keys`.
+    :param columns: Only retrieve these columns and the merge keys. When `merge_keys` is not given, the keys are
+                    inferred from all columns, so all columns are retrieved.
+    :param where: Only retrieve the records that satisfy all predicates, tuples `(column, operator, value)` that are
+                  evaluated by the nodes, see `algorithms._filter_records`. A `ValueError` is raised when a predicate
+                  is on a column that no node has.
+    :param optimize_dtypes: Let the nodes convert all columns except the merge keys to smaller dtypes, see
+                            `dtypes.optimize_dtypes`. Only when `merge_keys` is given.
+    """
+    # Checking the predicates, checking the overlap and building the bloom filter do not depend on each other and run
+    # concurrently
+    preparations = []
+    if where:
+        preparations.append(_call_async(_check_predicates, client, data, where, *args, **kwargs))
+    if check_overlap:
+        preparations.append(_call_async(_check_overlap, client, data, merge_keys, *args, **kwargs))
+    if bloom_filter_fpr is not None:
+        preparations.append(_call_async(_combined_bloom_filter, client, data, merge_keys, bloom_filter_fpr, *args,
+                                        **kwargs))
+    prepared = _run_async(*preparations) if preparations else []
+
+    rpc_kwargs = {}
+    if bloom_filter_fpr is not None:
+        bloom_filter = prepared[-1]
+        rpc_kwargs = {'merge_keys': merge_keys, 'bloom_filter': bloom_filter.to_bytes()}
+    if where:
+        rpc_kwargs['where'] = where
+    data_kwargs = {}
+    if columns is not None and merge_keys is not None:
+        keys = [merge_keys] if isinstance(merge_keys, str) else list(merge_keys)
+        data_kwargs['columns'] = keys + [c for c in columns if c not in keys]
+    if optimize_dtypes and merge_keys is not None:
+        data_kwargs.update(optimize_dtypes=True, merge_keys=merge_keys)
+
+    if two_phase:
+        _get_linked_node_data(client, data, merge_keys, *args, rpc_kwargs=rpc_kwargs, data_kwargs=data_kwargs,
+                              on_result=on_result, **kwargs)
+    else:
+        _dispatch_tasks(client, data, method='get_data', *args, rpc_kwargs={**rpc_kwargs, **data_kwargs},
+                        on_result=on_result, **kwargs)
+
+
+def _read_linked_batches(batched: Dict[int, transfer.RecordBatches], merge_keys) -> Dict[int, pd.DataFrame]:
+    """
+    Read node data that was sent as record batches one batch at a time. First only the key columns are read, then
+    every batch is reduced to the records whose keys link across all nodes. Memory use is bounded by the key columns,
+    the linked records and a single batch, instead of the size of the node tables.
+    """
+    organization_ids = sorted(batched)
+    node_data = [batched[organization_id] for organization_id in organization_ids]
+    empty = [df.empty() for df in node_data]
+    keys = join.join_keys(empty, join.resolve_keys(empty, merge_keys)) if node_data else None
+    if keys is None:
+        return {organization_id: df.to_pandas() for organization_id, df in zip(organization_ids, node_data)}
+
+    key_frames = [_concat(df.iter_frames(keys), df.empty(keys)) for df in node_data]
+    linked = join.linking_keys(key_frames, keys)
+    del key_frames
+    info(f'{len(linked)} keys link across all nodes')
+
+    return {organization_id: _concat((batch[join.select_keys(batch, linked)] for batch in df), df.empty())
+            for organization_id, df in zip(organization_ids, node_data)}
+
+
+def _concat(frames: Iterator[pd.DataFrame], empty: pd.DataFrame) -> pd.DataFrame:
+    frames = list(frames)
+    return pd.concat(frames, ignore_index=True) if frames else empty
+
+
+def _drop_duplicate_keys(df, merge_keys):
+    deduplicated = join.drop_duplicate_keys(df, merge_keys)
+    info(f'Dropped {len(df) - len(deduplicated)} records with duplicate identifiers before joining')
+    return deduplicated
+
+
+def _check_join_size(df_list, merge_keys, memory_budget, n_rows=None):
+    """
+    Estimate the size of the joined table from the key histograms and the average record size of every dataset.
+    Raise an exception when it exceeds the memory budget.
+
+    :param n_rows: Number of rows of the joined table, when it is already known
+    """
+    if n_rows is None:
+        n_rows = join.expected_size(df_list, merge_keys)
+    if n_rows is None:
+        return
+
+    row_size = sum(_record_size(df) for df in df_list)
+    expected_bytes = n_rows * row_size
+    info(f'Joined table is expected to have {n_rows} rows and take {expected_bytes / 2 ** 20:.1f} MiB')
+
+    if memory_budget is not None and expected_bytes > memory_budget:
+        raise ValueError(f'Joined table is expected to have {n_rows} rows and take {expected_bytes / 2 ** 20:.1f} '
+                         f'MiB, which exceeds the memory budget of {memory_budget / 2 ** 20:.1f} MiB')
+
+
+def _record_size(df):
+    sample = df.head(ROW_SIZE_SAMPLE)
+    if sample.empty:
+        return 0
+    return sample.memory_usage(deep=True, index=False).sum() / len(sample)
+
+
+def _get_linked_node_data(client, data, merge_keys, *args, rpc_kwargs=None, data_kwargs=None, on_result=None,
+                          **kwargs):
+    """
+    Retrieve only the records whose merge keys occur exactly once at every node. Other records would either not be
+    part of the inner join, or be dropped as duplicates afterwards.
+
+    :param rpc_kwargs: Additional keyword arguments for retrieving the keys
+    :param data_kwargs: Additional keyword arguments for retrieving the data
+    :param on_result: Function that is called with every node's data as soon as it arrives, see `_dispatch_tasks`
+    """
+    if merge_keys is None:
+        raise ValueError('Merge keys need to be specified to retrieve data in two phases')
+
+    rpc_kwargs = dict(rpc_kwargs or {}, merge_keys=merge_keys)
+    key_results = _dispatch_tasks(client, data, 'get_keys', *args, rpc_kwargs=rpc_kwargs, **kwargs)
+    for r in key_results:
+        info(f'Retrieved {len(r)} keys')
+
+    keys = join.linking_keys(key_results, list(key_results[0].columns))
+    info(f'{len(keys)} keys link across all nodes')
+
+    return _dispatch_tasks(client, data, 'get_data', *args, rpc_kwargs={'keys': keys, **(data_kwargs or {})},
+                           on_result=on_result, **kwargs)
+
+
+def _check_predicates(client, data, where, *args, **kwargs):
+    """
+    Raise a `ValueError` when a predicate is on a column that no node has. Nodes skip predicates on columns they do
+    not have, so such a predicate, for example on a misspelled column, would not filter any records.
+    """
+    columns = column_names(client, data, *args, **kwargs)
+    unknown = sorted({column for column, _, _ in where} - columns)
+    if unknown:
+        raise ValueError(f'Predicates on columns {unknown} can not be applied, no node has these columns')
+
+
+def _check_overlap(client, data, merge_keys, *args, **kwargs):
+    if merge_keys is None:
+        raise ValueError('Merge keys need to be specified to estimate the overlap between datasets')
+
+    overlap = estimate_overlap(client, data, merge_keys, *args, **kwargs)
+    if overlap['intersection_upper_bound'] < MIN_RECORDS:
+        raise ValueError(f'Only about {overlap["intersection"]:.0f} records can be linked for analysis! '
+                         f'Privacy is not ensured.')
+
+
+def _combined_bloom_filter(client, data, merge_keys, false_positive_rate, *args, **kwargs) -> sketches.BloomFilter:
+    """
+    Combine bloom filters of the merge keys of all nodes. All filters need the same size, which is based on the
+    largest dataset.
+    """
+    if merge_keys is None:
+        raise ValueError('Merge keys need to be specified to prefilter records with a bloom filter')
+
+    counts = _dispatch_tasks(client, data, 'count', *args, **kwargs)
+    size = sketches.BloomFilter.for_capacity(max(counts), false_positive_rate)
+
+    rpc_kwargs = {'merge_keys': merge_keys, 'num_bits': size.num_bits, 'num_hashes': size.num_hashes}
+    filters = _dispatch_tasks(client, data, 'bloom_filter', *args, rpc_kwargs=rpc_kwargs, **kwargs)
+
+    combined = reduce(operator.and_, map(sketches.BloomFilter.from_bytes, filters))
+    info(f'Combined bloom filter of {combined.num_bits} bits has fill ratio {combined.fill_ratio():.3f}')
+    return combined
+
+
+def _merge_multiple_dfs(joiner: join.IncrementalJoin):
     # TODO: How should we handle DataFrames with overlapping when those are not part of the join keys?
     # TODO: Decide what type of join to use. We should keep the maximum amount of records possible
-    return reduce(lambda left, right: pd.merge(left, right, on=on, how='inner', suffixes=(False, False)), df_list)
+    return joiner.result()
@@ -0,0 +1,256 @@
+"""
+Compact summaries of the join keys of a dataset, that can be shared with the master instead of the keys themselves.
+
+Keys are hashed with `pd.util.hash_pandas_object`, after converting them to canonical dtypes (see `normalize_keys`).
+Equal keys therefore get the same hash on every node, also when nodes store them with different dtypes, for example
+integers at one node and floats at a node with missing values.
+"""
+import math
+import struct
+import zlib
+from itertools import combinations
+from typing import Dict, List, Sequence, Union
+
+import numpy as np
+import pandas as pd
+
+# Constants of the splitmix64 finalizer, used to derive a second hash from the key hash
+_MIX_1 = np.uint64(0xbf58476d1ce4e5b9)
+_MIX_2 = np.uint64(0x94d049bb133111eb)
+
+
+def hash_keys(df: pd.DataFrame, keys: Union[str, List[str]]) -> np.ndarray:
+    """
+    Hash the key columns of every record to a 64 bit integer.
+
+    :param df: DataFrame containing the key columns
+    :param keys: column name or list of column names
+    :return: uint64 array with one hash per record
+    """
+    return pd.util.hash_pandas_object(normalize_keys(df, keys), index=False).values
+
+
+def normalize_keys(df: pd.DataFrame, keys: Union[str, List[str]]) -> pd.DataFrame:
+    """
+    Key columns of `df` in canonical dtypes, so that keys that are equal in a join have equal hashes. Numbers become
+    float64, and categorical columns are converted to their values. Integers beyond 2 ** 53 can get the same hash as a
+    neighbouring integer, which only causes false positives in filters and sketches.
+
+    :param df: DataFrame containing the key columns
+    :param keys: column name or list of column names
+    """
+    keys = [keys] if isinstance(keys, str) else list(keys)
+    return pd.concat([_normalize_key(df[key]) for key in keys], axis=1)
+
+
+def _normalize_key(values: pd.Series) -> pd.Series:
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        numeric = pd.api.types.is_numeric_dtype(values.cat.categories.dtype)
+        values = values.astype(np.float64 if numeric else object)
+    if pd.api.types.is_numeric_dtype(values.dtype):
+        # Adding zero turns -0.0 into 0.0, which joins with 0
+        return values.astype(np.float64) + 0.0
+    if pd.api.types.is_string_dtype(values.dtype):
+        return values.astype(object)
+    return values
+
+
+def _mix(hashes: np.ndarray) -> np.ndarray:
+    hashes = hashes ^ (hashes >> np.uint64(30))
+    hashes = hashes * _MIX_1
+    hashes = hashes ^ (hashes >> np.uint64(27))
+    hashes = hashes * _MIX_2
+    return hashes ^ (hashes >> np.uint64(31))
+
+
+class BloomFilter:
+    """
+    Bloom filter over key hashes, see `hash_keys`.
+
+    Filters with the same number of bits and hash functions can be combined with `&`. The result contains the keys
+    that were added to all filters, plus false positives.
+    """
+    _HEADER = struct.Struct('<QI')
+
+    def __init__(self, num_bits: int, num_hashes: int, bits: np.ndarray = None):
+        self.num_bits = int(num_bits)
+        self.num_hashes = int(num_hashes)
+        if bits is None:
+            bits = np.zeros((self.num_bits + 7) // 8, dtype=np.uint8)
+        self.bits = bits
+
+    @classmethod
+    def for_capacity(cls, capacity: int, false_positive_rate: float) -> 'BloomFilter':
+        """
+        Create a filter that has the requested false positive rate when `capacity` keys are added.
+        """
+        if not 0 < false_positive_rate < 1:
+            raise ValueError(f'False positive rate should be between 0 and 1, got {false_positive_rate}')
+        capacity = max(capacity, 1)
+        num_bits = math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2)
+        num_hashes = max(1, round(num_bits / capacity * math.log(2)))
+        return cls(num_bits, num_hashes)
+
+    def add(self, hashes: np.ndarray):
+        positions = np.unique(self._positions(hashes))
+        if not len(positions):
+            return
+
+        byte_index = positions >> 3
+        masks = np.left_shift(1, positions & 7).astype(np.uint8)
+
+        # Combine the masks of positions that fall in the same byte
+        starts = np.flatnonzero(np.r_[True, byte_index[1:] != byte_index[:-1]])
+        self.bits[byte_index[starts]] |= np.bitwise_or.reduceat(masks, starts)
+
+    def contains(self, hashes: np.ndarray) -> np.ndarray:
+        """
+        Check for every hash whether it is (probably) in the filter.
+
+        :return: boolean array
+        """
+        found = np.ones(len(hashes), dtype=bool)
+        for positions in self._positions(hashes).reshape(self.num_hashes, -1):
+            found &= ((self.bits[positions >> 3] >> (positions & 7)) & 1).astype(bool)
+        return found
+
+    def __and__(self, other: 'BloomFilter') -> 'BloomFilter':
+        if (self.num_bits, self.num_hashes) != (other.num_bits, other.num_hashes):
+            raise ValueError('Only bloom filters with the same size and number of hashes can be combined')
+        return BloomFilter(self.num_bits, self.num_hashes, self.bits & other.bits)
+
+    def fill_ratio(self) -> float:
+        return int(np.unpackbits(self.bits).sum()) / self.num_bits
+
+    def to_bytes(self) -> bytes:
+        """
+        Serialize the filter. The bits are compressed, which pays off for combined filters that are mostly empty.
+        """
+        return self._HEADER.pack(self.num_bits, self.num_hashes) + zlib.compress(self.bits.tobytes(), 1)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'BloomFilter':
+        num_bits, num_hashes = cls._HEADER.unpack_from(data)
+        bits = np.frombuffer(zlib.decompress(data[cls._HEADER.size:]), dtype=np.uint8).copy()
+        return cls(num_bits, num_hashes, bits)
+
+    def _positions(self, hashes: np.ndarray) -> np.ndarray:
+        """
+        Bit positions of all hash functions, using double hashing. Positions of the i-th hash function of all keys
+        are stored consecutively.
+        """
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        second = _mix(hashes) | np.uint64(1)
+        num_bits = np.uint64(self.num_bits)
+        return np.concatenate([(hashes + np.uint64(i) * second) % num_bits for i in range(self.num_hashes)]) \
+            .astype(np.int64)
+
+
+class HyperLogLog:
+    """
+    HyperLogLog sketch for estimating the number of distinct keys, using key hashes (see `hash_keys`).
+
+    Sketches with the same precision can be combined with `|`, which gives the sketch of the union of the key sets.
+    The relative standard error of the estimated cardinality is about `1.04 / sqrt(2 ** precision)`.
+    """
+    _HEADER = struct.Struct('<B')
+
+    def __init__(self, precision: int = 14, registers: np.ndarray = None):
+        if not 4 <= precision <= 18:
+            raise ValueError(f'Precision should be between 4 and 18, got {precision}')
+        self.precision = precision
+        if registers is None:
+            registers = np.zeros(2 ** precision, dtype=np.uint8)
+        self.registers = registers
+
+    @property
+    def relative_error(self) -> float:
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def add(self, hashes: np.ndarray):
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        index = (hashes >> np.uint64(64 - self.precision)).astype(np.int64)
+        rank = np.minimum(_leading_zeros(hashes << np.uint64(self.precision)), 64 - self.precision) + 1
+        np.maximum.at(self.registers, index, rank.astype(np.uint8))
+
+    def cardinality(self) -> float:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m ** 2 / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            # Small range correction: linear counting
+            estimate = m * math.log(m / zeros)
+        return float(estimate)
+
+    def __or__(self, other: 'HyperLogLog') -> 'HyperLogLog':
+        if self.precision != other.precision:
+            raise ValueError('Only HyperLogLog sketches with the same precision can be combined')
+        return HyperLogLog(self.precision, np.maximum(self.registers, other.registers))
+
+    def to_bytes(self) -> bytes:
+        return self._HEADER.pack(self.precision) + zlib.compress(self.registers.tobytes(), 1)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'HyperLogLog':
+        precision, = cls._HEADER.unpack_from(data)
+        registers = np.frombuffer(zlib.decompress(data[cls._HEADER.size:]), dtype=np.uint8).copy()
+        return cls(precision, registers)
+
+
+def estimate_overlap(sketches: Sequence[HyperLogLog]) -> Dict[str, object]:
+    """
+    Estimate the number of distinct keys of every dataset, of every pair of datasets, and of all datasets together.
+    Intersections are estimated with the inclusion-exclusion principle from the cardinalities of unions.
+
+    The upper bound of the intersection of all datasets takes three standard errors of every union into account. It
+    can be used to decide that a join will certainly be too small.
+
+    :param sketches: sketches of the keys of every dataset
+    :return: dict with 'cardinality' (list), 'pairwise_intersection' (nested list), 'intersection' and
+             'intersection_upper_bound'
+    """
+    n = len(sketches)
+    relative_error = sketches[0].relative_error
+    union_cache = {}
+
+    def union_cardinality(subset):
+        if subset not in union_cache:
+            union = sketches[subset[0]]
+            for i in subset[1:]:
+                union = union | sketches[i]
+            union_cache[subset] = union.cardinality()
+        return union_cache[subset]
+
+    def intersection(subset):
+        estimate, error = 0.0, 0.0
+        for size in range(1, len(subset) + 1):
+            for part in combinations(subset, size):
+                union = union_cardinality(part)
+                estimate += (-1) ** (size + 1) * union
+                error += 3 * relative_error * union
+        smallest = min(union_cardinality((i,)) for i in subset)
+        return min(max(estimate, 0.0), smallest), min(estimate + error, smallest * (1 + 3 * relative_error))
+
+    cardinality = [union_cardinality((i,)) for i in range(n)]
+    pairwise = [[cardinality[i] if i == j else intersection(tuple(sorted((i, j))))[0] for j in range(n)]
+                for i in range(n)]
+    total, upper_bound = intersection(tuple(range(n)))
+
+    return {
+        'cardinality': cardinality,
+        'pairwise_intersection': pairwise,
+        'intersection': total,
+        'intersection_upper_bound': upper_bound,
+    }
+
+
+def _leading_zeros(values: np.ndarray) -> np.ndarray:
+    """
+    Number of leading zero bits of unsigned 64 bit integers. Both 32 bit halves are exactly representable as floats,
+    so their bit length can be read from the float exponent.
+    """
+    _, high_bits = np.frexp((values >> np.uint64(32)).astype(np.float64))
+    _, low_bits = np.frexp((values & np.uint64(0xffffffff)).astype(np.float64))
+    return np.where(high_bits > 0, 32 - high_bits, 64 - low_bits)
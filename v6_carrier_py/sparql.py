@@ -0,0 +1,458 @@
+"""
+Streaming, typed ingestion of SPARQL query results.
+
+Results are requested in the SPARQL 1.1 tab-separated values format, which keeps the XSD datatype of every literal,
+and are parsed in chunks while they are downloaded. Every column gets a compact dtype based on the datatypes of its
+values (see `XSD_KINDS`): integers become int32 and decimals float32 when that keeps every value, dates datetime64
+and strings with few distinct values categorical.
+"""
+import csv
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from io import BytesIO
+from itertools import chain, count
+from typing import BinaryIO, Callable, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+import pandas as pd
+import requests
+from pandas.api.types import union_categoricals
+from requests.adapters import HTTPAdapter
+from vantage6.tools.util import info, warn
+
+from .dtypes import downcast_floats
+
+TSV = 'text/tab-separated-values'
+# Number of bytes of a response that is parsed at a time, the dtypes of the columns are determined on the first
+# SAMPLE_BYTES
+CHUNK_BYTES = 2 ** 24
+SAMPLE_BYTES = 2 ** 16
+# Maximum ratio of distinct values to values for which a string column is made categorical
+CATEGORY_RATIO = 0.5
+# Number of seconds to wait for the endpoint to respond
+REQUEST_TIMEOUT = 3600
+# Defaults of `query_pages`: rows per page, pages that are requested at the same time and retries per page
+PAGE_SIZE = 100000
+MAX_WORKERS = 4
+PAGE_RETRIES = 3
+# Number of seconds before the first retry of a page, the interval doubles with every retry
+RETRY_INTERVAL = 1
+
+XSD = 'http://www.w3.org/2001/XMLSchema#'
+INTEGER = 'integer'
+FLOAT = 'float'
+DATETIME = 'datetime'
+BOOLEAN = 'boolean'
+STRING = 'string'
+
+# Kind of value of XSD datatypes, other datatypes are read as strings
+XSD_KINDS = {
+    **{XSD + name: INTEGER for name in ['integer', 'int', 'long', 'short', 'byte', 'nonNegativeInteger',
+                                        'positiveInteger', 'nonPositiveInteger', 'negativeInteger', 'unsignedLong',
+                                        'unsignedInt', 'unsignedShort', 'unsignedByte', 'gYear']},
+    **{XSD + name: FLOAT for name in ['decimal', 'double', 'float']},
+    **{XSD + name: DATETIME for name in ['dateTime', 'date', 'dateTimeStamp']},
+    XSD + 'boolean': BOOLEAN,
+}
+
+# Numbers and booleans may be written without quotes and datatype in TSV results
+_BARE_TERMS = [(re.compile(r'[+-]?\d+'), XSD + 'integer'),
+               (re.compile(r'[+-]?\d*\.\d+'), XSD + 'decimal'),
+               (re.compile(r'[+-]?(?:\d+\.?\d*|\.\d+)[eE][+-]?\d+'), XSD + 'double'),
+               (re.compile(r'true|false'), XSD + 'boolean')]
+# Datatypes and language tags of literals, removed from raw bytes in `_fast_chunk`
+_DATATYPE = re.compile(rb'"\^\^<[^>\t\r\n]*>')
+_LANGUAGE_TAG = re.compile(rb'"@[A-Za-z][A-Za-z0-9-]*(?=[\t\r\n])')
+_LITERAL = re.compile(r'"(?P<lexical>.*)"(?:\^\^<(?P<datatype>[^>]*)>|@[A-Za-z0-9-]+)?', re.DOTALL)
+_PROLOGUE = re.compile(r'\s*(?:(?:BASE\s*<[^>]*>|PREFIX\s+[^\s:]*:\s*<[^>]*>)\s*)*', re.IGNORECASE)
+_PROJECTION = re.compile(r'SELECT\s+(?:(?:DISTINCT|REDUCED)\s+)?((?:[?$]\w+\s*)+)(?:WHERE\b|FROM\b|\{)',
+                         re.IGNORECASE)
+# Strings, IRIs, comments, whitespace and everything else in a SPARQL query
+_QUERY_TOKENS = re.compile(r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'|<[^<>"{}|^`\\\s]*>|#[^\n]*|\s+|[^"\'<#\s]+|.')
+_ESCAPES = re.compile(r'\\(.)')
+_UNESCAPED = {'t': '\t', 'n': '\n', 'r': '\r', 'b': '\b', 'f': '\f', '"': '"', "'": "'", '\\': '\\'}
+
+
+def query(endpoint: str, query_string: str, session: requests.Session = None,
+          chunk_bytes: int = CHUNK_BYTES) -> pd.DataFrame:
+    """
+    Run a `SELECT` query on a SPARQL endpoint and return the result as DataFrame with compact dtypes.
+
+    :param session: Session whose connections are reused, by default a new connection is made
+    :param chunk_bytes: Number of bytes of the response that is parsed at a time
+    """
+    session = session or requests.Session()
+    with session.post(endpoint, data={'query': query_string}, headers={'Accept': TSV}, stream=True,
+                      timeout=REQUEST_TIMEOUT) as response:
+        response.raise_for_status()
+        # Let urllib3 undo any content encoding, such as gzip, while streaming
+        response.raw.decode_content = True
+        return read_tsv(response.raw, chunk_bytes=chunk_bytes)
+
+
+def query_pages(endpoint: str, query_string: str, page_size: int = PAGE_SIZE, max_workers: int = MAX_WORKERS,
+                retries: int = PAGE_RETRIES, session: requests.Session = None,
+                chunk_bytes: int = CHUNK_BYTES) -> pd.DataFrame:
+    """
+    Run a `SELECT` query page by page and return the pages concatenated in order. The query is wrapped in a
+    subquery that is ordered by all its variables, so pages of `page_size` rows can be requested with `LIMIT` and
+    `OFFSET`. Up to `max_workers` pages are requested at the same time over a shared pool of connections, until a
+    page is not full. A page that fails is requested again up to `retries` times.
+
+    The query can not have dataset clauses (`FROM`), because subqueries can not have them.
+    """
+    session = session or requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    prologue, select = split_prologue(normalize_query(query_string))
+    columns = variables(query_string) or query(endpoint, header_query(query_string), session=session).columns
+    order = ' '.join(f'?{column}' for column in columns)
+
+    def fetch(page):
+        page_query = _with_prologue(prologue, f'SELECT * WHERE {{ {select} }} ORDER BY {order} '
+                                              f'LIMIT {page_size} OFFSET {page * page_size}')
+        return _with_retries(partial(query, endpoint, page_query, session=session, chunk_bytes=chunk_bytes),
+                             retries, f'page {page}')
+
+    pages = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = deque(executor.submit(fetch, page) for page in range(max_workers))
+        next_page = max_workers
+        while futures:
+            page = futures.popleft().result()
+            pages.append(page)
+            if len(page) < page_size:
+                # The last page, pages that were requested after it are empty
+                for future in futures:
+                    future.cancel()
+                break
+            futures.append(executor.submit(fetch, next_page))
+            next_page += 1
+
+    info(f'Fetched {sum(len(page) for page in pages)} rows in {len(pages)} pages')
+    # The last page can be empty, its columns have no dtypes yet
+    return concat_chunks([page for page in pages if len(page)] or pages[:1])
+
+
+def _with_retries(func: Callable[[], pd.DataFrame], retries: int, description: str) -> pd.DataFrame:
+    for attempt in count():
+        try:
+            return func()
+        except requests.RequestException as e:
+            if attempt >= retries:
+                raise
+            interval = RETRY_INTERVAL * 2 ** attempt
+            warn(f'Fetching {description} failed ({e}), retrying in {interval} seconds')
+            time.sleep(interval)
+
+
+def split_prologue(query_string: str) -> Tuple[str, str]:
+    """
+    Split a query into its `BASE` and `PREFIX` declarations and the rest of the query.
+    """
+    match = _PROLOGUE.match(query_string)
+    return match.group().strip(), query_string[match.end():].strip()
+
+
+def variables(query_string: str) -> Optional[List[str]]:
+    """
+    Names of the variables that a `SELECT` query projects, or `None` when they can not be read from the query
+    itself, for example with `SELECT *` or expressions.
+    """
+    _, select = split_prologue(normalize_query(query_string))
+    match = _PROJECTION.match(select)
+    return [name.lstrip('?$') for name in match.group(1).split()] if match else None
+
+
+def header_query(query_string: str) -> str:
+    """
+    Rewrite a `SELECT` query to one without rows, whose result only has the names of the variables.
+    """
+    prologue, select = split_prologue(normalize_query(query_string))
+    return _with_prologue(prologue, f'SELECT * WHERE {{ {select} }} LIMIT 0')
+
+
+def count_query(query_string: str, variable: str = 'count') -> str:
+    """
+    Rewrite a `SELECT` query to one that counts its rows in `variable`.
+    """
+    prologue, select = split_prologue(normalize_query(query_string))
+    return _with_prologue(prologue, f'SELECT (COUNT(*) AS ?{variable}) WHERE {{ {select} }}')
+
+
+def _with_prologue(prologue: str, query_string: str) -> str:
+    return f'{prologue} {query_string}' if prologue else query_string
+
+
+def read_tsv(stream: BinaryIO, chunk_bytes: int = CHUNK_BYTES) -> pd.DataFrame:
+    """
+    Parse SPARQL TSV results from a binary stream, `chunk_bytes` at a time.
+    """
+    return concat_chunks(iter_tsv(stream, chunk_bytes))
+
+
+def iter_tsv(stream: BinaryIO, chunk_bytes: int = CHUNK_BYTES) -> Iterator[pd.DataFrame]:
+    """
+    Yield SPARQL TSV results from a binary stream as DataFrames of about `chunk_bytes` of the stream.
+
+    The first `SAMPLE_BYTES` are parsed term by term, which determines the dtype of every column. In the rest of the
+    stream, quotes, datatypes and language tags are removed from the raw bytes, so pandas parses the numbers, and
+    only strings and dates are converted afterwards.
+    """
+    blocks = _line_blocks(stream, SAMPLE_BYTES, chunk_bytes)
+    header = next(blocks, b'').split(b'\n', 1)
+    columns = [column.lstrip('?$') for column in header[0].decode().rstrip('\r').split('\t')] if header[0] else []
+    blocks = chain(header[1:], blocks)
+
+    dtypes, datatypes = None, set()
+    for block in blocks:
+        if not block:
+            continue
+        if dtypes is None or b'\\' in block or b'"<' in block:
+            # Blocks with escapes, or literals that look like IRIs, are parsed term by term as well
+            chunk = typed_chunk(_read_block(block, columns, dtype=str))
+            if dtypes is None:
+                dtypes, datatypes = chunk.dtypes, set(_DATATYPE.findall(block))
+        else:
+            chunk = _fast_chunk(block, columns, dtypes, datatypes)
+        yield chunk
+
+    if dtypes is None:
+        # Results without rows still have columns
+        yield pd.DataFrame(columns=columns)
+
+
+def typed_chunk(chunk: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convert a DataFrame of RDF terms in Turtle syntax, as found in TSV results, to values with compact dtypes.
+    """
+    return pd.DataFrame({column: _typed_column(chunk[column]) for column in chunk.columns}, index=chunk.index)
+
+
+def _fast_chunk(block: bytes, columns: List[str], dtypes: pd.Series, datatypes: Set[bytes]) -> pd.DataFrame:
+    """
+    Parse a block of TSV results whose columns are expected to have `dtypes`. `datatypes` are the datatype suffixes
+    (`"^^<...>`) that are expected, replacing these literally is much faster than a regular expression.
+    """
+    text_columns = [c for c in columns if dtypes[c].kind in 'OM' or isinstance(dtypes[c], pd.CategoricalDtype)]
+    # Without escapes every quote delimits a literal, so once datatypes and language tags are gone, removing all
+    # quotes leaves the lexical values
+    if b'"@' in block:
+        block = _LANGUAGE_TAG.sub(b'', block)
+    for datatype in datatypes:
+        block = block.replace(datatype, b'')
+    if b'"^^<' in block:
+        block = _DATATYPE.sub(b'', block)
+    block = block.translate(None, b'"')
+    chunk = _read_block(block, columns, dtype={column: str for column in text_columns})
+
+    for column in columns:
+        values, dtype = chunk[column], dtypes[column]
+        if values.isna().all():
+            chunk[column] = values.astype(np.float32)
+        elif dtype.kind == 'M':
+            chunk[column] = pd.to_datetime(values)
+        elif column in text_columns:
+            chunk[column] = _string_column(values)
+        elif values.dtype.kind not in 'iufb':
+            # Values that did not parse as numbers are converted term by term
+            chunk[column] = _typed_column(values)
+        elif dtype == bool:
+            # Booleans can be written as 0 and 1
+            chunk[column] = values.map({0: False, 1: True}) if values.isna().any() else values.astype(bool)
+        elif values.dtype.kind == 'f':
+            chunk[column] = downcast_floats(values)
+        elif values.dtype.kind == 'i' and _fits(values, np.int32):
+            chunk[column] = values.astype(np.int32)
+    return chunk
+
+
+def _read_block(block: bytes, columns: List[str], dtype) -> pd.DataFrame:
+    # Unbound variables are empty fields, all other values are RDF terms that are never empty
+    return pd.read_csv(BytesIO(block), sep='\t', header=None, names=columns, dtype=dtype, quoting=csv.QUOTE_NONE,
+                       keep_default_na=False, na_values=[''], low_memory=False)
+
+
+def _line_blocks(stream: BinaryIO, first_size: int, size: int) -> Iterator[bytes]:
+    """
+    Yield blocks of about `first_size` bytes first and `size` bytes afterwards, that end at the end of a line.
+    """
+    rest = b''
+    read_size = first_size
+    while True:
+        data = stream.read(read_size)
+        if not data:
+            if rest:
+                yield rest if rest.endswith(b'\n') else rest + b'\n'
+            return
+
+        data = rest + data
+        end = data.rfind(b'\n') + 1
+        rest = data[end:]
+        if end:
+            yield data[:end]
+            read_size = size
+
+
+def _fits(values: pd.Series, dtype) -> bool:
+    info = np.iinfo(dtype)
+    return values.empty or info.min <= values.min() <= values.max() <= info.max
+
+
+def concat_chunks(chunks: Iterator[pd.DataFrame], category_ratio: Optional[float] = CATEGORY_RATIO) -> pd.DataFrame:
+    """
+    Concatenate typed chunks. Columns get the smallest dtype that fits the values of all chunks, and string columns
+    are categorical when all chunks together have few distinct values, so the dtypes do not depend on how the result
+    was split into chunks.
+
+    :param category_ratio: Maximum ratio of distinct values to values of categorical string columns, None only keeps
+                           columns categorical that are categorical in all chunks
+    """
+    chunks = list(chunks)
+    if not chunks:
+        return pd.DataFrame()
+    if len(chunks) == 1:
+        return chunks[0]
+
+    return pd.DataFrame({column: _concat_column([chunk[column] for chunk in chunks], category_ratio).rename(column)
+                         for column in chunks[0].columns})
+
+
+def _concat_column(parts: List[pd.Series], category_ratio: Optional[float]) -> pd.Series:
+    categorical = [isinstance(part.dtype, pd.CategoricalDtype) for part in parts]
+    if all(categorical):
+        values = pd.Series(union_categoricals(parts))
+    else:
+        values = pd.concat([part.astype(object) if is_categorical else part
+                            for part, is_categorical in zip(parts, categorical)], ignore_index=True)
+
+    # Chunks without values, such as a chunk in which a string column is unbound, do not decide the dtype
+    typed = [is_categorical or part.dtype == object
+             for part, is_categorical in zip(parts, categorical) if part.notna().any()]
+    if category_ratio is None or not typed or not all(typed):
+        return values
+    if values.nunique() <= category_ratio * len(values):
+        return values.astype('category')
+    return values.astype(object)
+
+
+def _typed_column(terms: pd.Series) -> pd.Series:
+    present = terms.dropna()
+    if present.empty:
+        return terms.astype(np.float32)
+
+    lexical, datatypes = _split_terms(present)
+    kinds = {XSD_KINDS.get(datatype, STRING) for datatype in datatypes}
+    kind = kinds.pop() if len(kinds) == 1 else STRING
+
+    if kind == STRING:
+        return _string_column(terms)
+
+    if kind == INTEGER:
+        values = _numbers(lexical, np.int64)
+        if values.dtype == np.int64 and _fits(values, np.int32):
+            values = values.astype(np.int32)
+    elif kind == FLOAT:
+        values = downcast_floats(_numbers(lexical, np.float64).astype(np.float64))
+    elif kind == DATETIME:
+        values = pd.to_datetime(lexical)
+    else:
+        values = lexical.isin(['true', '1'])
+
+    # Integers and booleans with unbound values become floats and objects
+    return values.reindex(terms.index) if len(values) < len(terms) else values
+
+
+def _string_column(terms: pd.Series) -> pd.Series:
+    """
+    Strings of a series of RDF terms: IRIs without brackets, literals without quotes, datatype or language tag.
+    Columns with few distinct values are made categorical.
+    """
+    values = _strings(terms.dropna()).reindex(terms.index)
+    if values.nunique() <= CATEGORY_RATIO * len(values):
+        return values.astype('category')
+    return values
+
+
+def _numbers(lexical: pd.Series, dtype) -> pd.Series:
+    if lexical.dtype.kind in 'iuf':
+        return lexical
+    try:
+        # Converting with numpy is several times faster than `pd.to_numeric`
+        return lexical.astype(dtype)
+    except (ValueError, OverflowError):
+        return pd.to_numeric(lexical)
+
+
+def _split_terms(terms: pd.Series):
+    """
+    Lexical values and the set of datatypes of a series of RDF terms. Columns of numbers without datatype, or of
+    literals with a single datatype, take a fast path.
+    """
+    values = terms.values
+    first = values[0]
+    if not first.startswith(('"', '<', '_:')):
+        for dtype, datatype in [(np.int64, 'integer'), (np.float64, 'double')]:
+            try:
+                return terms.astype(dtype), {XSD + datatype}
+            except (ValueError, OverflowError):
+                continue
+
+    match = _LITERAL.fullmatch(first)
+    if match and match.group('datatype'):
+        suffix = f'"^^<{match.group("datatype")}>'
+        # Quotes in literals are escaped, so every term ends with the suffix when it occurs once per term. Counting
+        # in the joined terms is much faster than checking every term.
+        joined = ''.join(values)
+        if joined.count(suffix) == len(values) == joined.count('"^^<') and joined.endswith(suffix):
+            end = -len(suffix)
+            lexical = np.array([term[1:end] for term in values], dtype=object)
+            return pd.Series(lexical, index=terms.index), {match.group('datatype')}
+
+    codes, uniques = pd.factorize(terms)
+    lexical, datatypes = [], set()
+    for term in uniques:
+        match = _LITERAL.fullmatch(term)
+        if match:
+            lexical.append(match.group('lexical'))
+            datatypes.add(match.group('datatype'))
+        else:
+            lexical.append(term)
+            datatypes.add(next((datatype for pattern, datatype in _BARE_TERMS if pattern.fullmatch(term)), None))
+    return pd.Series(np.array(lexical, dtype=object)[codes], index=terms.index), datatypes
+
+
+def _strings(terms: pd.Series) -> pd.Series:
+    codes, uniques = pd.factorize(terms)
+    strings = np.array([_string(term) for term in uniques], dtype=object)
+    return pd.Series(strings[codes], index=terms.index)
+
+
+def _string(term: str) -> str:
+    if term.startswith('<') and term.endswith('>'):
+        return term[1:-1]
+    match = _LITERAL.fullmatch(term)
+    if match:
+        lexical = match.group('lexical')
+        return _ESCAPES.sub(lambda m: _UNESCAPED.get(m.group(1), m.group(0)), lexical) if '\\' in lexical else lexical
+    return term
+
+
+def normalize_query(query: str) -> str:
+    """
+    Remove comments and collapse whitespace outside of strings and IRIs.
+    """
+    parts = []
+    for match in _QUERY_TOKENS.finditer(query):
+        token = match.group()
+        if token.startswith('#') or token.isspace():
+            if parts and parts[-1] == ' ':
+                continue
+            token = ' '
+        parts.append(token)
+    return ''.join(parts).strip()
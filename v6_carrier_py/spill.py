@@ -0,0 +1,118 @@
+"""
+Out-of-core join of datasets that do not fit in memory together.
+
+`PartitionedJoin` spills every dataset to disk as it arrives, hash partitioned on the join keys. Records with the same
+key always end up in the same partition, so the join of all datasets is the union of the joins of the partitions. The
+partitions are joined one at a time, and the result is returned as a sequence of chunks, so only one partition of
+every dataset and one chunk of the result are in memory at a time. Partitions are stored as Arrow IPC (Feather) files,
+which requires `pyarrow`.
+"""
+import os
+import shutil
+import tempfile
+from typing import Dict, Hashable, Iterable, Iterator, List, Optional, Union
+
+import numpy as np
+import pandas as pd
+from vantage6.tools.util import info
+
+from . import join
+from .sketches import hash_keys
+from .sparql import concat_chunks
+
+
+class PartitionedJoin:
+    """
+    Inner join on disk. Records whose key occurs more than once in a dataset, or more than once in the joined
+    table, are dropped like `master._combine_all_node_data` does. The order of the records differs from `merge_inner`:
+    the result is ordered by partition.
+
+    Use it as a context manager, the spilled files are removed on exit.
+
+    :param on: Column name or list of column names of the keys, see `join.resolve_keys`
+    :param n_partitions: Number of partitions, every partition of all datasets together should fit in memory
+    :param directory: Directory in which a temporary directory for the partitions is created, `None` uses the default
+                      temporary directory
+    :param compression: Compression of the partition files, 'lz4', 'zstd' or 'uncompressed'
+    """
+
+    def __init__(self, on: join.Keys, n_partitions: int = 16, directory: Optional[str] = None,
+                 compression: str = 'lz4'):
+        if on is None:
+            raise ValueError('Merge keys need to be specified to join out of core')
+        self.on = on
+        self.n_partitions = n_partitions
+        self.compression = compression
+        self.directory = tempfile.mkdtemp(prefix='join-', dir=directory)
+        # Files of every partition, by dataset id
+        self._files: Dict[Hashable, List[List[str]]] = {}
+
+    def __enter__(self) -> 'PartitionedJoin':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def add(self, dataset_id: Hashable, data: Union[pd.DataFrame, Iterable[pd.DataFrame]]):
+        """
+        Spill a dataset to disk.
+
+        :param dataset_id: Sortable id of the dataset, which determines the order of its columns in the result
+        :param data: The dataset, or an iterable of chunks of it such as `transfer.RecordBatches`
+        """
+        from pyarrow import feather
+
+        files = self._files.setdefault(dataset_id, [[] for _ in range(self.n_partitions)])
+        prefix = os.path.join(self.directory, str(list(self._files).index(dataset_id)))
+        chunks = [data] if isinstance(data, pd.DataFrame) else data
+        n_records = 0
+        for chunk in chunks:
+            partitions = partition(chunk, join.resolve_keys([chunk], self.on), self.n_partitions)
+            order = np.argsort(partitions, kind='stable')
+            bounds = np.searchsorted(partitions[order], np.arange(self.n_partitions + 1))
+            for i in range(self.n_partitions):
+                rows = order[bounds[i]:bounds[i + 1]]
+                if len(rows) == 0:
+                    continue
+                path = f'{prefix}-{i}-{len(files[i])}.arrow'
+                feather.write_feather(chunk.iloc[rows].reset_index(drop=True), path, compression=self.compression)
+                files[i].append(path)
+            n_records += len(chunk)
+        info(f'Spilled {n_records} records of dataset {dataset_id} to {self.n_partitions} partitions')
+
+    def chunks(self) -> Iterator[pd.DataFrame]:
+        """
+        Yield the joined records, one partition at a time. Partitions without joined records are skipped.
+        """
+        dataset_ids = sorted(self._files)
+        for i in range(self.n_partitions):
+            paths = [self._files[dataset_id][i] for dataset_id in dataset_ids]
+            # A partition that is empty in one of the datasets has no joined records
+            if not dataset_ids or not all(paths):
+                continue
+
+            frames = [_read(p) for p in paths]
+            keys = join.resolve_keys(frames, self.on)
+            joined = join.merge_inner([join.drop_duplicate_keys(df, keys) for df in frames], keys)
+            del frames
+            joined = joined.drop_duplicates(keep=False, subset=keys)
+            if len(joined):
+                yield joined.reset_index(drop=True)
+
+
+def partition(df: pd.DataFrame, on: join.Keys, n_partitions: int) -> np.ndarray:
+    """
+    Partition of every record, from the hash of its key. Equal keys get the same partition in every dataset, also when
+    the key columns have different dtypes, see `sketches.normalize_keys`.
+    """
+    return (hash_keys(df, on) % np.uint64(n_partitions)).astype(np.int64)
+
+
+def _read(paths: List[str]) -> pd.DataFrame:
+    from pyarrow import feather
+
+    # The chunks of a partition have the dtypes of the node data
+    return concat_chunks((feather.read_feather(path) for path in paths), category_ratio=None)
@@ -0,0 +1,323 @@
+"""
+Correlation matrices computed with matrix products.
+
+`correlation_matrix` is a replacement for `pd.DataFrame.corr` that processes the columns in blocks, using BLAS matrix
+products instead of a loop over all pairs of columns. `CorrelationStatistics` holds sufficient statistics of datasets
+with the same columns (horizontally partitioned data) that can be added up, so the exact correlation matrix of all data
+together can be computed without sharing any records.
+
+Missing values are handled like `pd.DataFrame.corr` does: every pair of columns only uses the records where both
+values are present. This is done by multiplying with masks that are 1 for present values and 0 for missing ones.
+"""
+from typing import Dict, Iterable, List, Union
+
+import numpy as np
+import pandas as pd
+
+METHODS = ('pearson', 'spearman')
+# Number of columns that are processed at a time
+BLOCK_SIZE = 256
+# Variances below this many rounding errors are treated as 0, see `_pearson`
+VARIANCE_TOLERANCE = 1000
+
+
+class CorrelationStatistics:
+    """
+    Pairwise sums over the records where both columns have a value. To limit loss of precision, the values of every
+    column are shifted by a constant before summing, the correlation does not depend on it.
+
+    - `count[i, j]`: number of records
+    - `sums[i, j]`: sum of column i
+    - `squares[i, j]`: sum of squares of column i
+    - `products[i, j]`: sum of the product of column i and column j
+    """
+
+    def __init__(self, columns: List[str], n_records: int, shift: np.ndarray, count: np.ndarray, sums: np.ndarray,
+                 squares: np.ndarray, products: np.ndarray):
+        self.columns = list(columns)
+        self.n_records = int(n_records)
+        self.shift = np.asarray(shift, dtype=np.float64)
+        self.count = np.asarray(count, dtype=np.float64)
+        self.sums = np.asarray(sums, dtype=np.float64)
+        self.squares = np.asarray(squares, dtype=np.float64)
+        self.products = np.asarray(products, dtype=np.float64)
+
+    @classmethod
+    def from_data(cls, df: pd.DataFrame) -> 'CorrelationStatistics':
+        """
+        Compute the statistics of the numeric columns of `df`.
+        """
+        numeric = _numeric_columns(df)
+        values = numeric.values.astype(np.float64)
+        mask = ~np.isnan(values)
+
+        weights = mask.astype(np.float64)
+
+        # Shift by the mean of every column, or 0 for columns without values
+        n_values = weights.sum(axis=0)
+        shift = np.where(mask, values, 0).sum(axis=0) / np.maximum(n_values, 1)
+
+        shifted = np.where(mask, values - shift, 0)
+
+        return cls(numeric.columns, len(df), shift,
+                   count=weights.T @ weights,
+                   sums=shifted.T @ weights,
+                   squares=(shifted ** 2).T @ weights,
+                   products=shifted.T @ shifted)
+
+    @classmethod
+    def from_batches(cls, batches: Iterable[pd.DataFrame]) -> 'CorrelationStatistics':
+        """
+        Compute the statistics of data that is processed in batches of records, for example `transfer.RecordBatches`.
+        Only one batch is held in memory at a time.
+        """
+        combined = None
+        for batch in batches:
+            statistics = cls.from_data(batch)
+            combined = statistics if combined is None else combined + statistics
+        if combined is None:
+            raise ValueError('Statistics require at least one batch')
+        return combined
+
+    def rebase(self, shift: np.ndarray) -> 'CorrelationStatistics':
+        """
+        Express the statistics in values shifted by `shift` instead of `self.shift`.
+        """
+        d = (self.shift - shift)[:, None]
+        d_t = d.T
+        return CorrelationStatistics(
+            self.columns, self.n_records, shift, self.count,
+            sums=self.sums + d * self.count,
+            squares=self.squares + 2 * d * self.sums + d ** 2 * self.count,
+            products=self.products + d_t * self.sums + d * self.sums.T + d * d_t * self.count,
+        )
+
+    def reindex(self, columns: List[str]) -> 'CorrelationStatistics':
+        """
+        Statistics for the given columns. Columns that are not part of these statistics are treated as missing
+        values only.
+        """
+        index = pd.Index(self.columns).get_indexer(columns)
+        present = index >= 0
+
+        def take(matrix):
+            result = np.zeros((len(columns), len(columns)))
+            result[np.ix_(present, present)] = matrix[np.ix_(index[present], index[present])]
+            return result
+
+        shift = np.zeros(len(columns))
+        shift[present] = self.shift[index[present]]
+        return CorrelationStatistics(columns, self.n_records, shift, take(self.count), take(self.sums),
+                                     take(self.squares), take(self.products))
+
+    def __add__(self, other: 'CorrelationStatistics') -> 'CorrelationStatistics':
+        columns = self.columns + [c for c in other.columns if c not in self.columns]
+        left, right = self.reindex(columns), other.reindex(columns)
+
+        # Use the average shift, weighted by the number of values
+        left_n, right_n = np.diag(left.count), np.diag(right.count)
+        total_n = np.maximum(left_n + right_n, 1)
+        shift = (left.shift * left_n + right.shift * right_n) / total_n
+
+        left, right = left.rebase(shift), right.rebase(shift)
+        return CorrelationStatistics(columns, left.n_records + right.n_records, shift,
+                                     left.count + right.count,
+                                     left.sums + right.sums,
+                                     left.squares + right.squares,
+                                     left.products + right.products)
+
+    def correlation(self) -> pd.DataFrame:
+        """
+        Pearson correlation matrix. Entries without at least two records or without variance are NaN.
+        """
+        correlation = _pearson(self.count, self.products, self.sums, self.sums.T, self.squares, self.squares.T)
+        return pd.DataFrame(correlation, index=self.columns, columns=self.columns)
+
+    def to_dict(self) -> Dict[str, list]:
+        """
+        Convert to built-in types, so the statistics can be serialized in any format.
+        """
+        return {
+            'columns': self.columns,
+            'n_records': self.n_records,
+            'shift': self.shift.tolist(),
+            'count': self.count.tolist(),
+            'sums': self.sums.tolist(),
+            'squares': self.squares.tolist(),
+            'products': self.products.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, statistics: Dict[str, list]) -> 'CorrelationStatistics':
+        return cls(**statistics)
+
+
+def correlation_matrix(df: pd.DataFrame, method: str = 'pearson', block_size: int = BLOCK_SIZE,
+                       dtype: Union[str, np.dtype] = np.float64) -> pd.DataFrame:
+    """
+    Correlation matrix of the numeric columns of `df`, the same as `df.corr(method)`.
+
+    :param df: DataFrame, non-numeric columns are ignored
+    :param method: 'pearson' or 'spearman'
+    :param block_size: Number of columns that are multiplied at a time, limits the size of intermediate results
+    :param dtype: Precision of the matrix products. 'float32' halves the memory use and is faster, at the cost of
+                  about 6 significant digits.
+    :return: DataFrame with the correlation between every pair of columns
+    """
+    if method not in METHODS:
+        raise ValueError(f'Unknown correlation method {method}, choose one of {METHODS}')
+
+    numeric = _numeric_columns(df)
+    values = numeric.values.astype(np.float64)
+    mask = ~np.isnan(values)
+
+    if method == 'spearman':
+        values = numeric.rank().values
+
+    correlation = _blocked_pearson(values, mask, block_size, np.dtype(dtype))
+
+    if method == 'spearman':
+        _rerank_incomplete_pairs(correlation, numeric.values.astype(np.float64), mask)
+
+    return pd.DataFrame(correlation, index=numeric.columns, columns=numeric.columns)
+
+
+def _numeric_columns(df: pd.DataFrame) -> pd.DataFrame:
+    return df.select_dtypes(include=['number', 'bool'])
+
+
+def _blocked_pearson(values: np.ndarray, mask: np.ndarray, block_size: int, dtype: np.dtype) -> np.ndarray:
+    n_columns = values.shape[1]
+
+    # Center every column to limit loss of precision, missing values become 0 so they do not add to any sum
+    n_values = mask.sum(axis=0)
+    mean = np.where(mask, values, 0).sum(axis=0) / np.maximum(n_values, 1)
+    centered = np.where(mask, values - mean, 0).astype(dtype)
+    weights = mask.astype(dtype)
+    squares = centered * centered
+    complete = mask.all(axis=0)
+
+    correlation = np.empty((n_columns, n_columns))
+    for i in range(0, n_columns, block_size):
+        rows = slice(i, i + block_size)
+        for j in range(i, n_columns, block_size):
+            columns = slice(j, j + block_size)
+            products = (centered[:, rows].T @ centered[:, columns]).astype(np.float64)
+
+            if complete[rows].all() and complete[columns].all():
+                # Without missing values the count and sums do not depend on the pair of columns
+                sums_i = centered[:, rows].sum(axis=0, dtype=np.float64)[:, None]
+                sums_j = centered[:, columns].sum(axis=0, dtype=np.float64)[None, :]
+                squares_i = squares[:, rows].sum(axis=0, dtype=np.float64)[:, None]
+                squares_j = squares[:, columns].sum(axis=0, dtype=np.float64)[None, :]
+                count = np.full(products.shape, len(values), dtype=np.float64)
+            else:
+                sums_i = (centered[:, rows].T @ weights[:, columns]).astype(np.float64)
+                sums_j = (weights[:, rows].T @ centered[:, columns]).astype(np.float64)
+                squares_i = (squares[:, rows].T @ weights[:, columns]).astype(np.float64)
+                squares_j = (weights[:, rows].T @ squares[:, columns]).astype(np.float64)
+                count = (weights[:, rows].T @ weights[:, columns]).astype(np.float64)
+
+            block = _pearson(count, products, sums_i, sums_j, squares_i, squares_j, dtype)
+            correlation[rows, columns] = block
+            correlation[columns, rows] = block.T
+
+    return correlation
+
+
+def _rerank_incomplete_pairs(correlation: np.ndarray, values: np.ndarray, mask: np.ndarray):
+    """
+    Like pandas, the Spearman correlation of a pair of columns ranks only the records where both values are present.
+    The ranks of complete columns can be shared, pairs with columns that miss values are ranked again.
+
+    Every column is sorted only once. The rank of a value within a subset of the records follows from the number of
+    records of the subset that come before it in sorted order, which is a cumulative sum. For a column i with missing
+    values this gives the ranks of all columns j within the records where column i is present, and the ranks of
+    column i within the records where column j is present, at once.
+    """
+    n_rows, n_columns = values.shape
+    column_index = np.arange(n_columns)
+
+    order = np.argsort(values, axis=0, kind='stable')
+    sorted_values = np.take_along_axis(values, order, axis=0)
+    sorted_mask = np.take_along_axis(mask, order, axis=0)
+    group_start, group_end = _tie_groups(sorted_values)
+
+    # Positions in the flattened arrays, which are much faster to index than `np.take_along_axis`
+    flat_order = (order * n_columns + column_index).ravel()
+    flat_start = (group_start * n_columns + column_index).ravel()
+    flat_end = (group_end * n_columns + column_index).ravel()
+
+    for i in np.flatnonzero(~mask.all(axis=0)):
+        # Ranks of every column j within the records where column i is present
+        keep = sorted_mask & mask[order, i]
+        ranks_j = np.empty(values.size)
+        ranks_j[flat_order] = _subset_ranks(keep, flat_start, flat_end)
+        ranks_j = ranks_j.reshape(values.shape)
+
+        # Ranks of column i within the records where column j is present
+        keep = mask[order[:, i], :]
+        ranks_i = np.empty(values.shape)
+        ranks_i[order[:, i]] = _subset_ranks(keep, (group_start[:, [i]] * n_columns + column_index).ravel(),
+                                             (group_end[:, [i]] * n_columns + column_index).ravel()
+                                             ).reshape(values.shape)
+
+        present = mask & mask[:, [i]]
+        ranks_i = np.where(present, ranks_i, 0)
+        ranks_j = np.where(present, ranks_j, 0)
+        row = _pearson(present.sum(axis=0).astype(np.float64), (ranks_i * ranks_j).sum(axis=0), ranks_i.sum(axis=0),
+                       ranks_j.sum(axis=0), (ranks_i ** 2).sum(axis=0), (ranks_j ** 2).sum(axis=0))
+        correlation[i, :] = row
+        correlation[:, i] = row
+
+
+def _tie_groups(sorted_values: np.ndarray):
+    """
+    For every position in the sorted columns, the first and the last position with the same value.
+    """
+    n_rows = len(sorted_values)
+    positions = np.arange(n_rows)[:, None]
+    same = sorted_values[1:] == sorted_values[:-1]
+
+    is_start = np.vstack([np.ones((1, sorted_values.shape[1]), dtype=bool), ~same])
+    is_end = np.vstack([~same, np.ones((1, sorted_values.shape[1]), dtype=bool)])
+
+    group_start = np.maximum.accumulate(np.where(is_start, positions, 0), axis=0)
+    group_end = np.minimum.accumulate(np.where(is_end, positions, n_rows)[::-1], axis=0)[::-1]
+    return group_start, group_end
+
+
+def _subset_ranks(keep: np.ndarray, flat_start: np.ndarray, flat_end: np.ndarray) -> np.ndarray:
+    """
+    Average ranks, in sorted order, of the values within the records marked by `keep`. `flat_start` and `flat_end`
+    are the flattened positions of the first and last value of the group of equal values of every position. Ranks of
+    records that are not kept are meaningless.
+
+    :return: flattened ranks
+    """
+    cumulative = np.cumsum(keep, axis=0, dtype=np.int32)
+    before = (cumulative - keep).ravel()[flat_start]
+    ties = cumulative.ravel()[flat_end] - before
+    return before + (ties + 1) / 2
+
+
+def _pearson(count: np.ndarray, products: np.ndarray, sums_i: np.ndarray, sums_j: np.ndarray,
+             squares_i: np.ndarray, squares_j: np.ndarray, dtype: np.dtype = np.float64) -> np.ndarray:
+    """
+    Pearson correlation from pairwise counts and sums. Entries without at least two records or without variance are
+    NaN.
+
+    A column that is constant within the records of a pair does not get a variance of exactly 0, but a rounding error
+    of the sums. Variances within `VARIANCE_TOLERANCE` times the precision of `dtype`, relative to the sum of squares,
+    count as no variance.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        covariance = count * products - sums_i * sums_j
+        variance_i = count * squares_i - sums_i ** 2
+        variance_j = count * squares_j - sums_j ** 2
+        correlation = covariance / np.sqrt(variance_i * variance_j)
+
+    tolerance = VARIANCE_TOLERANCE * np.finfo(dtype).eps * count
+    constant = (variance_i <= tolerance * squares_i) | (variance_j <= tolerance * squares_j)
+    correlation[(count < 2) | constant] = np.nan
+    return np.clip(correlation, -1, 1)
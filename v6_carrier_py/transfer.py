@@ -0,0 +1,223 @@
+"""
+Encoding of node results for the transfer to the master.
+
+Node results are pickled by default. With the `arrow` output format, DataFrames are written as Arrow IPC files instead,
+optionally compressed with lz4 or zstd. The master reads those without unpickling: uncompressed columns are used in
+place, either in the received bytes or in a memory-mapped file. This requires `pyarrow`.
+
+Large DataFrames can be split into record batches of a bounded number of rows (`batch_rows`). The master then
+receives a `RecordBatches` object instead of a DataFrame, which reads one batch at a time, optionally only some of the
+columns. Together with compression and memory mapping, the master never needs to hold a full node table.
+
+Like the other vantage6 output formats, an encoded result starts with the name of its format and a dot. Results
+without such a prefix are pickles.
+"""
+import json
+import os
+import pickle
+import tempfile
+from typing import Any, BinaryIO, Iterator, List, Optional
+
+import pandas as pd
+from vantage6.client import serialization
+from vantage6.tools.data_format import DataFormat
+
+ARROW = 'arrow'
+# Arrow IPC file with record batches that are read one at a time, see `RecordBatches`
+BATCHES = 'batches'
+PICKLE = 'pickle'
+JSON = 'json'
+COMPRESSIONS = ('lz4', 'zstd')
+
+_FORMATS = (ARROW, BATCHES, PICKLE, JSON)
+# Schema metadata with the total number of rows of a batched result
+_NUM_ROWS = b'num_rows'
+# Longest prefix that is checked for a format name
+_PREFIX_BYTES = max(len(f) for f in _FORMATS) + 1
+
+
+def write(output: Any, fp: BinaryIO, output_format: Optional[str] = None, compression: Optional[str] = None,
+          batch_rows: Optional[int] = None):
+    """
+    Write the output of an algorithm to the binary file `fp`.
+
+    :param output_format: `arrow`, `json` or `pickle`. Without a format the output is pickled without prefix, which
+                          is what the vantage6 client expects. Outputs that are not DataFrames, or that Arrow can not
+                          represent, are pickled when `arrow` is requested.
+    :param compression: Compression of Arrow record batches, `lz4` or `zstd`. Compressed results have to be decoded
+                        by the master, uncompressed results can be read in place.
+    :param batch_rows: Split DataFrames into Arrow record batches of at most this many rows, which the master reads
+                       as `RecordBatches`. This implies the `arrow` output format. The index is not kept.
+    """
+    if batch_rows is not None and isinstance(output, pd.DataFrame):
+        table = _to_table(output, preserve_index=False)
+        if table is not None:
+            metadata = dict(table.schema.metadata or {})
+            metadata[_NUM_ROWS] = str(len(output)).encode()
+            fp.write(BATCHES.encode() + b'.')
+            _write_table(table.replace_schema_metadata(metadata), fp, compression, batch_rows)
+            return
+        output_format = PICKLE
+
+    if output_format is None:
+        fp.write(pickle.dumps(output))
+        return
+
+    if compression is not None and compression not in COMPRESSIONS:
+        raise ValueError(f'Unknown compression {compression}, use one of {COMPRESSIONS}')
+
+    if output_format.lower() == ARROW:
+        table = _to_table(output) if isinstance(output, pd.DataFrame) else None
+        if table is not None:
+            fp.write(ARROW.encode() + b'.')
+            _write_table(table, fp, compression)
+            return
+        output_format = PICKLE
+
+    fp.write(output_format.encode() + b'.')
+    # The format is checked against the formats that vantage6 knows
+    fp.write(serialization.serialize(output, DataFormat(output_format.lower()).value))
+
+
+def decode(data: bytes, directory: Optional[str] = None) -> Any:
+    """
+    Decode a result that was written by `write`. Results that were split into batches are returned as
+    `RecordBatches`.
+
+    Uncompressed Arrow results are not copied: the columns of the DataFrame refer to `data`, and are therefore
+    read-only. When `directory` is given, Arrow results are written to a file in that directory and memory mapped
+    instead, so their data is paged in from disk and does not stay on the heap.
+    """
+    prefix, dot, _ = data[:_PREFIX_BYTES].partition(b'.')
+    output_format = prefix.decode('ascii', errors='ignore').lower() if dot else None
+    if output_format not in _FORMATS:
+        return pickle.loads(data)
+
+    offset = len(prefix) + 1
+    if output_format in (ARROW, BATCHES):
+        batches = RecordBatches(_open_arrow(data, offset, directory))
+        return batches if output_format == BATCHES else batches.to_pandas()
+    if output_format == JSON:
+        return json.loads(data[offset:])
+    return pickle.loads(memoryview(data)[offset:])
+
+
+class RecordBatches:
+    """
+    DataFrame that is read one record batch at a time. Only the batch that is being processed is decompressed and
+    converted, the rest stays encoded in memory, or on disk when it is memory mapped.
+
+    :param source: Arrow file with the batches
+    """
+
+    def __init__(self, source):
+        import pyarrow as pa
+
+        self._source = source
+        self.schema = pa.ipc.open_file(source).schema
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'RecordBatches':
+        import pyarrow as pa
+
+        return cls(pa.BufferReader(pa.py_buffer(data)))
+
+    @property
+    def columns(self) -> List[str]:
+        return list(self.schema.names)
+
+    @property
+    def num_batches(self) -> int:
+        return self._reader().num_record_batches
+
+    def __len__(self) -> int:
+        return int(self.schema.metadata[_NUM_ROWS])
+
+    def __iter__(self) -> Iterator[pd.DataFrame]:
+        return self.iter_frames()
+
+    def iter_frames(self, columns: Optional[List[str]] = None) -> Iterator[pd.DataFrame]:
+        """
+        Yield every batch as DataFrame.
+
+        :param columns: Only read these columns, the other columns are not even decompressed
+        """
+        reader = self._reader(columns)
+        for i in range(reader.num_record_batches):
+            yield self._select(reader.get_batch(i), columns).to_pandas(split_blocks=True)
+
+    def empty(self, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        DataFrame without rows, with the columns and dtypes of the batches.
+        """
+        reader = self._reader(columns)
+        # The schema does not contain the categories of categorical columns, the first batch does
+        empty = reader.get_batch(0).slice(0, 0) if reader.num_record_batches else reader.schema.empty_table()
+        return self._select(empty, columns).to_pandas()
+
+    def to_pandas(self, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Read all batches into one DataFrame.
+        """
+        # One block per column, so pandas does not copy columns into consolidated blocks
+        return self._select(self._reader(columns).read_all(), columns).to_pandas(split_blocks=True)
+
+    def to_bytes(self) -> bytes:
+        self._source.seek(0)
+        return self._source.read()
+
+    def __reduce__(self):
+        # Pickled as the encoded batches, so results can be cached
+        return RecordBatches.from_bytes, (self.to_bytes(),)
+
+    @staticmethod
+    def _select(data, columns: Optional[List[str]]):
+        # Only the requested fields are read, in the order of the schema
+        return data if columns is None else data.select(columns)
+
+    def _reader(self, columns: Optional[List[str]] = None):
+        import pyarrow as pa
+
+        options = pa.ipc.IpcReadOptions()
+        if columns is not None:
+            options = pa.ipc.IpcReadOptions(included_fields=[self.schema.get_field_index(c) for c in columns])
+        return pa.ipc.open_file(self._source, options=options)
+
+
+def _to_table(df: pd.DataFrame, preserve_index: Optional[bool] = None):
+    """
+    Arrow table of `df`, or `None` when Arrow can not represent it, for example a column with mixed types.
+    """
+    import pyarrow as pa
+
+    try:
+        return pa.Table.from_pandas(df, preserve_index=preserve_index)
+    except (ValueError, TypeError, NotImplementedError):
+        return None
+
+
+def _write_table(table, fp: BinaryIO, compression: Optional[str], batch_rows: Optional[int] = None):
+    import pyarrow as pa
+
+    options = pa.ipc.IpcWriteOptions(compression=compression)
+    # The file format has a footer with the location of every record batch, so the master can memory map it and read
+    # any batch
+    with pa.ipc.new_file(fp, table.schema, options=options) as writer:
+        writer.write_table(table, max_chunksize=batch_rows)
+
+
+def _open_arrow(data: bytes, offset: int, directory: Optional[str]):
+    """
+    Arrow file in `data` from `offset`, or a memory-mapped copy of it in `directory`.
+    """
+    import pyarrow as pa
+
+    if directory is None:
+        source = pa.BufferReader(pa.py_buffer(data).slice(offset))
+    else:
+        with tempfile.NamedTemporaryFile(dir=directory, suffix='.arrow', delete=False) as f:
+            f.write(memoryview(data)[offset:])
+        source = pa.memory_map(f.name)
+        # The mapping keeps the data available, the file is removed when it is closed
+        os.remove(f.name)
+    return source
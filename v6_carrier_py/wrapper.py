@@ -1,16 +1,21 @@
 import os
-import pickle
-from io import StringIO
+from typing import Any, Dict, List, Optional
 
 import pandas as pd
-from SPARQLWrapper import SPARQLWrapper, CSV
-from vantage6.client import serialization
 from vantage6.tools import docker_wrapper
-from vantage6.tools.data_format import DataFormat
 from vantage6.tools.dispatch_rpc import dispact_rpc
 from vantage6.tools.util import info
 
-SPARQL_RETURN_FORMAT = CSV
+from . import sparql, transfer
+from .cache import QueryCache
+
+# Input field with a list of methods that are run on the result of a single query
+BATCH = 'batch'
+# Environment variables that configure the query cache, see `query_triplestore`
+QUERY_CACHE_DIR = 'QUERY_CACHE_DIR'
+QUERY_CACHE_TTL = 'QUERY_CACHE_TTL'
+QUERY_CACHE_MAX_BYTES = 'QUERY_CACHE_MAX_BYTES'
+DATASET_VERSION = 'DATASET_VERSION'
 
 
 def sparql_wrapper(module: str):
@@ -28,8 +33,25 @@ def sparql_wrapper(module: str):
     - `TOKEN_FILE`: Path to a file containing a vantage6 authentication token
     - `OUTPUT_FILE`: Path where algorithm output should be stored
 
+    Optional environment variables:
+
+    - `QUERY_CACHE_DIR`: Directory, for example on a mounted volume, where query results are cached
+    - `QUERY_CACHE_TTL`: Number of seconds query results are cached, one hour by default
+    - `QUERY_CACHE_MAX_BYTES`: Maximum size of the query cache, 4 GiB by default
+    - `DATASET_VERSION`: Version of the data in the triplestore. Cached results of other versions are not used. The
+      input field `dataset_version` takes precedence.
+
     The file indicated by the `INPUT_FILE` environment variable requires the field `query` in order to use this wrapper.
-    The value should be a SPARQL `SELECT` query string.
+    The value should be a SPARQL `SELECT` query string. With the optional field `page_size`, the result is fetched in
+    pages of that many rows, which are requested concurrently. The methods `column_names` and `count` do not need the
+    result itself: the variables are read from the query, or a count is computed by the triplestore, see
+    `METADATA_METHODS`. Master tasks of these methods are dispatched like any other method.
+
+    The optional field `output_format` selects how the output is written, see `transfer.write`. With `arrow`,
+    DataFrames are written as Arrow IPC files that the master reads without unpickling, and the optional field
+    `compression` (`lz4` or `zstd`) compresses them. With the field `batch_rows`, DataFrames are split into record
+    batches of at most that many rows, which the master reads one at a time. Without `output_format` or `batch_rows`
+    the output is pickled.
 
     Example
     ======
@@ -50,6 +72,18 @@ def sparql_wrapper(module: str):
     The wrapper will provide the `column_names` algorithm with a pandas dataframe with the columns `person`, `name`,
     `email`.
 
+    Batches
+    =======
+    Instead of `method`, the input can contain the field `batch`: a list of methods, each with their own `args` and
+    `kwargs`. The query is run once and every method is called with the same dataframe. The output is a dict with
+    the result of every method, keyed by method name, or by the optional field `name` of the method. For example:
+    ```
+    {'query': '...',
+     'batch': [{'method': 'column_names'},
+               {'method': 'correlation_matrix', 'kwargs': {'method': 'spearman'}, 'name': 'spearman'}]
+     }
+    ```
+
     :param module: the name of a package that contains vantage6 algorithms
     :return:
     """
@@ -78,30 +112,68 @@ def sparql_wrapper(module: str):
 
     info(f"Using '{endpoint}' as triplestore endpoint")
 
-    data = query_triplestore(endpoint, query)
-
-    # make the actual call to the method/function
-    info("Dispatching ...")
-    output = dispact_rpc(data, input_data, module, token)
+    dataset_version = input_data.get('dataset_version', os.environ.get(DATASET_VERSION))
+    # Master methods with the same name combine the results of all organizations, so they are dispatched as usual
+    pushdown = None
+    if BATCH not in input_data and not input_data.get('master'):
+        pushdown = METADATA_METHODS.get(input_data.get('method'))
+    if pushdown is not None:
+        info(f"Computing {input_data['method']} without retrieving the full query result")
+        output = pushdown(endpoint, query, cache=_query_cache(), dataset_version=dataset_version)
+    else:
+        data = query_triplestore(endpoint, query, cache=_query_cache(), dataset_version=dataset_version,
+                                 page_size=input_data.get('page_size'))
+
+        # make the actual call to the method/function
+        info("Dispatching ...")
+        if BATCH in input_data:
+            output = _dispatch_batch(data, input_data[BATCH], module, token)
+        else:
+            output = dispact_rpc(data, input_data, module, token)
 
     # write output from the method to mounted output file. Which will be
     # transfered back to the server by the node-instance.
     output_file = os.environ["OUTPUT_FILE"]
     info(f"Writing output to {output_file}")
     with open(output_file, 'wb') as fp:
-        if 'output_format' in input_data:
-            output_format = input_data['output_format']
+        transfer.write(output, fp, output_format=input_data.get('output_format'),
+                       compression=input_data.get('compression'), batch_rows=input_data.get('batch_rows'))
 
-            # Indicate output format
-            fp.write(output_format.encode() + b'.')
 
-            # Write actual data
-            output_format = DataFormat(output_format.lower())
-            serialized = serialization.serialize(output, output_format)
-            fp.write(serialized)
-        else:
-            # No output format specified, use legacy method
-            fp.write(pickle.dumps(output))
+def _dispatch_batch(data: pd.DataFrame, batch: list, module: str, token: str) -> Dict[str, Any]:
+    """
+    Call every method of a batch with the same data. Methods should not modify the data.
+
+    :return: results keyed by the name of the method
+    """
+    results = {}
+    for method_input in batch:
+        name = method_input.get('name', method_input['method'])
+        if name in results:
+            raise ValueError(f'Batch contains method {name} multiple times, give every call a unique name')
+
+        info(f"Dispatching {name}")
+        method_input = {key: value for key, value in method_input.items() if key in ('method', 'args', 'kwargs')}
+        results[name] = dispact_rpc(data, method_input, module, token)
+    return results
+
+
+def _column_names(endpoint: str, query: str, **kwargs) -> List[str]:
+    columns = sparql.variables(query)
+    if columns is None:
+        columns = query_triplestore(endpoint, sparql.header_query(query), **kwargs).columns.to_list()
+    return columns
+
+
+def _count(endpoint: str, query: str, **kwargs) -> int:
+    result = query_triplestore(endpoint, sparql.count_query(query, 'count'), **kwargs)
+    return int(result['count'].iloc[0])
+
+
+# Methods that only need metadata of the query result. Their output is computed with a cheaper query that the
+# triplestore answers without sending the full result. The output is the same as that of `RPC_column_names` and
+# `RPC_count`.
+METADATA_METHODS = {'column_names': _column_names, 'count': _count}
 
 
 def _fix_endpoint(endpoint: str) -> str:
@@ -117,10 +189,41 @@ def _fix_endpoint(endpoint: str) -> str:
     return endpoint[idx:]
 
 
-def query_triplestore(endpoint: str, query: str):
-    sparql = SPARQLWrapper(endpoint, returnFormat=SPARQL_RETURN_FORMAT)
-    sparql.setQuery(query)
+def _query_cache() -> Optional[QueryCache]:
+    directory = os.environ.get(QUERY_CACHE_DIR)
+    if not directory:
+        return None
+
+    kwargs = {}
+    if QUERY_CACHE_TTL in os.environ:
+        kwargs['ttl'] = float(os.environ[QUERY_CACHE_TTL])
+    if QUERY_CACHE_MAX_BYTES in os.environ:
+        kwargs['max_bytes'] = int(os.environ[QUERY_CACHE_MAX_BYTES])
+    return QueryCache(directory, **kwargs)
 
-    result = sparql.query().convert().decode()
 
-    return pd.read_csv(StringIO(result))
+def query_triplestore(endpoint: str, query: str, cache: QueryCache = None, dataset_version: str = None,
+                      page_size: int = None):
+    """
+    Run `query` on the SPARQL endpoint and return the result as DataFrame.
+
+    :param cache: Cache that is checked before the query is run, and that stores the result afterwards
+    :param dataset_version: Version of the data in the triplestore, part of the cache key
+    :param page_size: Fetch the result in pages of `page_size` rows, which are requested concurrently, see
+                      `sparql.query_pages`
+    """
+    if cache is not None:
+        key = cache.make_key(endpoint, query, dataset_version)
+        data = cache.get(key)
+        if data is not None:
+            info('Using cached query result')
+            return data
+
+    if page_size:
+        data = sparql.query_pages(endpoint, query, page_size=page_size)
+    else:
+        data = sparql.query(endpoint, query)
+
+    if cache is not None:
+        cache.put(key, data)
+    return data